@@ -330,9 +330,11 @@ static void ota_check_task(void *pvParameters) {
     return;
   }
 
-  // Extract version (simple extraction)
+  // Extract version (simple extraction): skip key, then find value's quote
   char new_version[32] = {0};
-  const char *version_start = strchr(version_str, '"');
+  const char *version_colon = strchr(version_str + strlen("\"version\""), ':');
+  const char *version_start =
+      version_colon ? strchr(version_colon, '"') : NULL;
   if (version_start) {
     version_start++; // Skip first quote
     const char *version_end = strchr(version_start, '"');
@@ -484,3 +486,157 @@ esp_err_t ota_update_deinit(void) {
 }
 
 #endif // CONFIG_OTA_ENABLE
+
+#if defined(CONFIG_USB_OTA_ENABLE) && defined(ESP_PLATFORM)
+
+#include "esp_log.h"
+#include "esp_ota_ops.h"
+#include "esp_partition.h"
+#include "mbedtls/sha256.h"
+#include <string.h>
+
+#define STREAM_TAG "ota_stream"
+
+// Streamed (USB CDC) OTA state. Kept across disconnects so that a host
+// reconnecting with the same image can resume instead of starting over.
+static bool s_stream_active = false;
+static esp_ota_handle_t s_stream_handle = 0;
+static const esp_partition_t *s_stream_partition = NULL;
+static uint32_t s_stream_size = 0;
+static uint32_t s_stream_written = 0;
+static uint8_t s_stream_sha256[32];
+static mbedtls_sha256_context s_stream_sha_ctx;
+
+esp_err_t ota_stream_begin(uint32_t image_size, const uint8_t sha256[32],
+                           uint32_t *resume_offset) {
+  if (image_size == 0 || sha256 == NULL || resume_offset == NULL) {
+    return ESP_ERR_INVALID_ARG;
+  }
+
+  // Same image as the interrupted transfer: continue where flash stopped
+  if (s_stream_active && s_stream_size == image_size &&
+      memcmp(s_stream_sha256, sha256, sizeof(s_stream_sha256)) == 0) {
+    *resume_offset = s_stream_written;
+    ESP_LOGI(STREAM_TAG, "Resuming OTA stream at %lu/%lu bytes",
+             (unsigned long)s_stream_written, (unsigned long)image_size);
+    return ESP_OK;
+  }
+
+  ota_stream_abort();
+
+  s_stream_partition = esp_ota_get_next_update_partition(NULL);
+  if (s_stream_partition == NULL) {
+    ESP_LOGE(STREAM_TAG, "No OTA partition available");
+    return ESP_ERR_NOT_FOUND;
+  }
+  if (image_size > s_stream_partition->size) {
+    ESP_LOGE(STREAM_TAG, "Image (%lu bytes) larger than partition %s",
+             (unsigned long)image_size, s_stream_partition->label);
+    return ESP_ERR_INVALID_SIZE;
+  }
+
+  // Sequential writes: erase sector by sector instead of the whole image
+  // up front, so the host gets its reply immediately
+  esp_err_t ret = esp_ota_begin(s_stream_partition, OTA_WITH_SEQUENTIAL_WRITES,
+                                &s_stream_handle);
+  if (ret != ESP_OK) {
+    ESP_LOGE(STREAM_TAG, "esp_ota_begin failed: %s", esp_err_to_name(ret));
+    return ret;
+  }
+
+  mbedtls_sha256_init(&s_stream_sha_ctx);
+  mbedtls_sha256_starts(&s_stream_sha_ctx, 0);
+  memcpy(s_stream_sha256, sha256, sizeof(s_stream_sha256));
+  s_stream_size = image_size;
+  s_stream_written = 0;
+  s_stream_active = true;
+  *resume_offset = 0;
+
+  ESP_LOGI(STREAM_TAG, "OTA stream started: %lu bytes -> %s",
+           (unsigned long)image_size, s_stream_partition->label);
+  return ESP_OK;
+}
+
+esp_err_t ota_stream_write(uint32_t offset, const uint8_t *data, size_t len) {
+  if (!s_stream_active) {
+    return ESP_ERR_INVALID_STATE;
+  }
+  if (offset != s_stream_written) {
+    return ESP_ERR_INVALID_ARG;
+  }
+  if (len > s_stream_size - s_stream_written) {
+    return ESP_ERR_INVALID_SIZE;
+  }
+
+  esp_err_t ret = esp_ota_write(s_stream_handle, data, len);
+  if (ret != ESP_OK) {
+    ESP_LOGE(STREAM_TAG, "esp_ota_write failed at %lu: %s",
+             (unsigned long)offset, esp_err_to_name(ret));
+    return ret;
+  }
+  mbedtls_sha256_update(&s_stream_sha_ctx, data, len);
+  s_stream_written += len;
+  return ESP_OK;
+}
+
+uint32_t ota_stream_written(void) {
+  return s_stream_active ? s_stream_written : 0;
+}
+
+esp_err_t ota_stream_finish(void) {
+  if (!s_stream_active || s_stream_written != s_stream_size) {
+    return ESP_ERR_INVALID_STATE;
+  }
+
+  uint8_t digest[32];
+  mbedtls_sha256_finish(&s_stream_sha_ctx, digest);
+  if (memcmp(digest, s_stream_sha256, sizeof(digest)) != 0) {
+    ESP_LOGE(STREAM_TAG, "SHA-256 mismatch, discarding image");
+    ota_stream_abort();
+    return ESP_ERR_INVALID_CRC;
+  }
+
+  mbedtls_sha256_free(&s_stream_sha_ctx);
+  s_stream_active = false;
+
+  // esp_ota_end validates the image (header, segments, appended hash)
+  esp_err_t ret = esp_ota_end(s_stream_handle);
+  if (ret != ESP_OK) {
+    ESP_LOGE(STREAM_TAG, "esp_ota_end failed: %s", esp_err_to_name(ret));
+    return ret;
+  }
+
+  ret = esp_ota_set_boot_partition(s_stream_partition);
+  if (ret != ESP_OK) {
+    ESP_LOGE(STREAM_TAG, "esp_ota_set_boot_partition failed: %s",
+             esp_err_to_name(ret));
+    return ret;
+  }
+
+  ESP_LOGI(STREAM_TAG, "OTA stream complete, next boot from %s",
+           s_stream_partition->label);
+  return ESP_OK;
+}
+
+void ota_stream_abort(void) {
+  if (!s_stream_active) {
+    return;
+  }
+  esp_ota_abort(s_stream_handle);
+  mbedtls_sha256_free(&s_stream_sha_ctx);
+  s_stream_active = false;
+  s_stream_written = 0;
+  s_stream_size = 0;
+}
+
+bool ota_stream_is_running_image(const uint8_t app_digest[32]) {
+  uint8_t running_digest[32];
+  const esp_partition_t *running = esp_ota_get_running_partition();
+  if (running == NULL ||
+      esp_partition_get_sha256(running, running_digest) != ESP_OK) {
+    return false;
+  }
+  return memcmp(running_digest, app_digest, sizeof(running_digest)) == 0;
+}
+
+#endif // CONFIG_USB_OTA_ENABLE
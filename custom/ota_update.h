@@ -97,3 +97,78 @@ esp_err_t ota_check_for_updates(ota_callback_t callback);
 esp_err_t ota_update_deinit(void);
 
 #endif // CONFIG_OTA_ENABLE
+
+#if defined(CONFIG_USB_OTA_ENABLE) && defined(ESP_PLATFORM)
+
+#include "esp_err.h"
+#include <stdbool.h>
+#include <stddef.h>
+#include <stdint.h>
+
+/**
+ * @brief Start (or resume) receiving a firmware image as a byte stream
+ *
+ * Used by the USB CDC OTA receiver in usb_comm.c. If an interrupted transfer
+ * of the same image (same size and SHA-256) is still open, the transfer
+ * resumes from the number of bytes already written to flash.
+ *
+ * @param image_size Total image size in bytes
+ * @param sha256 Expected SHA-256 of the whole image (32 bytes)
+ * @param[out] resume_offset Offset the sender should continue from
+ * @return
+ *    - ESP_OK: Ready to receive data at *resume_offset
+ *    - ESP_ERR_INVALID_ARG: Invalid size or NULL pointer
+ *    - ESP_ERR_NOT_FOUND: No OTA partition available
+ *    - ESP_ERR_INVALID_SIZE: Image larger than the OTA partition
+ *    - Other: Error from esp_ota_begin
+ */
+esp_err_t ota_stream_begin(uint32_t image_size, const uint8_t sha256[32],
+                           uint32_t *resume_offset);
+
+/**
+ * @brief Write the next chunk of the image
+ *
+ * Chunks must arrive in order: offset has to equal the number of bytes
+ * written so far.
+ *
+ * @return
+ *    - ESP_OK: Chunk written
+ *    - ESP_ERR_INVALID_STATE: No transfer in progress
+ *    - ESP_ERR_INVALID_ARG: Offset does not match the next expected offset
+ *    - ESP_ERR_INVALID_SIZE: Chunk goes past the announced image size
+ *    - Other: Error from esp_ota_write
+ */
+esp_err_t ota_stream_write(uint32_t offset, const uint8_t *data, size_t len);
+
+/**
+ * @brief Get the number of bytes written in the current transfer
+ */
+uint32_t ota_stream_written(void);
+
+/**
+ * @brief Verify SHA-256 and the image, then select it as boot partition
+ *
+ * The caller is responsible for rebooting (esp_restart) afterwards.
+ *
+ * @return
+ *    - ESP_OK: Image valid, boot partition updated
+ *    - ESP_ERR_INVALID_STATE: Image not completely received
+ *    - ESP_ERR_INVALID_CRC: SHA-256 mismatch
+ *    - Other: Error from esp_ota_end / esp_ota_set_boot_partition
+ */
+esp_err_t ota_stream_finish(void);
+
+/**
+ * @brief Abort the current transfer and discard the partially written image
+ */
+void ota_stream_abort(void);
+
+/**
+ * @brief Check whether the running firmware already is the given image
+ *
+ * @param app_digest SHA-256 appended to the image by ESP-IDF (32 bytes)
+ * @return true if the running partition has the same digest
+ */
+bool ota_stream_is_running_image(const uint8_t app_digest[32]);
+
+#endif // CONFIG_USB_OTA_ENABLE
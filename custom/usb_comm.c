@@ -1,13 +1,22 @@
 #include "usb_comm.h"
+#include "esp_app_desc.h"
 #include "esp_log.h"
 #include "gui_guider.h"
 #include "lvgl_port_v9.h"
 #include "tinyusb_cdc_acm.h"
 #include "tinyusb_default_config.h"
 #include "freertos/queue.h"
+#include "ota_update.h"
+#include <stdarg.h>
 #include <stdio.h>
+#include <stdlib.h>
 #include <string.h>
 
+#ifdef CONFIG_USB_OTA_ENABLE
+#include "esp_rom_crc.h"
+#include "esp_system.h"
+#endif
+
 // USB CDC buffer size
 #define USB_CDC_BUF_SIZE 64
 
@@ -21,6 +30,10 @@ static bool s_screen_switched = false;       // Đã chuyển từ screen_loadin
 static bool s_data_received = false;         // Đã nhận được dữ liệu từ host chưa
 static bool s_screen_switch_pending = false; // Đã gửi signal chuyển screen vào queue chưa
 static char s_label_version[64] = "";        // Lưu giá trị label_version để join vào label_account
+static char s_dsm_upgrade_text[32] = "";     // Giá trị label_upgrade_available gần nhất (từ DSM)
+static char s_fw_notice_version[32] = "";    // Version firmware mới host báo (rỗng = không có)
+static char s_fw_notice_sha[65] = "";        // SHA-256 image đã báo, để chỉ xử lý 1 lần mỗi image
+static bool s_snapshot_stale = false;        // Đang hiển thị snapshot cũ của host (sau restart/reconnect)
 
 // Queue để gửi tín hiệu backlight state (tránh block khi gửi)
 static QueueHandle_t s_backlight_signal_queue = NULL;
@@ -269,6 +282,8 @@ static void cdc_line_state_changed_cb(int itf, cdcacm_event_t *event) {
 
     // Reset flag data received when CDC disconnected
     s_data_received = false;
+    // Kết nối mới sẽ tự báo snapshot cũ/live, không giữ trạng thái mờ của lần trước
+    s_snapshot_stale = false;
 
     // IMPORTANT: When host closes connection (DTR=0), always switch back to screen_loading
     // if currently on screen. No need to check was_ready as callback may be called multiple times
@@ -445,6 +460,137 @@ static void usb_set_upgrade_label_text_and_color(lv_obj_t *widget, int upgrade_v
   lv_obj_set_style_text_color(widget, color, LV_PART_MAIN | LV_STATE_DEFAULT);
 }
 
+/**
+ * Vẽ label_upgrade_available: ưu tiên thông báo firmware mới từ host (màu cam),
+ * nếu không có thì hiển thị trạng thái upgrade của DSM.
+ * Gọi khi đã lock LVGL.
+ *
+ * @param widget Widget label_upgrade_available
+ */
+static void usb_render_upgrade_label_unlocked(lv_obj_t *widget) {
+  if (s_fw_notice_version[0] != '\0') {
+    char text[48];
+    snprintf(text, sizeof(text), "FW %s", s_fw_notice_version);
+    lv_label_set_text(widget, text);
+    lv_obj_set_style_text_color(widget, lv_color_hex(0xFFA500), LV_PART_MAIN | LV_STATE_DEFAULT);
+    return;
+  }
+
+  int upgrade_value = 0;
+  if (sscanf(s_dsm_upgrade_text, "%d", &upgrade_value) == 1) {
+    usb_set_upgrade_label_text_and_color(widget, upgrade_value);
+  } else if (s_dsm_upgrade_text[0] != '\0') {
+    // Nếu không parse được, hiển thị trực tiếp text
+    lv_label_set_text(widget, s_dsm_upgrade_text);
+  }
+}
+
+/**
+ * So sánh version dạng "1.2.3" (cho phép tiền tố 'v', phần đuôi như "-rc1" bị bỏ qua).
+ *
+ * @param candidate Version host báo
+ * @param running Version firmware đang chạy
+ * @return true nếu candidate mới hơn running; false nếu bằng, cũ hơn hoặc không parse được
+ */
+static bool usb_version_is_newer(const char *candidate, const char *running) {
+  if (*candidate == 'v' || *candidate == 'V') candidate++;
+  if (*running == 'v' || *running == 'V') running++;
+  if (*candidate < '0' || *candidate > '9' || *running < '0' || *running > '9') {
+    return false; // Không phải version số: không thể biết là mới hơn
+  }
+  while ((*candidate >= '0' && *candidate <= '9') || (*running >= '0' && *running <= '9')) {
+    char *end_candidate;
+    char *end_running;
+    unsigned long a = strtoul(candidate, &end_candidate, 10);
+    unsigned long b = strtoul(running, &end_running, 10);
+    if (a != b) {
+      return a > b;
+    }
+    candidate = *end_candidate == '.' ? end_candidate + 1 : end_candidate;
+    running = *end_running == '.' ? end_running + 1 : end_running;
+  }
+  return false;
+}
+
+/**
+ * Xử lý dòng "firmware_available: <version> <size> <sha256>" (hoặc "-") từ host.
+ * Host gửi ngay khi file firmware thay đổi và nhắc lại sau mỗi lần wake up,
+ * nên ESP32 không cần poll /version định kỳ. Chỉ hiển thị khi version host báo
+ * mới hơn bản đang chạy (host rollback về bản cũ không phải là bản cập nhật).
+ *
+ * @param args Phần sau dấu ':'
+ */
+static void usb_handle_firmware_notice(const char *args) {
+  char version[32] = "";
+  char sha[65] = "";
+  unsigned long size = 0;
+
+  if (sscanf(args, " %31s %lu %64s", version, &size, sha) != 3) {
+    version[0] = '\0'; // "-": host không còn firmware
+    sha[0] = '\0';
+  }
+
+  // Firmware đang chạy đã là bản này hoặc mới hơn: không cần báo
+  const esp_app_desc_t *running = esp_app_get_description();
+  if (version[0] != '\0' && !usb_version_is_newer(version, running->version)) {
+    version[0] = '\0';
+  }
+
+  bool changed = strcmp(sha, s_fw_notice_sha) != 0 || strcmp(version, s_fw_notice_version) != 0;
+  strncpy(s_fw_notice_version, version, sizeof(s_fw_notice_version) - 1);
+  strncpy(s_fw_notice_sha, sha, sizeof(s_fw_notice_sha) - 1);
+
+  if (changed && version[0] != '\0') {
+    ESP_LOGI("usb_comm", "Host báo firmware mới: %s (%lu bytes), đang chạy %s", version, size, running->version);
+#if defined(CONFIG_OTA_ENABLE) && defined(CONFIG_OTA_AUTO_CHECK)
+    // Wi-Fi OTA: kiểm tra /version đúng 1 lần khi host báo, thay vì poll định kỳ
+    ota_check_for_updates(NULL);
+#endif
+  }
+
+  // Vẽ lại cả khi không đổi: screen có thể vừa được tạo lại sau khi wake up
+  lv_obj_t *widget = guider_ui.screen_label_upgrade_available;
+  if (widget != NULL && lvgl_port_lock(20)) {
+    if (lv_obj_is_valid(widget)) {
+      usb_render_upgrade_label_unlocked(widget);
+    }
+    lvgl_port_unlock();
+  }
+}
+
+/**
+ * Làm mờ (snapshot cũ) hoặc hiển thị bình thường (số liệu live) toàn bộ screen.
+ * Gọi khi đã lock LVGL.
+ */
+static void usb_apply_stale_style_unlocked(void) {
+  lv_obj_t *screen = guider_ui.screen;
+  if (screen != NULL && lv_obj_is_valid(screen)) {
+    lv_obj_set_style_opa(screen, s_snapshot_stale ? LV_OPA_50 : LV_OPA_COVER, LV_PART_MAIN | LV_STATE_DEFAULT);
+  }
+}
+
+/**
+ * Xử lý dòng "snapshot_stale: <giây>" từ host.
+ * Sau restart/reconnect, host gửi ngay snapshot đã lưu kèm tuổi > 0 để màn hình có số liệu
+ * tức thì; screen hiển thị mờ cho tới khi host gửi số liệu live và "snapshot_stale: 0".
+ *
+ * @param args Phần sau dấu ':'
+ */
+static void usb_handle_snapshot_stale(const char *args) {
+  unsigned long age = 0;
+  if (sscanf(args, " %lu", &age) != 1) {
+    age = 0;
+  }
+  s_snapshot_stale = age > 0;
+  if (s_snapshot_stale) {
+    ESP_LOGI("usb_comm", "Host gửi snapshot cũ (%lu giây trước), hiển thị mờ tới khi có số liệu live", age);
+  }
+  if (lvgl_port_lock(20)) {
+    usb_apply_stale_style_unlocked();
+    lvgl_port_unlock();
+  }
+}
+
 /**
  * Update widget mà không lock (đã lock ở caller)
  * @param widget Widget cần update
@@ -514,6 +660,327 @@ static void usb_update_widget_unlocked(lv_obj_t *widget, widget_type_t widget_ty
   }
 }
 
+// Sparkline từ host (xem SparklineWindows trong server/read_sensor.py):
+//   "spark_<tên>: =<hex...>" cả cửa sổ (cũ -> mới), gửi sau mỗi lần wake up
+//   "spark_<tên>: +<hex>"    thêm điểm mới nhất, mỗi tick
+// Mỗi byte là giá trị đã lượng tử 0-254, 0xFF = không có dữ liệu. Host giữ lịch sử,
+// ESP32 chỉ giữ mảng điểm của lv_chart.
+#define SPARKLINE_POINTS 60
+#define SPARKLINE_NONE 0xFF
+
+typedef struct {
+  const char *name;     // Tên sau "spark_"
+  lv_obj_t **host_ptr;  // Widget để gắn chart (vẽ chồng lên, không đổi layout GUI Guider)
+  bool use_parent;      // Gắn vào container cha của widget thay vì chính widget
+  int32_t height_pct;   // Chiều cao chart theo % widget chứa (căn đáy)
+  lv_obj_t *chart;      // Tạo khi nhận dữ liệu lần đầu
+  lv_chart_series_t *series;
+} sparkline_t;
+
+static sparkline_t s_sparklines[] = {
+    {"cpu", &guider_ui.screen_bar_cpu_usage, false, 100, NULL, NULL},
+    {"ram", &guider_ui.screen_bar_ram_usage, false, 100, NULL, NULL},
+    {"gpu", &guider_ui.screen_bar_gpu_usage, false, 100, NULL, NULL},
+    {"temp_cpu", &guider_ui.screen_cont_temp_cpu, false, 35, NULL, NULL},
+    {"download", &guider_ui.screen_label_download_total, true, 35, NULL, NULL},
+    {"upload", &guider_ui.screen_label_upload_total, true, 35, NULL, NULL},
+};
+
+/**
+ * Lấy (hoặc tạo) chart của sparkline. Gọi khi đã lock LVGL.
+ * Chart được tạo lại nếu widget chứa đã bị xóa (ví dụ screen được tạo lại).
+ */
+static lv_obj_t *usb_sparkline_chart_unlocked(sparkline_t *spark) {
+  if (spark->chart != NULL && lv_obj_is_valid(spark->chart)) {
+    return spark->chart;
+  }
+  lv_obj_t *host = (spark->host_ptr != NULL) ? *spark->host_ptr : NULL;
+  if (host != NULL && spark->use_parent) {
+    host = lv_obj_get_parent(host);
+  }
+  if (host == NULL || !lv_obj_is_valid(host)) {
+    return NULL;
+  }
+
+  lv_obj_t *chart = lv_chart_create(host);
+  lv_obj_add_flag(chart, LV_OBJ_FLAG_IGNORE_LAYOUT);
+  lv_obj_remove_flag(chart, LV_OBJ_FLAG_CLICKABLE | LV_OBJ_FLAG_SCROLLABLE);
+  lv_obj_set_size(chart, lv_pct(100), lv_pct(spark->height_pct));
+  lv_obj_align(chart, LV_ALIGN_BOTTOM_MID, 0, 0);
+  // Nền trong suốt, không viền/lưới/chấm điểm: chỉ còn đường xu hướng
+  lv_obj_set_style_bg_opa(chart, LV_OPA_TRANSP, LV_PART_MAIN);
+  lv_obj_set_style_border_width(chart, 0, LV_PART_MAIN);
+  lv_obj_set_style_pad_all(chart, 0, LV_PART_MAIN);
+  lv_obj_set_style_radius(chart, 0, LV_PART_MAIN);
+  lv_obj_set_style_line_width(chart, 2, LV_PART_ITEMS);
+  lv_obj_set_style_line_opa(chart, LV_OPA_60, LV_PART_ITEMS);
+  lv_obj_set_style_size(chart, 0, 0, LV_PART_INDICATOR);
+  lv_chart_set_type(chart, LV_CHART_TYPE_LINE);
+  lv_chart_set_div_line_count(chart, 0, 0);
+  lv_chart_set_point_count(chart, SPARKLINE_POINTS);
+  lv_chart_set_range(chart, LV_CHART_AXIS_PRIMARY_Y, 0, SPARKLINE_NONE - 1);
+  lv_chart_set_update_mode(chart, LV_CHART_UPDATE_MODE_SHIFT);
+
+  spark->series = lv_chart_add_series(chart, lv_color_white(), LV_CHART_AXIS_PRIMARY_Y);
+  lv_chart_set_all_value(chart, spark->series, LV_CHART_POINT_NONE);
+  spark->chart = chart;
+  return chart;
+}
+
+/**
+ * Xử lý dòng "spark_<tên>: =<hex>" hoặc "spark_<tên>: +<hex>".
+ * @param line Dòng đã bỏ '\n' (bị sửa tại chỗ)
+ */
+static void usb_handle_sparkline(char *line) {
+  char *colon = strchr(line, ':');
+  if (colon == NULL) {
+    return;
+  }
+  *colon = '\0';
+  const char *name = line + 6; // Bỏ "spark_"
+  const char *value = colon + 1;
+  while (*value == ' ') {
+    value++;
+  }
+  char mode = *value++;
+  size_t hex_len = strlen(value);
+  if ((mode != '=' && mode != '+') || (hex_len % 2) != 0 || hex_len / 2 > SPARKLINE_POINTS) {
+    return;
+  }
+
+  sparkline_t *spark = NULL;
+  for (size_t i = 0; i < sizeof(s_sparklines) / sizeof(s_sparklines[0]); i++) {
+    if (strcmp(name, s_sparklines[i].name) == 0) {
+      spark = &s_sparklines[i];
+      break;
+    }
+  }
+  if (spark == NULL) {
+    return;
+  }
+
+  if (!lvgl_port_lock(20)) {
+    // Bỏ qua lần này; cửa sổ đầy đủ được gửi lại sau lần wake up tiếp theo
+    ESP_LOGD("usb_comm", "Không thể lock LVGL, bỏ qua sparkline %s", name);
+    return;
+  }
+  lv_obj_t *chart = usb_sparkline_chart_unlocked(spark);
+  if (chart != NULL) {
+    if (mode == '=') {
+      lv_chart_set_all_value(chart, spark->series, LV_CHART_POINT_NONE);
+    }
+    for (size_t i = 0; i < hex_len; i += 2) {
+      unsigned int point = 0;
+      if (sscanf(value + i, "%2x", &point) != 1) {
+        break;
+      }
+      lv_chart_set_next_value(chart, spark->series, point == SPARKLINE_NONE ? LV_CHART_POINT_NONE : (int32_t)point);
+    }
+  }
+  lvgl_port_unlock();
+}
+
+#ifdef CONFIG_USB_OTA_ENABLE
+// USB OTA: sau lệnh "ota_begin: <size> <sha256> <app_digest|->" host gửi frame nhị phân
+// (xem UsbOtaUploader trong server/read_sensor.py), little-endian:
+//   0xA5 0x5A | seq u32 | offset u32 | len u16 | payload[len] | crc32 u32 (seq..payload)
+// Trả lời dạng dòng text: B<offset> (bắt đầu/resume), U (đã chạy image này),
+// K<offset> (ack tích lũy), N<offset> (gửi lại từ offset), D (xong, reboot), E<code> (lỗi)
+#define USB_OTA_MAGIC0 0xA5
+#define USB_OTA_MAGIC1 0x5A
+#define USB_OTA_HEADER_SIZE 12
+#define USB_OTA_CRC_SIZE 4
+#define USB_OTA_MAX_CHUNK 4096
+// Không nhận được byte nào trong khoảng này thì quay lại chế độ dòng lệnh (giữ image dở để resume)
+#define USB_OTA_IDLE_TIMEOUT_MS 1000
+
+static bool s_ota_rx_active = false; // Đang nhận frame nhị phân (không parse dòng label)
+static uint32_t s_ota_image_size = 0;
+static uint8_t s_ota_frame[USB_OTA_HEADER_SIZE + USB_OTA_MAX_CHUNK + USB_OTA_CRC_SIZE];
+static size_t s_ota_frame_len = 0;   // Số byte đã nhận của frame hiện tại
+static size_t s_ota_frame_total = 0; // Kích thước frame (biết sau khi nhận đủ header)
+static bool s_ota_nak_sent = false;  // Đã gửi NAK cho khoảng trống hiện tại
+static TickType_t s_ota_last_rx = 0;
+
+static uint32_t usb_ota_read_u32(const uint8_t *p) {
+  return (uint32_t)p[0] | ((uint32_t)p[1] << 8) | ((uint32_t)p[2] << 16) | ((uint32_t)p[3] << 24);
+}
+
+/**
+ * Gửi một dòng trả lời USB OTA cho host.
+ */
+static void usb_ota_reply(const char *fmt, ...) {
+  char msg[32];
+  va_list args;
+  va_start(args, fmt);
+  int len = vsnprintf(msg, sizeof(msg) - 1, fmt, args);
+  va_end(args);
+  if (len <= 0 || len >= (int)sizeof(msg) - 1) {
+    return;
+  }
+  msg[len++] = '\n';
+  tud_cdc_write(msg, len);
+  tud_cdc_write_flush();
+}
+
+/**
+ * Parse chuỗi hex 64 ký tự thành 32 bytes.
+ */
+static bool usb_ota_parse_hex32(const char *hex, uint8_t out[32]) {
+  if (strlen(hex) != 64) {
+    return false;
+  }
+  for (int i = 0; i < 32; i++) {
+    unsigned int byte;
+    if (sscanf(hex + i * 2, "%2x", &byte) != 1) {
+      return false;
+    }
+    out[i] = (uint8_t)byte;
+  }
+  return true;
+}
+
+/**
+ * Xử lý lệnh "ota_begin: <size> <sha256> <app_digest|->" và chuyển sang chế độ nhận frame.
+ */
+static void usb_ota_handle_begin(const char *args) {
+  unsigned long size = 0;
+  char sha_hex[65] = {0};
+  char digest_hex[65] = {0};
+  uint8_t sha256[32];
+  uint8_t digest[32];
+
+  if (sscanf(args, "%lu %64s %64s", &size, sha_hex, digest_hex) != 3 ||
+      !usb_ota_parse_hex32(sha_hex, sha256)) {
+    usb_ota_reply("E%d", ESP_ERR_INVALID_ARG);
+    return;
+  }
+
+  // Host gửi digest của image: nếu trùng firmware đang chạy thì không cần cập nhật
+  if (usb_ota_parse_hex32(digest_hex, digest) && ota_stream_is_running_image(digest)) {
+    ESP_LOGI("usb_comm", "USB OTA: firmware đang chạy đã là bản mới nhất");
+    usb_ota_reply("U");
+    return;
+  }
+
+  uint32_t offset = 0;
+  esp_err_t ret = ota_stream_begin((uint32_t)size, sha256, &offset);
+  if (ret != ESP_OK) {
+    usb_ota_reply("E%d", ret);
+    return;
+  }
+
+  s_ota_image_size = (uint32_t)size;
+  s_ota_frame_len = 0;
+  s_ota_frame_total = 0;
+  s_ota_nak_sent = false;
+  s_ota_last_rx = xTaskGetTickCount();
+  s_ota_rx_active = true;
+  ESP_LOGI("usb_comm", "USB OTA: nhận %lu bytes, bắt đầu từ offset %lu", size, (unsigned long)offset);
+  usb_ota_reply("B%lu", (unsigned long)offset);
+}
+
+/**
+ * Xử lý một frame đã nhận đủ: kiểm tra CRC/offset, ghi flash và gửi ack.
+ */
+static void usb_ota_handle_frame(void) {
+  const uint8_t *frame = s_ota_frame;
+  uint32_t offset = usb_ota_read_u32(&frame[6]);
+  uint16_t len = (uint16_t)(frame[10] | (frame[11] << 8));
+
+  if (len == 0) {
+    // Frame rỗng: host yêu cầu thoát chế độ nhận frame (trước khi gửi lại ota_begin)
+    s_ota_rx_active = false;
+    return;
+  }
+
+  uint32_t crc = usb_ota_read_u32(&frame[USB_OTA_HEADER_SIZE + len]);
+  uint32_t calc = esp_rom_crc32_le(0, &frame[2], USB_OTA_HEADER_SIZE - 2);
+  calc = esp_rom_crc32_le(calc, &frame[USB_OTA_HEADER_SIZE], len);
+  uint32_t expected = ota_stream_written();
+
+  if (crc != calc || offset > expected) {
+    // Frame hỏng hoặc mất frame trước đó: yêu cầu gửi lại từ offset đang chờ (1 lần cho mỗi khoảng trống)
+    if (!s_ota_nak_sent) {
+      ESP_LOGW("usb_comm", "USB OTA: frame %lu lỗi (crc=%d), NAK offset %lu",
+               (unsigned long)usb_ota_read_u32(&frame[2]), crc == calc, (unsigned long)expected);
+      usb_ota_reply("N%lu", (unsigned long)expected);
+      s_ota_nak_sent = true;
+    }
+    return;
+  }
+  if (offset < expected) {
+    return; // Frame gửi lại, đã ghi rồi
+  }
+  s_ota_nak_sent = false;
+
+  esp_err_t ret = ota_stream_write(offset, &frame[USB_OTA_HEADER_SIZE], len);
+  if (ret != ESP_OK) {
+    usb_ota_reply("E%d", ret);
+    ota_stream_abort();
+    s_ota_rx_active = false;
+    return;
+  }
+  expected += len;
+  usb_ota_reply("K%lu", (unsigned long)expected);
+
+  if (expected == s_ota_image_size) {
+    s_ota_rx_active = false;
+    ret = ota_stream_finish();
+    if (ret != ESP_OK) {
+      usb_ota_reply("E%d", ret);
+      return;
+    }
+    usb_ota_reply("D");
+    ESP_LOGI("usb_comm", "USB OTA hoàn tất, reboot sang firmware mới...");
+    // Đợi host nhận 'D' trước khi reboot
+    vTaskDelay(pdMS_TO_TICKS(500));
+    esp_restart();
+  }
+}
+
+/**
+ * Đưa một byte vào bộ parse frame USB OTA (tự đồng bộ lại theo magic).
+ */
+static void usb_ota_feed(uint8_t byte) {
+  if (s_ota_frame_len == 0 && byte != USB_OTA_MAGIC0) {
+    return;
+  }
+  if (s_ota_frame_len == 1 && byte != USB_OTA_MAGIC1) {
+    s_ota_frame_len = (byte == USB_OTA_MAGIC0) ? 1 : 0;
+    return;
+  }
+  s_ota_frame[s_ota_frame_len++] = byte;
+
+  if (s_ota_frame_len == USB_OTA_HEADER_SIZE) {
+    uint16_t len = (uint16_t)(s_ota_frame[10] | (s_ota_frame[11] << 8));
+    if (len > USB_OTA_MAX_CHUNK) {
+      s_ota_frame_len = 0; // Header hỏng, tìm magic tiếp
+      return;
+    }
+    s_ota_frame_total = USB_OTA_HEADER_SIZE + len + USB_OTA_CRC_SIZE;
+  }
+  if (s_ota_frame_len < USB_OTA_HEADER_SIZE || s_ota_frame_len < s_ota_frame_total) {
+    return;
+  }
+  s_ota_frame_len = 0;
+  usb_ota_handle_frame();
+}
+
+/**
+ * Thoát chế độ nhận frame nếu host ngừng gửi (rút cáp, host restart).
+ * Image dở được giữ lại để host resume bằng ota_begin với cùng image.
+ */
+static void usb_ota_check_idle(void) {
+  if (s_ota_rx_active && (xTaskGetTickCount() - s_ota_last_rx) > pdMS_TO_TICKS(USB_OTA_IDLE_TIMEOUT_MS)) {
+    ESP_LOGW("usb_comm", "USB OTA: không có dữ liệu, dừng ở %lu/%lu bytes (có thể resume)",
+             (unsigned long)ota_stream_written(), (unsigned long)s_ota_image_size);
+    s_ota_rx_active = false;
+    s_ota_frame_len = 0;
+  }
+}
+#endif // CONFIG_USB_OTA_ENABLE
+
 /**
  * Task đọc dữ liệu từ USB CDC-ACM và cập nhật UI widgets.
  * Đọc dữ liệu theo dòng, parse format "label_name: value" và cập nhật widget
@@ -525,7 +992,7 @@ static void usb_update_widget_unlocked(lv_obj_t *widget, widget_type_t widget_ty
  */
 static void usb_reader_task(void *arg) {
   uint8_t buf[USB_CDC_BUF_SIZE];
-  char line[128]; // Tăng size để chứa label dài hơn
+  char line[192]; // Đủ chứa label dài và lệnh ota_begin (size + 2 hash hex)
   size_t line_len = 0;
 
   const size_t num_labels = s_label_map_count;
@@ -535,15 +1002,36 @@ static void usb_reader_task(void *arg) {
     size_t len = 0;
     esp_err_t ret = tinyusb_cdcacm_read(TINYUSB_CDC_ACM_0, buf, sizeof(buf), &len);
     if (ret != ESP_OK || len == 0) {
+#ifdef CONFIG_USB_OTA_ENABLE
+      if (s_ota_rx_active) {
+        // Đang nhận firmware: poll nhanh để không làm chậm đường truyền
+        usb_ota_check_idle();
+        vTaskDelay(pdMS_TO_TICKS(1));
+        continue;
+      }
+#endif
       // Delay lâu hơn để không chiếm CPU, nhường cho LVGL task
       vTaskDelay(pdMS_TO_TICKS(50));
       continue;
     }
 
-    // Thêm delay nhỏ sau khi đọc được data để tránh quá tải khi nhận nhiều data liên tiếp
-    vTaskDelay(pdMS_TO_TICKS(5));
+#ifdef CONFIG_USB_OTA_ENABLE
+    if (s_ota_rx_active) {
+      s_ota_last_rx = xTaskGetTickCount();
+    } else
+#endif
+    {
+      // Thêm delay nhỏ sau khi đọc được data để tránh quá tải khi nhận nhiều data liên tiếp
+      vTaskDelay(pdMS_TO_TICKS(5));
+    }
 
     for (int i = 0; i < len; i++) {
+#ifdef CONFIG_USB_OTA_ENABLE
+      if (s_ota_rx_active) {
+        usb_ota_feed(buf[i]);
+        continue;
+      }
+#endif
       char c = (char)buf[i];
       if (c == '\r' || c == '\0') {
         continue;
@@ -555,6 +1043,32 @@ static void usb_reader_task(void *arg) {
         line[line_len] = '\0';
         line_len = 0;
 
+        // Thông báo firmware mới từ host (read_sensor.py theo dõi file .bin)
+        if (strncmp(line, "firmware_available:", 19) == 0) {
+          usb_handle_firmware_notice(line + 19);
+          continue;
+        }
+
+        // Tuổi snapshot host vừa gửi (> 0 = snapshot cũ sau restart/reconnect)
+        if (strncmp(line, "snapshot_stale:", 15) == 0) {
+          usb_handle_snapshot_stale(line + 15);
+          continue;
+        }
+
+        // Dữ liệu biểu đồ xu hướng (sparkline) từ host
+        if (strncmp(line, "spark_", 6) == 0) {
+          usb_handle_sparkline(line);
+          continue;
+        }
+
+#ifdef CONFIG_USB_OTA_ENABLE
+        // Lệnh cập nhật firmware qua USB (read_sensor.py --usb-ota)
+        if (strncmp(line, "ota_begin:", 10) == 0) {
+          usb_ota_handle_begin(line + 10);
+          continue;
+        }
+#endif
+
         // Parse format: "label_name: value"
         // Ví dụ: "label_storage_1: 26%" hoặc "bar_cpu_usage: 3"
         char *colon = strchr(line, ':');
@@ -660,15 +1174,11 @@ static void usb_reader_task(void *arg) {
                 // Đặc biệt: Xử lý upgradeAvailable label - format text và đổi màu
                 else if (strcmp(label_name, "label_upgrade_available") == 0) {
 
-                  // Parse giá trị upgradeAvailable (1-5)
-                  int upgrade_value = 0;
-
-                  if (sscanf(value_str, "%d", &upgrade_value) == 1) {
-                    usb_set_upgrade_label_text_and_color(widget, upgrade_value);
-                  } else {
-                    // Nếu không parse được, hiển thị trực tiếp text
-                    usb_update_widget_unlocked(widget, WIDGET_TYPE_LABEL, value_str);
-                  }
+                  // Lưu giá trị upgradeAvailable (1-5) của DSM; thông báo firmware mới
+                  // từ host (nếu có) được ưu tiên hiển thị
+                  strncpy(s_dsm_upgrade_text, value_str, sizeof(s_dsm_upgrade_text) - 1);
+                  s_dsm_upgrade_text[sizeof(s_dsm_upgrade_text) - 1] = '\0';
+                  usb_render_upgrade_label_unlocked(widget);
                 }
                 // Update widget với text/value (cho các label thông thường)
                 else {
@@ -931,6 +1441,8 @@ static void usb_screen_switch_task(void *arg) {
           // Screen đã được setup trong setup_ui() rồi, chỉ cần load
           // Chuyển từ screen_loading sang screen
           lv_screen_load(guider_ui.screen);
+          // Snapshot cũ có thể đã tới trước khi screen được tạo
+          usb_apply_stale_style_unlocked();
           lvgl_port_unlock();
 
           ESP_LOGI("usb_comm", "Task screen switch: Đã chuyển sang screen thành công");
@@ -1047,7 +1559,12 @@ void usb_comm_start(void) {
   }
 
   // Priority thấp hơn LVGL task (4) để không block render
+  // Stack lớn hơn khi bật USB OTA (esp_ota_write, kiểm tra SHA-256 partition)
+#ifdef CONFIG_USB_OTA_ENABLE
+  xTaskCreate(usb_reader_task, "usb_comm_cdc", 6144, NULL, 3, NULL);
+#else
   xTaskCreate(usb_reader_task, "usb_comm_cdc", 4096, NULL, 3, NULL);
+#endif
 
   // Task screen switch với priority giống reader
   xTaskCreate(usb_screen_switch_task, "usb_comm_screen", 2048, NULL, 3, NULL);
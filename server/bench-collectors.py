@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+Benchmark pipeline thu thập metrics trong read_sensor.py, không cần phần cứng.
+
+Tạo cây /proc, /sys, /dev giả trong thư mục tạm và các lệnh giả (synodisk, nvme,
+nvidia-smi, snmpwalk, iostat, ping, ethtool, ip) in output cố định sau một độ trễ cố
+định, rồi chạy từng hàm read_*, từng collector và toàn bộ aggregate_metrics.
+
+Với mỗi hàm báo cáo:
+  - wall time p50/p99
+  - CPU time p50 (gồm cả process con)
+  - số syscall read/write (/proc/self/io)
+  - số lệnh ngoài được chạy
+  - bộ nhớ cấp phát đỉnh (tracemalloc, đo ở lượt riêng để không ảnh hưởng thời gian)
+
+Có thể lưu kết quả thành baseline JSON và so sánh giữa các phiên bản.
+
+CÁCH SỬ DỤNG:
+
+python3 bench-collectors.py
+python3 bench-collectors.py --iterations 20 --save-baseline bench-baseline.json
+# So sánh với baseline, exit 1 nếu có hàm chậm hơn quá 20%
+python3 bench-collectors.py --baseline bench-baseline.json
+# Lệnh giả trả về ngay (chỉ đo phần Python), chỉ chạy các hàm khớp regex
+python3 bench-collectors.py --latency-scale 0 --only "cpu|ram"
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+import read_sensor  # noqa: E402
+
+# Lệnh giả: tên -> (độ trễ giây, output) hoặc (độ trễ, {mẫu trong argv: output})
+STUB_COMMANDS = {
+    "synodisk": (0.15, "".join(
+        f">> Disk id: {disk}\n>> Slot id: {disk}\n>> Tempeture: {34 + disk} C\n" for disk in range(1, 5)
+    )),
+    "nvme": (0.03, "Smart Log for NVME device:nvme0 namespace-id:ffffffff\n"
+                   "critical_warning                        : 0\n"
+                   "temperature                             : 41 C\n"
+                   "available_spare                         : 100%\n"),
+    "nvidia-smi": (0.08, {
+        "clocks.current.graphics": "1350\n",
+        "utilization.gpu,fan.speed": "23, 41\n",
+        "temperature.gpu": "58\n",
+    }),
+    "snmpwalk": (0.05, {
+        "6574.3.1.1": "".join(
+            f'.1.3.6.1.4.1.6574.3.1.1.2.{i} = STRING: "Volume {i}"\n'
+            f".1.3.6.1.4.1.6574.3.1.1.4.{i} = Counter64: {i * 700 * 1024 ** 3}\n"
+            f".1.3.6.1.4.1.6574.3.1.1.5.{i} = Counter64: {3725 * 1024 ** 3}\n"
+            for i in range(1, 4)
+        ),
+        "6574.2.1.1.13": "".join(
+            f".1.3.6.1.4.1.6574.2.1.1.13.{i} = INTEGER: 1\n" for i in range(0, 8)
+        ),
+        "6574.1": (
+            ".1.3.6.1.4.1.6574.1.1.0 = INTEGER: 1\n"
+            ".1.3.6.1.4.1.6574.1.3.0 = INTEGER: 1\n"
+            ".1.3.6.1.4.1.6574.1.4.1.0 = INTEGER: 1\n"
+            ".1.3.6.1.4.1.6574.1.5.3.0 = STRING: \"DSM 7.2.1-69057 Update 5\"\n"
+            ".1.3.6.1.4.1.6574.1.5.4.0 = INTEGER: 2\n"
+            ".1.3.6.1.4.1.6574.1.5.7.0 = INTEGER: 1\n"
+        ),
+    }),
+    "iostat": (0.02, "Linux 4.4.302+ (nas) \t01/01/2025 \t_x86_64_\t(4 CPU)\n\n"
+                     "Device             tps    kB_read/s    kB_wrtn/s    kB_dscd/s\n"
+                     "sata1            12.00       512.00       256.00         0.00\n"
+                     "sata2             8.00       128.00      1024.00         0.00\n"
+                     "nvme0n1         120.00      2048.00      4096.00         0.00\n"),
+    "ping": (0.02, "PING google.com (142.250.66.14) 56(84) bytes of data.\n"
+                   "64 bytes from 142.250.66.14: icmp_seq=1 ttl=117 time=12.3 ms\n"),
+    "ethtool": (0.01, "Settings for eth0:\n\tSpeed: 1000Mb/s\n\tDuplex: Full\n\tLink detected: yes\n"),
+    "ip": (0.005, "2: ovs_eth0: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500 qdisc noqueue state UNKNOWN\n"
+                  "    inet 192.168.1.14/24 brd 192.168.1.255 scope global ovs_eth0\n"),
+}
+
+# Cây /proc, /sys, /dev giả (đường dẫn tương đối -> nội dung)
+FIXTURE_FILES = {
+    "proc/cpuinfo": "".join(f"processor\t: {cpu}\ncpu MHz\t\t: 3400.000\n\n" for cpu in range(4)),
+    "proc/stat": "cpu  10132153 290696 3084719 46828483 16683 0 25195 0 0 0\n",
+    "proc/meminfo": "MemTotal:       16318568 kB\nMemFree:         1245064 kB\nMemAvailable:    9345012 kB\n",
+    "sys/class/hwmon/hwmon0/name": "nct6775\n",
+    "sys/class/hwmon/hwmon0/fan1_input": "1200\n",
+    "sys/class/hwmon/hwmon0/fan2_input": "900\n",
+    "sys/class/hwmon/hwmon0/fan3_input": "0\n",
+    "sys/class/hwmon/hwmon0/temp1_input": "45000\n",
+    "sys/class/hwmon/hwmon0/temp1_label": "SYSTIN\n",
+    "sys/class/hwmon/hwmon0/temp2_input": "52000\n",
+    "sys/class/hwmon/hwmon0/temp2_label": "CPUTIN\n",
+    "sys/class/hwmon/hwmon0/temp3_input": "38000\n",
+    "sys/class/hwmon/hwmon0/temp3_label": "AUXTIN0\n",
+    "sys/class/hwmon/hwmon0/temp4_input": "41000\n",
+    "sys/class/hwmon/hwmon0/temp4_label": "SMBUSMASTER 0\n",
+    "sys/class/hwmon/hwmon1/name": "k10temp\n",
+    "sys/class/hwmon/hwmon1/temp1_input": "55000\n",
+    "sys/class/hwmon/hwmon1/temp1_label": "Tctl\n",
+    "sys/class/drm/card0/gt_cur_freq_mhz": "350\n",
+    "sys/class/drm/card0/device/temp1_input": "48000\n",
+    "sys/devices/pci0000:00/0000:00:1f.6/net/eth0/speed": "1000\n",
+    "sys/devices/pci0000:00/0000:00:1f.6/net/eth0/statistics/rx_bytes": "982734012\n",
+    "sys/devices/pci0000:00/0000:00:1f.6/net/eth0/statistics/tx_bytes": "117342001\n",
+    "sys/devices/virtual/net/ovs_eth0/statistics/rx_bytes": "982734012\n",
+    "sys/devices/virtual/net/ovs_eth0/statistics/tx_bytes": "117342001\n",
+    "sys/devices/virtual/net/lo/statistics/rx_bytes": "0\n",
+    "sys/devices/virtual/net/lo/statistics/tx_bytes": "0\n",
+    "dev/nvme0": "",
+    "dev/nvme1": "",
+}
+# Giống sysfs thật: /sys/class/net/<iface> là symlink tới thiết bị (virtual hoặc PCI)
+FIXTURE_LINKS = {
+    "sys/class/net/eth0": "../../devices/pci0000:00/0000:00:1f.6/net/eth0",
+    "sys/class/net/ovs_eth0": "../../devices/virtual/net/ovs_eth0",
+    "sys/class/net/lo": "../../devices/virtual/net/lo",
+}
+
+# So sánh với baseline: (key, ngưỡng tuyệt đối tối thiểu để tính là regression)
+BASELINE_KEYS = (
+    ("wall_p50_ms", 1.0),
+    ("wall_p99_ms", 2.0),
+    ("cpu_p50_ms", 1.0),
+    ("syscalls", 5),
+    ("execs", 0),
+    ("alloc_peak_kb", 16.0),
+)
+
+
+def percentile(values, pct):
+    """Tính percentile (nearest-rank) của danh sách giá trị."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[idx]
+
+
+def build_fixture(root, latency_scale):
+    """Tạo cây file giả và thư mục bin chứa lệnh giả."""
+    for rel_path, content in FIXTURE_FILES.items():
+        path = root / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content, encoding="utf-8")
+    for rel_path, target in FIXTURE_LINKS.items():
+        path = root / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.symlink_to(target)
+
+    bin_dir = root / "bin"
+    bin_dir.mkdir()
+    for name, (latency, output) in STUB_COMMANDS.items():
+        lines = ["#!/bin/sh"]
+        if latency * latency_scale > 0:
+            lines.append(f"sleep {latency * latency_scale:.3f}")
+        cases = output if isinstance(output, dict) else {"": output}
+        lines.append('case "$*" in')
+        for pattern, text in cases.items():
+            lines.append(f"  *{pattern}*) cat <<'EOF'\n{text}EOF\n  ;;")
+        lines.append("esac")
+        script = bin_dir / name
+        script.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        script.chmod(0o755)
+    return bin_dir
+
+
+class FixturePaths:
+    """Trỏ /proc, /sys, /dev của read_sensor sang cây giả trong lúc benchmark."""
+
+    def __init__(self, root):
+        self.root = root
+        self.saved_roots = dict(read_sensor.HOST_ROOTS)
+
+    def __enter__(self):
+        read_sensor.configure_host_roots(host_root=str(self.root))
+        return self
+
+    def __exit__(self, *exc_info):
+        read_sensor.HOST_ROOTS.update(self.saved_roots)
+
+
+class ExecCounter:
+    """Đếm số lần subprocess.run được gọi (mỗi lần là một process con)."""
+
+    def __init__(self):
+        self.count = 0
+        self.real_run = subprocess.run
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+        return self.real_run(*args, **kwargs)
+
+    def __enter__(self):
+        subprocess.run = self
+        return self
+
+    def __exit__(self, *exc_info):
+        subprocess.run = self.real_run
+
+
+def read_syscall_count():
+    """Số syscall read + write của process (Linux), None nếu không đọc được."""
+    try:
+        with open("/proc/self/io", "rb") as io_file:
+            fields = dict(line.split(b":") for line in io_file.read().splitlines())
+        return int(fields[b"syscr"]) + int(fields[b"syscw"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def cpu_seconds():
+    """CPU time (user + system) của process và các process con đã kết thúc."""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def measure(func, execs, syscall_overhead):
+    """Chạy func một lần, trả về (wall s, cpu s, syscalls, execs)."""
+    sys0, exec0, cpu0 = read_syscall_count(), execs.count, cpu_seconds()
+    start = time.perf_counter()
+    func()
+    wall = time.perf_counter() - start
+    cpu = cpu_seconds() - cpu0
+    sys1 = read_syscall_count()
+    syscalls = None if sys0 is None or sys1 is None else max(0, sys1 - sys0 - syscall_overhead)
+    return wall, cpu, syscalls, execs.count - exec0
+
+
+def measure_allocations(func):
+    """Bộ nhớ cấp phát đỉnh (KB) trong một lần chạy func."""
+    gc.collect()
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    return max(0, peak - before) / 1024.0
+
+
+def bench_targets():
+    """Các hàm cần benchmark: mọi read_*, các collector không phải read_*, và aggregate_metrics."""
+    targets = [
+        (name, getattr(read_sensor, name))
+        for name in sorted(vars(read_sensor))
+        if name.startswith("read_") and callable(getattr(read_sensor, name))
+    ]
+    names = {func for _, func in targets}
+    targets += [(f"collector:{name}", func) for name, func in read_sensor.COLLECTORS if func not in names]
+    targets.append(("aggregate_metrics", read_sensor.aggregate_metrics))
+    return targets
+
+
+def run_benchmark(targets, iterations):
+    """Chạy benchmark, trả về dict kết quả theo tên hàm."""
+    results = {}
+    with ExecCounter() as execs:
+        overhead = measure(lambda: None, execs, 0)[2] or 0
+        for name, func in targets:
+            func()  # Warm-up: regex compile, import lười, cache của collector
+            samples = [measure(func, execs, overhead) for _ in range(iterations)]
+            walls = [sample[0] for sample in samples]
+            cpus = [sample[1] for sample in samples]
+            syscalls = [sample[2] for sample in samples if sample[2] is not None]
+            results[name] = {
+                "wall_p50_ms": percentile(walls, 50) * 1000,
+                "wall_p99_ms": percentile(walls, 99) * 1000,
+                "cpu_p50_ms": percentile(cpus, 50) * 1000,
+                "syscalls": int(percentile(syscalls, 50)) if syscalls else None,
+                "execs": samples[-1][3],
+            }
+            print(".", end="", flush=True)
+
+    tracemalloc.start()
+    try:
+        for name, func in targets:
+            results[name]["alloc_peak_kb"] = measure_allocations(func)
+    finally:
+        tracemalloc.stop()
+    print()
+    return results
+
+
+def print_results(results):
+    header = f"{'Hàm':<28} {'p50 ms':>9} {'p99 ms':>9} {'CPU ms':>8} {'syscall':>8} {'exec':>5} {'alloc KB':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, row in results.items():
+        syscalls = "-" if row["syscalls"] is None else str(row["syscalls"])
+        print(
+            f"{name:<28} {row['wall_p50_ms']:>9.2f} {row['wall_p99_ms']:>9.2f} {row['cpu_p50_ms']:>8.2f} "
+            f"{syscalls:>8} {row['execs']:>5} {row['alloc_peak_kb']:>9.1f}"
+        )
+
+
+def compare_baseline(results, baseline, threshold):
+    """In các regression so với baseline, trả về số regression."""
+    regressions = 0
+    for name, row in results.items():
+        old = baseline.get("results", {}).get(name)
+        if old is None:
+            print(f"ℹ️ {name}: không có trong baseline")
+            continue
+        for key, floor in BASELINE_KEYS:
+            new_value, old_value = row.get(key), old.get(key)
+            if new_value is None or old_value is None:
+                continue
+            if new_value > old_value * (1 + threshold) and new_value - old_value > floor:
+                regressions += 1
+                print(f"✗ {name}: {key} {old_value:.2f} -> {new_value:.2f}")
+    if not regressions:
+        print(f"✓ Không có regression so với baseline (ngưỡng {threshold:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pipeline thu thập metrics với /proc, /sys và lệnh giả")
+    parser.add_argument("--iterations", type=int, default=10, help="Số lần chạy mỗi hàm (default: 10)")
+    parser.add_argument("--latency-scale", type=float, default=1.0,
+                        help="Nhân độ trễ của lệnh giả (default: 1.0, 0 = trả về ngay)")
+    parser.add_argument("--only", default=None, help="Chỉ chạy các hàm có tên khớp regex này")
+    parser.add_argument("--save-baseline", metavar="FILE", default=None, help="Lưu kết quả thành baseline JSON")
+    parser.add_argument("--baseline", metavar="FILE", default=None, help="So sánh với baseline JSON")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Tỉ lệ chậm hơn baseline được tính là regression (default: 0.2)")
+    args = parser.parse_args()
+
+    targets = bench_targets()
+    if args.only:
+        targets = [(name, func) for name, func in targets if re.search(args.only, name)]
+
+    root = Path(tempfile.mkdtemp(prefix="bench-collectors-"))
+    saved_env = {key: os.environ.get(key) for key in ("PATH", "USER")}
+    try:
+        bin_dir = build_fixture(root, args.latency_scale)
+        os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+        os.environ["USER"] = "admin"
+        print(f"Fixture: {root}, {len(targets)} hàm x {args.iterations} lần, latency x{args.latency_scale:g}")
+        with FixturePaths(root):
+            results = run_benchmark(targets, max(1, args.iterations))
+    finally:
+        for key, value in saved_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shutil.rmtree(root, ignore_errors=True)
+
+    print_results(results)
+
+    report = {
+        "version": read_sensor.get_version(),
+        "python": platform.python_version(),
+        "iterations": args.iterations,
+        "latency_scale": args.latency_scale,
+        "results": results,
+    }
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps(report, indent=2) + "\n", encoding="utf-8")
+        print(f"✓ Đã lưu baseline vào {args.save_baseline}")
+
+    regressions = 0
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        print(f"So sánh với baseline {args.baseline} (version {baseline.get('version')})")
+        regressions = compare_baseline(results, baseline, args.threshold)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Benchmark tải đồng thời cho OTA HTTP server trong read_sensor.py.
+
+Chạy nhiều client tải firmware song song (HTTP/1.1 keep-alive), đồng thời đo độ trễ
+của /health để kiểm tra việc tải firmware chậm không block các endpoint khác.
+Cũng kiểm tra nhanh Range (resume OTA), ETag/If-None-Match và HEAD.
+
+CÁCH SỬ DỤNG:
+
+# Tự start OTA server trên port ngẫu nhiên với firmware giả 2 MB
+python3 bench-ota-server.py
+
+# 16 client, mỗi client tải 10 lần, firmware 4 MB
+python3 bench-ota-server.py --clients 16 --requests 10 --size-mb 4
+
+# Benchmark server đang chạy sẵn (ví dụ trên NAS)
+python3 bench-ota-server.py --url http://192.168.1.14:8888
+"""
+
+import argparse
+import http.client
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from threading import Event, Thread
+from urllib.parse import urlparse
+
+sys.path.insert(0, str(Path(__file__).parent))
+import read_sensor  # noqa: E402
+
+
+def percentile(values, pct):
+    """Tính percentile (nearest-rank) của danh sách giá trị."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[idx]
+
+
+def download_worker(host, port, requests, results, errors):
+    """Tải firmware nhiều lần trên cùng một connection keep-alive."""
+    conn = http.client.HTTPConnection(host, port, timeout=60)
+    try:
+        for _ in range(requests):
+            start = time.perf_counter()
+            conn.request("GET", "/firmware.bin")
+            resp = conn.getresponse()
+            body = resp.read()
+            elapsed = time.perf_counter() - start
+            if resp.status != 200:
+                errors.append(f"HTTP {resp.status}")
+                continue
+            results.append((elapsed, len(body)))
+    except Exception as exc:
+        errors.append(str(exc))
+    finally:
+        conn.close()
+
+
+def health_probe(host, port, stop_event, latencies, errors):
+    """Gọi /health liên tục trong lúc các client đang tải firmware."""
+    conn = http.client.HTTPConnection(host, port, timeout=10)
+    try:
+        while not stop_event.is_set():
+            start = time.perf_counter()
+            conn.request("GET", "/health")
+            resp = conn.getresponse()
+            resp.read()
+            latencies.append(time.perf_counter() - start)
+            time.sleep(0.02)
+    except Exception as exc:
+        errors.append(f"health: {exc}")
+    finally:
+        conn.close()
+
+
+def check_protocol(host, port, expected):
+    """Kiểm tra HEAD, Range và If-None-Match. Trả về danh sách lỗi."""
+    problems = []
+    conn = http.client.HTTPConnection(host, port, timeout=10)
+    try:
+        conn.request("HEAD", "/firmware.bin")
+        resp = conn.getresponse()
+        resp.read()
+        etag = resp.getheader("ETag")
+        if resp.status != 200 or resp.getheader("Accept-Ranges") != "bytes" or not etag:
+            problems.append(f"HEAD: status={resp.status}, headers={resp.getheaders()}")
+        size = int(resp.getheader("Content-Length", "0"))
+
+        if expected is not None and size != len(expected):
+            problems.append(f"HEAD: Content-Length {size} != {len(expected)}")
+
+        # Resume từ giữa file
+        offset = size // 3
+        conn.request("GET", "/firmware.bin", headers={"Range": f"bytes={offset}-", "If-Range": etag or ""})
+        resp = conn.getresponse()
+        body = resp.read()
+        if resp.status != 206 or len(body) != size - offset:
+            problems.append(f"Range: status={resp.status}, len={len(body)}")
+        elif expected is not None and body != expected[offset:]:
+            problems.append("Range: nội dung không khớp")
+
+        conn.request("GET", "/firmware.bin", headers={"Range": f"bytes={size + 10}-"})
+        resp = conn.getresponse()
+        resp.read()
+        if resp.status != 416:
+            problems.append(f"Range ngoài file: status={resp.status} (mong đợi 416)")
+
+        conn.request("GET", "/firmware.bin", headers={"If-None-Match": etag or ""})
+        resp = conn.getresponse()
+        resp.read()
+        if resp.status != 304:
+            problems.append(f"If-None-Match: status={resp.status} (mong đợi 304)")
+    except Exception as exc:
+        problems.append(str(exc))
+    finally:
+        conn.close()
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tải đồng thời cho OTA HTTP server")
+    parser.add_argument("--url", default=None, help="URL server có sẵn (mặc định: tự start server local)")
+    parser.add_argument("--clients", type=int, default=8, help="Số client tải song song (default: 8)")
+    parser.add_argument("--requests", type=int, default=5, help="Số lần tải mỗi client (default: 5)")
+    parser.add_argument("--size-mb", type=float, default=2.0, help="Kích thước firmware giả (MB, default: 2)")
+    args = parser.parse_args()
+
+    expected = None
+    tmp_dir = None
+    if args.url:
+        parsed = urlparse(args.url)
+        host, port = parsed.hostname, parsed.port or 80
+    else:
+        tmp_dir = tempfile.TemporaryDirectory()
+        firmware_path = Path(tmp_dir.name) / read_sensor.FIRMWARE_FILENAME
+        expected = os.urandom(int(args.size_mb * 1024 * 1024))
+        firmware_path.write_bytes(expected)
+        server = read_sensor.OTAHTTPServer(("127.0.0.1", 0), firmware_path)
+        host, port = server.server_address
+        Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Đã start OTA server tại http://{host}:{port} (firmware {len(expected)} bytes)")
+
+    problems = check_protocol(host, port, expected)
+    for problem in problems:
+        print(f"✗ {problem}")
+    if not problems:
+        print("✓ HEAD, Range, If-Range, 416 và If-None-Match hoạt động đúng")
+
+    results, errors, health_latencies = [], [], []
+    stop_event = Event()
+    probe = Thread(target=health_probe, args=(host, port, stop_event, health_latencies, errors))
+    probe.start()
+
+    workers = [
+        Thread(target=download_worker, args=(host, port, args.requests, results, errors))
+        for _ in range(args.clients)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    wall = time.perf_counter() - start
+    stop_event.set()
+    probe.join()
+
+    total_bytes = sum(size for _, size in results)
+    download_times = [elapsed for elapsed, _ in results]
+    print()
+    print(f"Client: {args.clients} x {args.requests} lần tải, thời gian: {wall:.2f}s")
+    print(f"Tải thành công: {len(results)}, lỗi: {len(errors)}")
+    print(f"Throughput: {total_bytes / wall / (1024 * 1024):.1f} MB/s")
+    print(
+        f"Thời gian tải firmware: p50 {percentile(download_times, 50) * 1000:.1f} ms, "
+        f"p99 {percentile(download_times, 99) * 1000:.1f} ms"
+    )
+    print(
+        f"/health trong lúc tải ({len(health_latencies)} request): "
+        f"p50 {percentile(health_latencies, 50) * 1000:.2f} ms, "
+        f"p99 {percentile(health_latencies, 99) * 1000:.2f} ms, "
+        f"max {max(health_latencies or [0]) * 1000:.2f} ms"
+    )
+    for error in errors[:5]:
+        print(f"✗ {error}")
+
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+    sys.exit(1 if problems or errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -39,17 +39,42 @@ CÁCH SỬ DỤNG:
 8. Thay đổi port OTA server:
    python3 read_sensor.py --ota-port 9000
 
+9. Nhiều màn hình (một lần đọc sensor, gửi tới tất cả màn hình):
+   python3 read_sensor.py --serial-device /dev/ttyACM0 --serial-device /dev/ttyACM1
+   python3 read_sensor.py --usb-serial 7C:DF:A1:00:11:22 --usb-serial 7C:DF:A1:00:33:44
+
+10. Hiển thị metrics của máy khác (agent -> hub):
+   # Trên máy có màn hình (hub), nhận agent ở port 9777
+   python3 read_sensor.py --hub-port 9777
+   # Trên máy khác (agent), stream snapshot về hub
+   python3 read_sensor.py --agent 192.168.1.14:9777
+
+11. Cập nhật firmware qua cáp USB (không cần Wi-Fi):
+   python3 read_sensor.py --usb-ota
+
 ARGUMENTS:
 
 --output PATH
     File output để ghi dữ liệu sensor (default: sensors.txt)
     Ví dụ: --output /tmp/sensors.txt
+    File được ghi nguyên tử (file tạm + rename) và chỉ khi nội dung thay đổi.
+    Dùng --output /dev/shm/sensors.txt để không ghi vào volume (HDD được ngủ).
+
+--output-fsync SECONDS
+    fsync file output tối đa mỗi N giây (default: 0 = không fsync)
+    Ví dụ: --output-fsync 300
 
 --serial-device PATH
     Thiết bị serial để gửi dữ liệu tới ESP32 (ví dụ: /dev/ttyACM0)
-    Nếu không chỉ định, script sẽ tự động tìm ESP32 USB device
+    Nếu không chỉ định, script sẽ tự động tìm tất cả ESP32 USB device
+    Có thể lặp lại để gửi tới nhiều màn hình
     Ví dụ: --serial-device /dev/ttyACM0
 
+--usb-serial SERIAL
+    Chỉ quản lý ESP32 có USB serial number này (match cùng vendor/model ID)
+    Có thể lặp lại để chọn nhiều màn hình
+    Ví dụ: --usb-serial 7C:DF:A1:00:11:22
+
 --vendor-id HEX
     Vendor ID để tìm USB device (hex, default: 303a)
     Chỉ áp dụng khi không chỉ định --serial-device
@@ -65,6 +90,27 @@ ARGUMENTS:
     Chỉ áp dụng khi có --serial-device hoặc tự động tìm được USB device
     Ví dụ: --interval 1.0  # Gửi mỗi 1 giây
 
+--adaptive-interval
+    Chu kỳ thích ứng thay cho --interval cố định: về --interval-min ngay sau wake-up hoặc
+    khi số liệu biến động (CPU ±5%, nhiệt độ ±2°C, mạng ±1 Mbps hoặc ±20%...), gấp đôi
+    mỗi tick số liệu đứng yên, tối đa --interval-max. Khi mọi màn hình tắt, script block
+    trên serial fd và chỉ thức dậy khi ESP32 gửi dữ liệu (W), quét màn hình mới mỗi 30s.
+
+--interval-min SECONDS / --interval-max SECONDS
+    Giới hạn chu kỳ của --adaptive-interval (default: 1.0 / 30.0)
+
+--warm-interval SECONDS
+    Khi mọi màn hình tắt, background thread vẫn đọc metrics mỗi N giây (default: 60, 0 = tắt)
+    để lúc ESP32 gửi 'W' có thể gửi ngay storage + dynamic data từ cache trong cùng tick.
+    Collector đọc SMART (nhiệt độ/trạng thái ổ) chỉ chạy nếu ổ có I/O kể từ lần trước,
+    để không đánh thức ổ đang standby.
+
+--state-file PATH / --state-interval SECONDS
+    Lưu snapshot cuối cùng (kèm thời điểm chạy từng collector) vào file JSON nhỏ
+    (default: /dev/shm/read_sensor_state.json, ghi tối đa mỗi 10s khi thay đổi, 0 = tắt).
+    Sau restart hoặc khi màn hình kết nối lại, snapshot này được gửi ngay (đánh dấu
+    "snapshot_stale: <tuổi>", ESP32 hiển thị mờ) rồi được thay bằng số liệu live.
+
 --file-interval SECONDS
     Khoảng thời gian (giây) giữa các lần ghi file (default: None = ghi mỗi lần gửi serial)
     Nếu set, sẽ ghi file ít thường xuyên hơn so với gửi serial
@@ -85,8 +131,118 @@ ARGUMENTS:
 --ota-port PORT
     Port cho OTA HTTP server (default: 8888). Set 0 để tắt OTA server.
     OTA server serve firmware file tại http://localhost:PORT/firmware.bin
+    Prometheus metrics (snapshot mới nhất, không thu thập lại) tại http://localhost:PORT/metrics
+    JSON snapshot tại http://localhost:PORT/api/snapshot (ETag/304, gzip)
+    Server-Sent Events (full snapshot rồi delta mỗi tick) tại http://localhost:PORT/api/stream
+    Lịch sử min/max/mean (1s/1 giờ, 1 phút/24 giờ, 15 phút/30 ngày) tại http://localhost:PORT/api/history
+    Self-metrics (histogram độ trễ, bộ đếm, RSS/CPU của daemon) tại http://localhost:PORT/api/self
     Ví dụ: --ota-port 8888 hoặc --ota-port 0 (tắt)
 
+--usb-ota
+    Gửi JonsboN4Monitor.bin tới từng màn hình qua USB CDC khi kết nối
+    (frame có sequence number + CRC32, ack theo cửa sổ, resume khi mất kết nối)
+    ESP32 trả lời ngay nếu đã chạy đúng image này, nên có thể bật thường xuyên
+
+--history-file PATH
+    File lịch sử metrics (default: history.bin cạnh script). Ring file cố định dung lượng,
+    lưu bucket 1 phút (min/max/mean) đã nén, nên restart hay reboot DSM không mất lịch sử.
+    Ví dụ: --history-file /volume1/homes/admin/history.bin
+    File trên tmpfs (--history-file /dev/shm/history.bin) không bao giờ ghi volume nhưng
+    mất khi reboot và chiếm RAM bằng --history-size-mb.
+
+--history-size-mb MB
+    Dung lượng file lịch sử (default: 16, khoảng vài tuần cho toàn bộ metrics). Set 0 để tắt.
+
+--history-flush SECONDS
+    Khoảng thời gian giữa các lần ghi lịch sử xuống disk (default: 300). Giữa hai lần flush
+    không có lần ghi nào; khi ổ không có I/O nào khác, flush được hoãn (tối đa 24 giờ)
+    để không đánh thức ổ đang ngủ.
+
+--budget-cpu PERCENT / --budget-tick-ms MS
+    Budget của daemon (default: 0 = không giới hạn), ví dụ --budget-cpu 2 --budget-tick-ms 500.
+    CPU tính theo % của một core (kể cả synodisk/snmpwalk...), trung bình cả thời gian sleep;
+    thời gian tick không tính 1 giây lấy mẫu tốc độ mạng. Vượt budget 3 tick liên tiếp thì
+    collector đắt nhất bị giãn chu kỳ gấp đôi (tối đa 16 tick, dùng lại giá trị cũ) hoặc bị
+    bỏ nếu là ping/GPU; dưới 70% budget 10 tick liên tiếp thì hoàn lại từng bước.
+    Trạng thái tại /api/self ("budget") và /metrics (jonsbo_budget_level, jonsbo_collector_stride).
+
+--tick-deadline SECONDS
+    Thời gian tối đa mỗi tick chờ collector (default: 3.0, 0 = chờ hết như trước).
+    Collector chưa xong được chạy tiếp ở background: tick dùng giá trị lần trước, đánh dấu
+    stale trong /api/snapshot ("stale", "age") và /metrics (jonsbo_collector_stale), rồi gộp
+    kết quả về muộn vào tick sau, nên màn hình luôn được cập nhật đúng chu kỳ.
+
+--worker-collectors LIST / --worker-timeout SECONDS / --worker-max-calls N
+    Collector gọi lệnh ngoài (default: collector khai báo isolate, built-in là
+    storage,disk_temps,disk_status,disk_io,network) chạy
+    trong 2 worker process sống lâu, kết quả trả về qua pipe. Mỗi lần gọi có timeout (default: 30s),
+    quá timeout thì worker bị kill và thay mới, nên syscall kẹt (ổ hỏng, snmpd treo) không làm
+    treo daemon hay serial. Worker được thay sau N lần gọi (default: 500). "none" = chạy trong daemon.
+
+--plugin-dir PATH
+    Thư mục collector plugin (default: collectors.d cạnh script, env N4_PLUGIN_DIR). Mỗi file .py
+    có hàm register(registry) gọi registry.add(name, function, labels=..., cost=..., cadence=...,
+    depends=..., isolate=...) để thêm sensor mà không sửa read_sensor.py.
+
+Capability probe / circuit breaker (luôn bật)
+    Lúc khởi động kiểm tra lệnh ngoài (nvidia-smi, nvme, synodisk, snmpwalk, ethtool...) và
+    đường dẫn /sys, /proc có trên máy; lệnh không có thì không bao giờ fork (tìm lại mỗi 10 phút).
+    Lệnh (theo subtree SNMP, từng ổ NVMe/interface) hoặc collector lỗi 3 lần liên tiếp bị tạm
+    ngừng 30s, rồi thử lại một lần (half-open); lỗi tiếp thì thời gian chờ gấp đôi, tối đa 10 phút.
+    Collector bị tạm ngừng dùng lại giá trị cũ, đánh dấu stale như khi trễ deadline.
+    Trạng thái tại /api/self ("capabilities", "breakers") và /metrics (jonsbo_breaker_state).
+
+--stats-log SECONDS
+    In một dòng self-metrics mỗi N giây (default: 0 = tắt): RSS, CPU%, byte/frame đã ghi serial,
+    số reconnect/timeout và 3 lệnh/collector chậm nhất theo p99.
+    Histogram độ trễ (collector, subprocess, ghi serial, HTTP) luôn được ghi, xem tại
+    http://localhost:PORT/api/self hoặc /metrics (jonsbo_self_latency_seconds).
+
+--profile TICKS
+    Profile TICKS tick đầu tiên rồi ghi dump (default: 0 = không profile lúc start).
+    Khi daemon đang chạy, kill -USR1 <pid> hoặc curl -X POST http://localhost:PORT/api/profile?ticks=N
+    để profile N tick tiếp theo; màn hình vẫn được cập nhật trong lúc profile.
+    POST chỉ nhận từ localhost (403 từ máy khác), 409 nếu đang có phiên profile.
+    GET /api/profile trả về trạng thái và danh sách dump gần nhất.
+
+--profile-mode sample|cprofile|both
+    sample (default): lấy mẫu stack main thread 200 lần/giây bằng setitimer, overhead thấp,
+    ghi .collapsed (flamegraph.pl, speedscope). cprofile: cProfile, ghi .pstats. Luôn có .txt tóm tắt.
+
+--profile-dir PATH
+    Thư mục ghi dump profile (default: profiles/ cạnh script)
+
+--host-root PREFIX
+    Chạy trong container với /proc, /sys (và /dev) của host mount read-only tại PREFIX
+    (default: không có, đọc /proc, /sys, /dev trực tiếp). Env: N4_HOST_ROOT
+    Ví dụ: docker run -v /proc:/host/proc:ro -v /sys:/host/sys:ro ... --host-root /host
+
+--proc-root PATH / --sys-root PATH / --dev-root PATH
+    Chỉ định riêng từng thư mục gốc (ưu tiên hơn --host-root).
+    Env: N4_PROC_ROOT, N4_SYS_ROOT, N4_DEV_ROOT
+
+--metrics-scope host|cgroup
+    CPU/RAM của cả host (default) hoặc của container đang chạy script (cgroup v2/v1:
+    CPU theo quota/cpuset, RAM tổng là memory limit). Env: N4_METRICS_SCOPE
+
+--agent HOST:PORT
+    Chế độ agent: đọc metrics và stream snapshot (delta-encoded) về hub qua TCP
+    Tự động reconnect với exponential backoff khi mất kết nối
+    Ví dụ: --agent 192.168.1.14:9777
+
+--agent-name NAME
+    Tên host hiển thị trên hub (default: hostname)
+
+--hub-port PORT
+    Port nhận snapshot từ các agent (default: 0 = tắt)
+    Màn hình sẽ xoay vòng hiển thị máy local và các agent
+
+--hub-bind ADDRESS
+    Địa chỉ bind cho hub (default: 0.0.0.0)
+
+--hub-rotate SECONDS
+    Thời gian hiển thị mỗi host khi hub có nhiều host (default: 15.0)
+
 VÍ DỤ:
 
 # Chỉ ghi file
@@ -106,10 +262,13 @@ python3 read_sensor.py --vendor-id 303a --model-id 4001 --interval 2.0
 
 LƯU Ý:
 
-- Khi ESP32 tắt màn hình (backlight off), script sẽ dừng đọc và gửi dữ liệu sensor
+- Khi ESP32 tắt màn hình (backlight off), script sẽ dừng gửi dữ liệu sensor và chỉ đọc
+  chậm mỗi --warm-interval giây (warm cache) để lần bật màn hình sau hiển thị ngay
 - Khi ESP32 bật màn hình (backlight on), script sẽ:
   + Gửi storage data (label_storage_*) 1 lần duy nhất
   + Sau đó gửi dynamic data (fan, CPU, RAM, GPU, temp, network) định kỳ
+- Khi có nhiều màn hình, mỗi màn hình có trạng thái backlight/wake-up riêng nhưng
+  metrics chỉ được đọc 1 lần mỗi tick và gửi chung cho tất cả màn hình
 - Script tự động tìm USB device trong:
   + /dev/serial/by-id/
   + /sys/bus/usb/devices/
@@ -121,21 +280,34 @@ from __future__ import annotations
 
 import argparse
 import atexit
+import bisect
 import fcntl
+import hashlib
+import io
+import ipaddress
 import json
+import math
+import mmap
 import os
+import random
 import re
 import select
 import signal
 import socket
+import socketserver
+import struct
 import subprocess
 import sys
 import time
+import zlib
+from array import array
+from collections import deque
 from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from threading import Thread
-from typing import Dict, Optional, List, Tuple
+from threading import Condition, Event, Lock, Thread, active_count, local
+from typing import Callable, Dict, Optional, List, Tuple
+from urllib.parse import parse_qs
 
 def get_version_from_cmake() -> str:
     """
@@ -162,8 +334,16 @@ def get_version_from_cmake() -> str:
     # Fallback về version mặc định
     return "1.0.1"
 
-# Version của script và firmware - đọc từ CMakeLists.txt để đồng bộ
-VERSION = get_version_from_cmake()
+# Version của script và firmware - đọc từ CMakeLists.txt để đồng bộ (lần đầu cần, không phải lúc import)
+_VERSION: Optional[str] = None
+
+
+def get_version() -> str:
+    """Version đã cache, chỉ parse CMakeLists.txt ở lần gọi đầu tiên."""
+    global _VERSION
+    if _VERSION is None:
+        _VERSION = get_version_from_cmake()
+    return _VERSION
 
 # Dùng termios để set DTR/RTS trên Linux (built-in, không cần pip)
 try:
@@ -329,14 +509,36 @@ CPU_MHZ_RE = re.compile(r"cpu MHz\s*:\s*([0-9.]+)", re.IGNORECASE)
 # Flags cho biết user muốn chạy chế độ serial (giữ nguyên behaviour mặc định)
 SERIAL_MODE_HINT_FLAGS = (
     "--serial-device",
+    "--usb-serial",
     "--vendor-id",
     "--model-id",
     "--interval",
+    "--adaptive-interval",
+    "--interval-min",
+    "--interval-max",
+    "--state-file",
+    "--state-interval",
+    "--warm-interval",
     "--serial-retries",
     "--serial-retry-delay",
     "--no-wait-signal",
     "--auto-start-timeout",
     "--debug",
+    "--agent",
+    "--hub-port",
+    "--usb-ota",
+    "--history-file",
+    "--history-size-mb",
+    "--history-flush",
+    "--profile",
+    "--stats-log",
+    "--budget-cpu",
+    "--budget-tick-ms",
+    "--tick-deadline",
+    "--worker-collectors",
+    "--worker-timeout",
+    "--worker-max-calls",
+    "--plugin-dir",
 )
 
 
@@ -457,6 +659,643 @@ def format_storage_size(size_str: str) -> str:
             return f"{value:.1f} Gb"
 
 
+# ---------------------------------------------------------------------------
+# Thư mục gốc /proc, /sys, /dev và metrics theo cgroup
+# ---------------------------------------------------------------------------
+
+# Chạy trong container: mount /proc, /sys của host read-only rồi trỏ vào đây,
+# ví dụ --host-root /host (=> /host/proc, /host/sys, /host/dev)
+HOST_ROOT_ENV = "N4_HOST_ROOT"
+HOST_ROOT_KIND_ENV = {"proc": "N4_PROC_ROOT", "sys": "N4_SYS_ROOT", "dev": "N4_DEV_ROOT"}
+HOST_ROOTS: Dict[str, Path] = {"proc": Path("/proc"), "sys": Path("/sys"), "dev": Path("/dev")}
+
+# cgroup của chính process (trong container là cgroup của container, không phải của host)
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+METRICS_SCOPE_ENV = "N4_METRICS_SCOPE"
+METRICS_SCOPES = ("host", "cgroup")
+
+
+def configure_host_roots(
+    host_root: Optional[str] = None,
+    proc_root: Optional[str] = None,
+    sys_root: Optional[str] = None,
+    dev_root: Optional[str] = None,
+) -> Dict[str, Path]:
+    """Chọn thư mục gốc cho /proc, /sys, /dev mà mọi collector và USB discovery dùng.
+
+    Thứ tự ưu tiên: tham số riêng (--proc-root...) > env riêng (N4_PROC_ROOT...)
+    > prefix chung (--host-root hoặc N4_HOST_ROOT) > mặc định /proc, /sys, /dev.
+
+    Returns:
+        HOST_ROOTS sau khi cập nhật
+    """
+    prefix = host_root or os.environ.get(HOST_ROOT_ENV)
+    explicit = {"proc": proc_root, "sys": sys_root, "dev": dev_root}
+    for kind, env_name in HOST_ROOT_KIND_ENV.items():
+        value = explicit[kind] or os.environ.get(env_name)
+        if value:
+            HOST_ROOTS[kind] = Path(value)
+        elif prefix:
+            HOST_ROOTS[kind] = Path(prefix) / kind
+        else:
+            HOST_ROOTS[kind] = Path("/") / kind
+    return HOST_ROOTS
+
+
+def proc_path(*parts: str) -> Path:
+    """Đường dẫn trong procfs, ví dụ proc_path("meminfo") -> /proc/meminfo."""
+    return HOST_ROOTS["proc"].joinpath(*parts)
+
+
+def sys_path(*parts: str) -> Path:
+    """Đường dẫn trong sysfs, ví dụ sys_path("class/net", "eth0") -> /sys/class/net/eth0."""
+    return HOST_ROOTS["sys"].joinpath(*parts)
+
+
+def dev_path(*parts: str) -> Path:
+    """Đường dẫn trong /dev, ví dụ dev_path("ttyACM0") -> /dev/ttyACM0."""
+    return HOST_ROOTS["dev"].joinpath(*parts)
+
+
+def _read_cgroup_int(path: Path) -> Optional[int]:
+    """Đọc một số nguyên từ file cgroup, None nếu không có hoặc là "max" (không giới hạn)."""
+    try:
+        value = path.read_text(encoding="utf-8").split()[0]
+    except (OSError, IndexError):
+        return None
+    if value == "max":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def _read_cgroup_stat(path: Path, key: str) -> int:
+    """Đọc một key trong file dạng "key value" (cpu.stat, memory.stat), 0 nếu không có."""
+    try:
+        for line in path.read_text(encoding="utf-8").splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[0] == key:
+                return int(parts[1])
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+class CgroupReader:
+    """Đọc CPU/RAM của cgroup chứa process (cgroup v2 hoặc v1).
+
+    CPU usage tính theo giới hạn của cgroup (cpu.max / cfs_quota hoặc cpuset),
+    RAM tổng là memory limit (hoặc RAM của host nếu không giới hạn). RAM dùng
+    không tính page cache inactive, giống cách docker stats hiển thị.
+    """
+
+    def __init__(self, root: Path = CGROUP_ROOT):
+        self.root = root
+        self.v2 = (root / "cgroup.controllers").exists()
+        self.path = self._own_cgroup() if self.v2 else root
+        self._last_cpu: Optional[Tuple[float, int]] = None
+        if not self.available():
+            raise OSError(f"Không tìm thấy cgroup CPU/memory trong {root}")
+        # Lấy mẫu đầu tiên để lần đọc đầu tiên đã có CPU usage
+        self.cpu_usage()
+
+    def _own_cgroup(self) -> Path:
+        """cgroup v2 của process từ /proc/self/cgroup ("0::/path"), fallback về root."""
+        try:
+            # /proc của chính container (không qua proc_path): cần cgroup của process này
+            for line in Path("/proc/self/cgroup").read_text(encoding="utf-8").splitlines():
+                if line.startswith("0::"):
+                    candidate = self.root / line[3:].strip().lstrip("/")
+                    if (candidate / "cpu.stat").exists():
+                        return candidate
+        except OSError:
+            pass
+        return self.root
+
+    def available(self) -> bool:
+        if self.v2:
+            return (self.path / "cpu.stat").exists() and (self.path / "memory.current").exists()
+        return self._cpuacct_usage_file() is not None and (self.root / "memory/memory.usage_in_bytes").exists()
+
+    def _cpuacct_usage_file(self) -> Optional[Path]:
+        for name in ("cpuacct/cpuacct.usage", "cpu,cpuacct/cpuacct.usage"):
+            if (self.root / name).exists():
+                return self.root / name
+        return None
+
+    def _sample_cpu(self) -> Optional[int]:
+        """Tổng CPU time của cgroup tính bằng micro giây."""
+        if self.v2:
+            if not (self.path / "cpu.stat").exists():
+                return None
+            return _read_cgroup_stat(self.path / "cpu.stat", "usage_usec")
+        usage_file = self._cpuacct_usage_file()
+        usage_ns = _read_cgroup_int(usage_file) if usage_file else None
+        return None if usage_ns is None else usage_ns // 1000
+
+    def cpu_limit(self) -> float:
+        """Số CPU cgroup được dùng (quota/period, hoặc số CPU trong cpuset)."""
+        quota = period = None
+        if self.v2:
+            try:
+                parts = (self.path / "cpu.max").read_text(encoding="utf-8").split()
+                if len(parts) == 2 and parts[0] != "max":
+                    quota, period = int(parts[0]), int(parts[1])
+            except (OSError, ValueError):
+                pass
+        else:
+            for cpu_dir in ("cpu", "cpu,cpuacct"):
+                quota = _read_cgroup_int(self.root / cpu_dir / "cpu.cfs_quota_us")
+                period = _read_cgroup_int(self.root / cpu_dir / "cpu.cfs_period_us")
+                if quota is not None:
+                    break
+        try:
+            cpus = float(len(os.sched_getaffinity(0)))
+        except (AttributeError, OSError):
+            cpus = float(os.cpu_count() or 1)
+        if quota and period and quota > 0:
+            return min(cpus, quota / period)
+        return cpus
+
+    def cpu_usage(self) -> Optional[float]:
+        """CPU usage (%) của cgroup kể từ lần đọc trước."""
+        now = time.monotonic()
+        usage_us = self._sample_cpu()
+        if usage_us is None:
+            return None
+        previous, self._last_cpu = self._last_cpu, (now, usage_us)
+        if previous is None or now <= previous[0]:
+            return None
+        used_seconds = (usage_us - previous[1]) / 1_000_000
+        percent = used_seconds / ((now - previous[0]) * self.cpu_limit()) * 100.0
+        return max(0.0, min(100.0, percent))
+
+    def ram_info(self, host_total_kb: Optional[int]) -> Optional[Tuple[int, int]]:
+        """(used_kb, total_kb) của cgroup; total là memory limit hoặc RAM host nếu không giới hạn."""
+        if self.v2:
+            usage = _read_cgroup_int(self.path / "memory.current")
+            limit = _read_cgroup_int(self.path / "memory.max")
+            inactive = _read_cgroup_stat(self.path / "memory.stat", "inactive_file")
+        else:
+            memory_dir = self.root / "memory"
+            usage = _read_cgroup_int(memory_dir / "memory.usage_in_bytes")
+            limit = _read_cgroup_int(memory_dir / "memory.limit_in_bytes")
+            inactive = _read_cgroup_stat(memory_dir / "memory.stat", "total_inactive_file")
+        if usage is None:
+            return None
+        total_kb = limit // 1024 if limit else None
+        # cgroup v1 dùng số rất lớn (~2^63) thay cho "không giới hạn"
+        if host_total_kb and (total_kb is None or total_kb > host_total_kb):
+            total_kb = host_total_kb
+        if not total_kb:
+            return None
+        used_kb = max(0, usage - inactive) // 1024
+        return (min(used_kb, total_kb), total_kb)
+
+
+# None = metrics của cả host (mặc định), CgroupReader = metrics của container
+CGROUP_READER: Optional[CgroupReader] = None
+
+
+def configure_metrics_scope(scope: Optional[str] = None, cgroup_root: Path = CGROUP_ROOT) -> str:
+    """Chọn phạm vi CPU/RAM: "host" (toàn máy) hoặc "cgroup" (container đang chạy script).
+
+    Returns:
+        Scope thực sự được dùng (fallback về "host" nếu không đọc được cgroup)
+    """
+    global CGROUP_READER
+    scope = scope or os.environ.get(METRICS_SCOPE_ENV) or "host"
+    CGROUP_READER = None
+    if scope == "cgroup":
+        try:
+            CGROUP_READER = CgroupReader(cgroup_root)
+        except OSError as exc:
+            print(f"⚠ {exc}, dùng CPU/RAM của host", file=sys.stderr)
+            return "host"
+    return scope
+
+
+# Env có hiệu lực cả khi import module (bench, test) chứ không chỉ qua main()
+configure_host_roots()
+
+
+# ---------------------------------------------------------------------------
+# Self-metrics: histogram độ trễ cố định + bộ đếm, luôn bật
+# ---------------------------------------------------------------------------
+
+# Upper bound (giây) của các bucket, bucket cuối là +Inf
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Loại histogram: collector (mỗi collector), subprocess (theo tên lệnh), serial_write, http (theo route)
+LATENCY_KINDS = ("collector", "subprocess", "serial_write", "http")
+
+
+class LatencyHistogram:
+    """Histogram bucket cố định: observe() O(log bucket), không cấp phát thêm bộ nhớ."""
+
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Ước lượng quantile bằng nội suy tuyến tính trong bucket (giống histogram_quantile)."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                lower = LATENCY_BUCKETS[index - 1] if index > 0 else 0.0
+                if index == len(LATENCY_BUCKETS):
+                    return lower  # Bucket +Inf: chỉ biết chặn dưới
+                return lower + (LATENCY_BUCKETS[index] - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return LATENCY_BUCKETS[-1]
+
+    def to_dict(self) -> Dict[str, object]:
+        p50, p99 = self.quantile(0.5), self.quantile(0.99)
+        return {
+            "count": self.count,
+            "sum": round(self.total, 6),
+            "p50": None if p50 is None else round(p50, 6),
+            "p99": None if p99 is None else round(p99, 6),
+            "buckets": list(LATENCY_BUCKETS) + ["+Inf"],
+            "counts": list(self.counts),
+        }
+
+
+class SelfMetrics:
+    """Histogram độ trễ và bộ đếm của chính daemon (thread-safe, overhead ~1 µs mỗi lần ghi).
+
+    Histogram: collector, subprocess, serial_write, http. Bộ đếm: timeout/lỗi subprocess,
+    byte/frame đã ghi serial, reconnect... Kèm RSS và CPU time của process khi đọc snapshot.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._histograms: Dict[Tuple[str, str], LatencyHistogram] = {}
+        self._counters: Dict[Tuple[str, str], int] = {}
+        self.started = time.time()
+        self._last_log: Optional[Tuple[float, float]] = None  # (monotonic, cpu seconds) lần log trước
+        # Worker process: ghi lại từng sự kiện để gửi về daemon chính (xem run_collector_worker)
+        self.journal: Optional[List[Tuple[str, str, str, float]]] = None
+
+    def observe(self, kind: str, name: str, seconds: float) -> None:
+        if self.journal is not None:
+            self.journal.append(("observe", kind, name, seconds))
+        with self._lock:
+            histogram = self._histograms.get((kind, name))
+            if histogram is None:
+                histogram = self._histograms[(kind, name)] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    def inc(self, counter: str, name: str = "", amount: int = 1) -> None:
+        if self.journal is not None:
+            self.journal.append(("inc", counter, name, amount))
+        with self._lock:
+            self._counters[(counter, name)] = self._counters.get((counter, name), 0) + amount
+
+    @staticmethod
+    def process_stats() -> Dict[str, float]:
+        """RSS, CPU time và số thread của chính process (/proc/self, không qua proc_path)."""
+        times = os.times()
+        stats = {
+            "cpu_user_seconds": times.user,
+            "cpu_system_seconds": times.system,
+            "cpu_children_seconds": times.children_user + times.children_system,
+            "threads": active_count(),
+        }
+        try:
+            resident_pages = int(Path("/proc/self/statm").read_text().split()[1])
+            stats["rss_bytes"] = resident_pages * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            pass
+        return stats
+
+    def snapshot(self) -> Dict[str, object]:
+        """Toàn bộ self-metrics dạng dict (cho /api/self)."""
+        with self._lock:
+            histograms: Dict[str, Dict[str, object]] = {}
+            for (kind, name), histogram in sorted(self._histograms.items()):
+                histograms.setdefault(kind, {})[name] = histogram.to_dict()
+            counters: Dict[str, Dict[str, int]] = {}
+            for (counter, name), value in sorted(self._counters.items()):
+                counters.setdefault(counter, {})[name] = value
+        return {
+            "uptime_seconds": round(time.time() - self.started, 1),
+            "process": self.process_stats(),
+            "latency": histograms,
+            "counters": counters,
+        }
+
+    def prometheus_lines(self) -> List[str]:
+        """Histogram/bộ đếm/process theo Prometheus text format."""
+        lines = [
+            "# HELP jonsbo_self_latency_seconds Độ trễ collector, subprocess, ghi serial và HTTP request",
+            "# TYPE jonsbo_self_latency_seconds histogram",
+        ]
+        with self._lock:
+            histograms = [(key, list(h.counts), h.total, h.count) for key, h in sorted(self._histograms.items())]
+            counters = sorted(self._counters.items())
+        for (kind, name), counts, total, count in histograms:
+            labels = f'kind="{kind}",name="{_prometheus_escape(name)}"'
+            cumulative = 0
+            for bound, bucket_count in zip(list(LATENCY_BUCKETS) + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f'jonsbo_self_latency_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"jonsbo_self_latency_seconds_sum{{{labels}}} {total!r}")
+            lines.append(f"jonsbo_self_latency_seconds_count{{{labels}}} {count}")
+        lines.append("# HELP jonsbo_events_total Bộ đếm sự kiện (timeout, lỗi, byte/frame serial, reconnect)")
+        lines.append("# TYPE jonsbo_events_total counter")
+        for (counter, name), value in counters:
+            lines.append(f'jonsbo_events_total{{event="{counter}",name="{_prometheus_escape(name)}"}} {value}')
+        process = self.process_stats()
+        lines.append("# HELP jonsbo_process_cpu_seconds_total CPU time của daemon (user + system)")
+        lines.append("# TYPE jonsbo_process_cpu_seconds_total counter")
+        lines.append(f"jonsbo_process_cpu_seconds_total {process['cpu_user_seconds'] + process['cpu_system_seconds']!r}")
+        if "rss_bytes" in process:
+            lines.append("# HELP jonsbo_process_resident_memory_bytes RSS của daemon")
+            lines.append("# TYPE jonsbo_process_resident_memory_bytes gauge")
+            lines.append(f"jonsbo_process_resident_memory_bytes {process['rss_bytes']}")
+        return lines
+
+    def log_line(self) -> str:
+        """Một dòng tóm tắt: RSS, CPU% từ lần log trước, serial, reconnect và các lệnh chậm nhất (p99)."""
+        process = self.process_stats()
+        now = time.monotonic()
+        cpu = process["cpu_user_seconds"] + process["cpu_system_seconds"]
+        parts = [f"rss {process.get('rss_bytes', 0) / (1024 * 1024):.1f} MB"]
+        if self._last_log is not None and now > self._last_log[0]:
+            parts.append(f"cpu {(cpu - self._last_log[1]) / (now - self._last_log[0]) * 100:.1f}%")
+        self._last_log = (now, cpu)
+        with self._lock:
+            counters = dict(self._counters)
+            slowest = sorted(
+                ((h.quantile(0.99) or 0.0, kind, name) for (kind, name), h in self._histograms.items()
+                 if kind in ("collector", "subprocess")),
+                reverse=True,
+            )[:3]
+        serial_bytes = sum(v for (c, _), v in counters.items() if c == "serial_bytes")
+        serial_frames = sum(v for (c, _), v in counters.items() if c == "serial_frames")
+        reconnects = sum(v for (c, _), v in counters.items() if c in ("display_disconnects", "agent_reconnects"))
+        timeouts = sum(v for (c, _), v in counters.items() if c == "subprocess_timeouts")
+        parts.append(f"serial {serial_bytes / 1024:.1f} KB/{serial_frames} frame")
+        parts.append(f"{reconnects} reconnect, {timeouts} timeout")
+        if slowest:
+            parts.append("p99 " + ", ".join(f"{name} {p99 * 1000:.0f} ms" for p99, _, name in slowest))
+        return "📊 " + ", ".join(parts)
+
+
+SELF_METRICS = SelfMetrics()
+
+
+def run_command(args: List[str], **kwargs) -> subprocess.CompletedProcess:
+    """subprocess.run có đo thời gian (histogram "subprocess" theo tên lệnh) và đếm timeout/lỗi.
+
+    Exception giữ nguyên như subprocess.run để code gọi xử lý như cũ.
+    """
+    name = os.path.basename(args[0]) if args else "?"
+    if name == "sh" and len(args) > 2 and args[1] == "-c":
+        name = args[2].split()[0]  # Pipeline "iostat -dy | awk ...": tính theo lệnh đầu tiên
+    # Lệnh không có hoặc breaker đang mở: không fork, raise giống khi thiếu lệnh
+    if CAPABILITIES.tool(name) is None:
+        SELF_METRICS.inc("subprocess_skipped", name)
+        raise FileNotFoundError(f"Không tìm thấy lệnh {name}")
+    key = breaker_key(name, args)
+    if not BREAKERS.allow(key):
+        SELF_METRICS.inc("subprocess_skipped", name)
+        raise FileNotFoundError(f"{key}: circuit breaker đang mở")
+    start = time.perf_counter()
+    try:
+        result = subprocess.run(args, **kwargs)
+    except subprocess.TimeoutExpired:
+        SELF_METRICS.inc("subprocess_timeouts", name)
+        BREAKERS.failure(key)
+        raise
+    except (OSError, subprocess.SubprocessError):
+        SELF_METRICS.inc("subprocess_errors", name)
+        BREAKERS.failure(key)
+        raise
+    finally:
+        SELF_METRICS.observe("subprocess", name, time.perf_counter() - start)
+    if result.returncode != 0:
+        SELF_METRICS.inc("subprocess_errors", name)
+        BREAKERS.failure(key)
+    else:
+        BREAKERS.success(key)
+    return result
+
+
+# ---------------------------------------------------------------------------
+# Capability probe + circuit breaker: không fork lệnh không có hoặc lỗi liên tục
+# ---------------------------------------------------------------------------
+
+# Lệnh ngoài collector có thể dùng (probe lúc khởi động; lệnh khác được tìm khi gọi lần đầu)
+PROBE_TOOLS = ("synodisk", "nvme", "nvidia-smi", "snmpwalk", "snmpget", "ethtool", "iostat", "ping", "ip", "df")
+# Nguồn dữ liệu trong /proc, /sys: tên -> (loại thư mục gốc, đường dẫn)
+PROBE_PATHS = {
+    "hwmon": ("sys", "class/hwmon"),
+    "thermal": ("sys", "class/thermal"),
+    "drm": ("sys", "class/drm"),
+    "nvme": ("sys", "class/nvme"),
+    "net": ("sys", "class/net"),
+    "diskstats": ("proc", "diskstats"),
+}
+# Lệnh không có được tìm lại sau khoảng này (có thể vừa cài package)
+CAPABILITY_RECHECK_SECONDS = 600.0
+# Breaker mở sau N lần lỗi liên tiếp, chờ 30s rồi cho thử một lần (half-open);
+# thử lỗi thì thời gian chờ gấp đôi, tối đa 10 phút
+BREAKER_THRESHOLD = 3
+BREAKER_BASE_BACKOFF = 30.0
+BREAKER_MAX_BACKOFF = 600.0
+# Exit code != 0 của ping là do mạng/host, không phải do công cụ
+BREAKER_EXEMPT_TOOLS = frozenset(("ping",))
+# Lệnh có key riêng theo tham số cuối: subtree SNMP, từng ổ NVMe, từng interface
+BREAKER_KEY_LAST_ARG = frozenset(("snmpwalk", "snmpget", "nvme", "ethtool"))
+
+
+def breaker_key(name: str, args: List[str]) -> str:
+    """Key circuit breaker của một lệnh, ví dụ "nvidia-smi", "snmpwalk 1.3.6.1.4.1.6574.3"."""
+    if name in BREAKER_EXEMPT_TOOLS:
+        return ""
+    if name in BREAKER_KEY_LAST_ARG and len(args) > 1:
+        return f"{name} {args[-1]}"
+    return name
+
+
+class Capabilities:
+    """Lệnh ngoài và đường dẫn /proc, /sys thực sự có trên máy (thread-safe).
+
+    Lệnh được tìm bằng PATH (không fork) một lần; lệnh không có được tìm lại mỗi
+    CAPABILITY_RECHECK_SECONDS. Subtree SNMP được ghi nhận qua circuit breaker khi dùng lần đầu.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.tools: Dict[str, Optional[str]] = {}
+        self._checked: Dict[str, float] = {}
+        self.paths: Dict[str, bool] = {}
+
+    def tool(self, name: str) -> Optional[str]:
+        """Đường dẫn đầy đủ của lệnh, None nếu không có trong PATH."""
+        now = time.monotonic()
+        with self._lock:
+            if name in self.tools and (self.tools[name] or now - self._checked[name] < CAPABILITY_RECHECK_SECONDS):
+                return self.tools[name]
+        import shutil
+        path = shutil.which(name)
+        with self._lock:
+            self.tools[name] = path
+            self._checked[name] = now
+        return path
+
+    def probe(self) -> Dict[str, object]:
+        """Kiểm tra PROBE_TOOLS và PROBE_PATHS (gọi lúc khởi động, sau configure_host_roots)."""
+        with self._lock:
+            self._checked.clear()
+            self.tools.clear()
+        for name in PROBE_TOOLS:
+            self.tool(name)
+        paths = {name: HOST_ROOTS[kind].joinpath(path).exists() for name, (kind, path) in PROBE_PATHS.items()}
+        with self._lock:
+            self.paths = paths
+        return self.status()
+
+    def status(self) -> Dict[str, object]:
+        """Kết quả probe cho /api/self."""
+        with self._lock:
+            return {
+                "tools": {name: path is not None for name, path in sorted(self.tools.items())},
+                "paths": dict(self.paths),
+            }
+
+
+class CircuitBreakers:
+    """Circuit breaker theo key: lệnh ("nvidia-smi", "snmpwalk <oid>") hoặc collector ("collector:gpu").
+
+    closed: chạy bình thường, đếm lỗi liên tiếp. Sau BREAKER_THRESHOLD lỗi -> open: allow()
+    trả False tới hết backoff. Hết backoff -> half-open: cho đúng một lần thử; thành công thì
+    đóng lại, lỗi thì mở lại với backoff gấp đôi (tối đa BREAKER_MAX_BACKOFF).
+    Chỉ giữ state cho key đang lỗi.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._state: Dict[str, Dict[str, float]] = {}
+
+    def allow(self, key: str) -> bool:
+        """True nếu được chạy (closed, hoặc lần thử half-open)."""
+        if not key:
+            return True
+        with self._lock:
+            state = self._state.get(key)
+            if state is None or not state["open_until"]:
+                return True
+            if state["half_open"] or time.monotonic() < state["open_until"]:
+                return False
+            state["half_open"] = True
+            return True
+
+    def success(self, key: str) -> None:
+        if not key:
+            return
+        with self._lock:
+            state = self._state.pop(key, None)
+        if state is not None and state["open_until"]:
+            print(f"✓ {key} hoạt động lại, đóng circuit breaker")
+
+    def failure(self, key: str) -> None:
+        if not key:
+            return
+        with self._lock:
+            state = self._state.setdefault(
+                key, {"failures": 0, "trips": 0, "backoff": 0.0, "open_until": 0.0, "half_open": False}
+            )
+            state["failures"] += 1
+            if not state["half_open"] and (state["open_until"] or state["failures"] < BREAKER_THRESHOLD):
+                return
+            state["backoff"] = min(BREAKER_MAX_BACKOFF, state["backoff"] * 2) if state["backoff"] else BREAKER_BASE_BACKOFF
+            state["open_until"] = time.monotonic() + state["backoff"]
+            state["half_open"] = False
+            state["trips"] += 1
+            failures, backoff = state["failures"], state["backoff"]
+        SELF_METRICS.inc("breaker_trips", key)
+        print(f"⚠ {key} lỗi {int(failures)} lần liên tiếp, tạm ngừng {backoff:g}s (circuit breaker)", file=sys.stderr)
+
+    def status(self) -> Dict[str, Dict[str, object]]:
+        """State của các key đang lỗi cho /api/self và /metrics."""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                key: {
+                    "state": "half_open" if state["half_open"] else "open" if state["open_until"] else "closed",
+                    "failures": int(state["failures"]),
+                    "trips": int(state["trips"]),
+                    "backoff": state["backoff"],
+                    "retry_in": round(max(0.0, state["open_until"] - now), 1) if state["open_until"] else 0.0,
+                }
+                for key, state in sorted(self._state.items())
+            }
+
+
+CAPABILITIES = Capabilities()
+BREAKERS = CircuitBreakers()
+
+
+def process_age() -> Optional[float]:
+    """Số giây từ lúc process được tạo (/proc/self/stat, tính cả khởi động interpreter và import)."""
+    try:
+        stat = Path("/proc/self/stat").read_text()
+        start_ticks = int(stat.rsplit(")", 1)[1].split()[19])
+        uptime = float(Path("/proc/uptime").read_text().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupTimer:
+    """Mốc thời gian khởi động (tính từ lúc process bắt đầu), in thành một dòng sau frame đầu tiên."""
+
+    def __init__(self):
+        self.start = time.monotonic() - (process_age() or 0.0)
+        self.marks: List[Tuple[str, float]] = []
+        self.reported = False
+
+    def mark(self, name: str) -> None:
+        """Ghi mốc (bỏ qua sau khi đã báo cáo)."""
+        if not self.reported:
+            self.marks.append((name, time.monotonic()))
+
+    def to_dict(self) -> Dict[str, float]:
+        """Thời điểm (ms từ lúc process bắt đầu) của từng mốc, cho /api/self."""
+        return {name: round((at - self.start) * 1000, 1) for name, at in self.marks}
+
+    def report(self, name: str) -> None:
+        """Ghi mốc cuối và in báo cáo (chỉ lần đầu)."""
+        if self.reported:
+            return
+        self.mark(name)
+        self.reported = True
+        parts = []
+        previous = self.start
+        for mark_name, at in self.marks:
+            parts.append(f"{mark_name} +{(at - previous) * 1000:.0f} ms")
+            previous = at
+        print(f"⏱ Khởi động: {', '.join(parts)} (tổng {(previous - self.start) * 1000:.0f} ms)")
+
+
+STARTUP_TIMER = StartupTimer()
+
+
 def read_fan_speeds() -> Dict[str, str]:
     """Đọc tốc độ quạt từ /sys/class/hwmon/hwmon*/fan*_input.
     
@@ -465,7 +1304,7 @@ def read_fan_speeds() -> Dict[str, str]:
     """
     fans: Dict[str, str] = {}
     try:
-        hwmon_path = Path("/sys/class/hwmon")
+        hwmon_path = sys_path("class/hwmon")
         if not hwmon_path.exists():
             # Initialize all 7 fans to N/A
             return {f"label_fan{i}_value": "N/A" for i in range(1, 8)}
@@ -513,7 +1352,7 @@ def read_cpu_clock_ghz() -> Optional[float]:
         CPU clock speed tính bằng GHz, hoặc None nếu không đọc được
     """
     try:
-        cpuinfo = Path("/proc/cpuinfo").read_text(encoding="utf-8")
+        cpuinfo = proc_path("cpuinfo").read_text(encoding="utf-8")
         match = CPU_MHZ_RE.search(cpuinfo)
         if match:
             mhz = float(match.group(1))
@@ -526,11 +1365,15 @@ def read_cpu_clock_ghz() -> Optional[float]:
 def read_cpu_usage() -> Optional[float]:
     """Đọc CPU usage từ /proc/stat bằng cách tính phần trăm từ CPU times.
     
+    Với --metrics-scope cgroup, trả về CPU usage của container (theo giới hạn CPU của cgroup).
+
     Returns:
         CPU usage percentage (0-100), hoặc None nếu không đọc được
     """
+    if CGROUP_READER is not None:
+        return CGROUP_READER.cpu_usage()
     try:
-        stat_file = Path("/proc/stat")
+        stat_file = proc_path("stat")
         if not stat_file.exists():
             return None
         
@@ -563,14 +1406,19 @@ def read_cpu_usage() -> Optional[float]:
 
 def read_ram_info() -> Optional[Tuple[int, int]]:
     """Đọc RAM info từ /proc/meminfo. Trả về (used_kb, total_kb).
+
+    Với --metrics-scope cgroup, trả về RAM của container (total = memory limit).
     
     Returns:
         Tuple (used_kb, total_kb) tính bằng KB, hoặc None nếu không đọc được
     """
     try:
-        meminfo = Path("/proc/meminfo").read_text(encoding="utf-8")
+        meminfo = proc_path("meminfo").read_text(encoding="utf-8")
         total_match = re.search(r"MemTotal:\s+(\d+)\s+kB", meminfo)
         available_match = re.search(r"MemAvailable:\s+(\d+)\s+kB", meminfo)
+
+        if CGROUP_READER is not None:
+            return CGROUP_READER.ram_info(int(total_match.group(1)) if total_match else None)
         
         if total_match and available_match:
             total_kb = int(total_match.group(1))
@@ -592,7 +1440,7 @@ def read_gpu_clock_mhz() -> Optional[int]:
     """
     # Try nvidia-smi first (for NVIDIA GPUs) - đọc current clock, không phải max
     try:
-        result = subprocess.run(
+        result = run_command(
             ["nvidia-smi", "--query-gpu=clocks.current.graphics", "--format=csv,noheader,nounits"],
             capture_output=True,
             text=True,
@@ -611,7 +1459,7 @@ def read_gpu_clock_mhz() -> Optional[int]:
     
     # Fallback: Try /sys/class/drm/card*/gt_cur_freq_mhz (current frequency)
     try:
-        drm_path = Path("/sys/class/drm")
+        drm_path = sys_path("class/drm")
         if not drm_path.exists():
             return None
         
@@ -676,7 +1524,7 @@ def read_gpu_usage_percent() -> Tuple[Optional[int], Optional[int]]:
         - gpu_fan_speed: GPU fan speed percentage (0-100), hoặc None nếu không đọc được
     """
     try:
-        result = subprocess.run(
+        result = run_command(
             ["nvidia-smi", "--query-gpu=utilization.gpu,fan.speed", "--format=csv,noheader,nounits"],
             capture_output=True,
             text=True,
@@ -715,7 +1563,7 @@ def read_disk_temps() -> Dict[str, str]:
     
     # Try synodisk first (Synology specific)
     try:
-        result = subprocess.run(
+        result = run_command(
             ["synodisk", "--enum"],
             capture_output=True,
             text=True,
@@ -749,7 +1597,7 @@ def read_disk_temps() -> Dict[str, str]:
     # Command: nvme smart-log $device | grep "temperature" | head -1 | awk '{print $3}'
     try:
         # Get list of NVMe devices (only main devices: nvme0, nvme1, etc.)
-        nvme_devices = sorted(Path("/dev").glob("nvme[0-9]"))
+        nvme_devices = sorted(dev_path().glob("nvme[0-9]"))
         nvme_idx = 1
         
         for nvme_device in nvme_devices:
@@ -758,7 +1606,7 @@ def read_disk_temps() -> Dict[str, str]:
             
             try:
                 # Run nvme smart-log and parse temperature
-                result = subprocess.run(
+                result = run_command(
                     ["nvme", "smart-log", str(nvme_device)],
                     capture_output=True,
                     text=True,
@@ -803,7 +1651,7 @@ def read_disk_temps() -> Dict[str, str]:
     if all(temps.get(f"label_temp_nvme{i}", "N/A") == "N/A" for i in range(1, 6)):
         try:
             nvme_idx = 1
-            for nvme_path in sorted(Path("/sys/block").glob("nvme*")):
+            for nvme_path in sorted(sys_path("block").glob("nvme*")):
                 if nvme_idx > 5:
                     break
                 temp_file = nvme_path / "device" / "temp1_input"
@@ -921,7 +1769,7 @@ def read_system_temps() -> Dict[str, str]:
     }
     
     try:
-        hwmon_path = Path("/sys/class/hwmon")
+        hwmon_path = sys_path("class/hwmon")
         if not hwmon_path.exists():
             return temps
         
@@ -993,7 +1841,7 @@ def read_system_temps() -> Dict[str, str]:
         # Try to get GPU temperature from nvidia-smi
         if not temps["label_temp_gpu"] or temps["label_temp_gpu"] == "N/A":
             try:
-                result = subprocess.run(
+                result = run_command(
                     ["nvidia-smi", "--query-gpu=temperature.gpu", "--format=csv,noheader,nounits"],
                     capture_output=True,
                     text=True,
@@ -1013,7 +1861,7 @@ def read_system_temps() -> Dict[str, str]:
         # Try to get GPU temperature from /sys/class/drm
         if not temps["label_temp_gpu"] or temps["label_temp_gpu"] == "N/A":
             try:
-                drm_path = Path("/sys/class/drm")
+                drm_path = sys_path("class/drm")
                 if drm_path.exists():
                     for card_path in sorted(drm_path.glob("card*")):
                         # Try device/temp1_input
@@ -1059,7 +1907,7 @@ def run_snmpwalk(host: str = "localhost", community: str = "public", version: st
         base_oid,
     ]
     try:
-        completed = subprocess.run(
+        completed = run_command(
             cmd,
             check=True,
             capture_output=True,
@@ -1135,7 +1983,7 @@ def run_snmpget(host: str = "localhost", community: str = "public", version: str
         oid,
     ]
     try:
-        completed = subprocess.run(
+        completed = run_command(
             cmd,
             check=True,
             capture_output=True,
@@ -1241,7 +2089,7 @@ def read_storage_volumes() -> Dict[str, str]:
         
         # Fallback: Nếu SNMP không hoạt động, dùng df -h (cách cũ)
         # Sử dụng awk để parse chính xác df -h output
-        result = subprocess.run(
+        result = run_command(
             ["sh", "-c", "df -h | awk '/\\/volume[123]$/ {print $6, $2, $3, $5}'"],
             capture_output=True,
             text=True,
@@ -1408,11 +2256,11 @@ def get_network_interface() -> Optional[str]:
     
     # Thử các interface ưu tiên trước
     for iface in preferred_interfaces:
-        iface_path = Path(f"/sys/class/net/{iface}")
+        iface_path = sys_path("class/net", iface)
         if iface_path.exists():
             # Kiểm tra xem có IP không
             try:
-                result = subprocess.run(
+                result = run_command(
                     ["ip", "-4", "addr", "show", iface],
                     capture_output=True,
                     text=True,
@@ -1425,7 +2273,7 @@ def get_network_interface() -> Optional[str]:
     
     # Nếu không tìm thấy, tìm interface đầu tiên có IP và không phải loopback
     try:
-        result = subprocess.run(
+        result = run_command(
             ["ip", "-4", "addr", "show"],
             capture_output=True,
             text=True,
@@ -1471,7 +2319,7 @@ def read_system_info() -> Dict[str, str]:
             info["label_hostname"] = hostname
     except Exception:
         try:
-            result = subprocess.run(
+            result = run_command(
                 ["hostname"],
                 capture_output=True,
                 text=True,
@@ -1491,7 +2339,7 @@ def read_system_info() -> Dict[str, str]:
         if not username:
             # Fallback: dùng getpass hoặc whoami
             try:
-                result = subprocess.run(
+                result = run_command(
                     ["whoami"],
                     capture_output=True,
                     text=True,
@@ -1511,7 +2359,7 @@ def read_system_info() -> Dict[str, str]:
     iface = get_network_interface()
     if iface:
         try:
-            result = subprocess.run(
+            result = run_command(
                 ["ip", "-4", "addr", "show", iface],
                 capture_output=True,
                 text=True,
@@ -1673,7 +2521,7 @@ def get_physical_nic() -> Optional[str]:
     
     # Thử các interface ưu tiên trước
     for iface in physical_interfaces:
-        iface_path = Path(f"/sys/class/net/{iface}")
+        iface_path = sys_path("class/net", iface)
         if not iface_path.exists():
             continue
         
@@ -1686,7 +2534,7 @@ def get_physical_nic() -> Optional[str]:
             
             # Kiểm tra xem có tốc độ không
             try:
-                result = subprocess.run(
+                result = run_command(
                     ["ethtool", iface],
                     capture_output=True,
                     text=True,
@@ -1704,7 +2552,7 @@ def get_physical_nic() -> Optional[str]:
     
     # Nếu không tìm thấy, tìm tất cả interface và loại bỏ virtual
     try:
-        net_path = Path("/sys/class/net")
+        net_path = sys_path("class/net")
         if net_path.exists():
             for iface_dir in net_path.iterdir():
                 iface = iface_dir.name
@@ -1720,7 +2568,7 @@ def get_physical_nic() -> Optional[str]:
                     
                     # Kiểm tra xem có tốc độ không
                     try:
-                        result = subprocess.run(
+                        result = run_command(
                             ["ethtool", iface],
                             capture_output=True,
                             text=True,
@@ -1768,7 +2616,7 @@ def get_nic_max_speed_mbps(physical_iface: Optional[str] = None) -> Optional[flo
     
     for test_iface in interfaces_to_try:
         try:
-            speed_path = Path(f"/sys/class/net/{test_iface}/speed")
+            speed_path = sys_path("class/net", test_iface, "speed")
             if speed_path.exists():
                 speed_str = speed_path.read_text().strip()
                 # File speed chứa tốc độ tính bằng Mbps (ví dụ: "2500")
@@ -1784,7 +2632,7 @@ def get_nic_max_speed_mbps(physical_iface: Optional[str] = None) -> Optional[flo
     # Fallback: thử dùng ethtool nếu không đọc được từ /sys
     for test_iface in interfaces_to_try:
         try:
-            result = subprocess.run(
+            result = run_command(
                 ["ethtool", test_iface],
                 capture_output=True,
                 text=True,
@@ -1832,7 +2680,7 @@ def read_disk_io() -> Dict[str, str]:
             "iostat -dy | awk 'NR>3 {tps+=$2; read+=$3; write+=$4} END {printf \"%.0f %.2f %.2f\\n\",tps,read/1024,write/1024}'"
         ]
         
-        completed = subprocess.run(
+        completed = run_command(
             cmd,
             capture_output=True,
             text=True,
@@ -1862,6 +2710,10 @@ def read_disk_io() -> Dict[str, str]:
     return result
 
 
+# Khoảng lấy mẫu rx/tx_bytes để tính tốc độ mạng (collector network sleep khoảng này)
+NETWORK_SAMPLE_SECONDS = 1.0
+
+
 def read_network_speed() -> Dict[str, str]:
     """Đọc tốc độ download và upload từ network interface (tự động chọn Kbps hoặc Mbps).
     
@@ -1885,8 +2737,8 @@ def read_network_speed() -> Dict[str, str]:
     
     try:
         # Đường dẫn đến statistics
-        rx_path = Path(f"/sys/class/net/{iface}/statistics/rx_bytes")
-        tx_path = Path(f"/sys/class/net/{iface}/statistics/tx_bytes")
+        rx_path = sys_path("class/net", iface, "statistics/rx_bytes")
+        tx_path = sys_path("class/net", iface, "statistics/tx_bytes")
         
         if not rx_path.exists() or not tx_path.exists():
             return result
@@ -1899,7 +2751,7 @@ def read_network_speed() -> Dict[str, str]:
             return result
         
         # Đợi 1 giây
-        time.sleep(1)
+        time.sleep(NETWORK_SAMPLE_SECONDS)
         
         # Đọc lần 2
         try:
@@ -1975,7 +2827,7 @@ def read_ping() -> Dict[str, str]:
     
     try:
         # Ping google.com với 1 packet, timeout 3 giây
-        ping_result = subprocess.run(
+        ping_result = run_command(
             ["ping", "-c", "1", "-W", "3", "google.com"],
             capture_output=True,
             text=True,
@@ -1998,76 +2850,2181 @@ def read_ping() -> Dict[str, str]:
     return result
 
 
-def aggregate_metrics() -> Dict[str, str]:
+def _collect_cpu() -> Dict[str, str]:
+    """Collector CPU: clock + usage."""
+    return format_cpu_metrics(read_cpu_clock_ghz(), read_cpu_usage())
+
+
+def _collect_ram() -> Dict[str, str]:
+    """Collector RAM: used / total."""
+    return format_ram_metrics(read_ram_info())
+
+
+def _collect_gpu() -> Dict[str, str]:
+    """Collector GPU: clock, usage và fan speed."""
+    gpu_clock = read_gpu_clock_mhz()
+    gpu_usage, gpu_fan_speed = read_gpu_usage_percent()
+    return format_gpu_metrics(gpu_clock, gpu_usage, gpu_fan_speed)
+
+
+# ---------------------------------------------------------------------------
+# Registry collector: mỗi collector khai báo labels, chi phí, chu kỳ, phụ thuộc, sandbox
+# ---------------------------------------------------------------------------
+
+# Loại chi phí: cheap = chỉ đọc /proc, /sys (dùng cho frame đầu sau wake up);
+# command = gọi lệnh ngoài; wait = chủ yếu chờ (lấy mẫu, mạng), chạy song song với các collector khác
+COLLECTOR_COSTS = ("cheap", "command", "wait")
+# Nhóm gửi tới màn hình của label mới (plugin): wakeup, dynamic hoặc None (chỉ API/file)
+COLLECTOR_DISPLAY_GROUPS = ("wakeup", "dynamic")
+PLUGIN_DIR_NAME = "collectors.d"
+PLUGIN_DIR_ENV = "N4_PLUGIN_DIR"
+
+
+class CollectorSpec:
+    """Khai báo một collector (built-in hoặc plugin), engine dựa vào đây để lập lịch và đo.
+
+    Args:
+        name: Tên collector (dùng trong stats, API, --worker-collectors)
+        function: Hàm trả về {label: value}; nếu có depends thì nhận thêm dict label -> value
+            của các collector phụ thuộc ở tick hiện tại
+        labels: Labels collector sinh ra (label khác bị bỏ)
+        cost: Một trong COLLECTOR_COSTS
+        cadence: Chạy tối đa mỗi N giây, giữa hai lần dùng lại giá trị cũ (0 = mỗi tick)
+        depends: Collector phải chạy trước (đã đăng ký trước đó)
+        isolate: Mặc định chạy trong worker process (COLLECTOR_POOL)
+        optional: TICK_BUDGET được bỏ hẳn khi vượt budget
+        essential: TICK_BUDGET không bao giờ giãn chu kỳ
+        wakes_disks: Đọc SMART, có thể đánh thức ổ đang standby (warm cache bỏ qua)
+        idle_seconds: Thời gian chờ có chủ đích bên trong (không tính vào budget thời gian tick)
+        breaker: Dùng circuit breaker khi lỗi liên tục
+        na_is_failure: Trả về toàn N/A cũng tính là lỗi cho breaker (ví dụ gpu trên máy không có
+            card NVIDIA); mặc định không, vì N/A là trạng thái bình thường của nhiều collector
+            (ổ standby, khay trống, không có SNMP)
+        display: Nhóm gửi tới màn hình cho label chưa có trong LABEL_ORDER
+        source: "builtin" hoặc tên file plugin
+    """
+
+    def __init__(
+        self,
+        name: str,
+        function: Callable[..., Dict[str, str]],
+        labels: Tuple[str, ...],
+        cost: str = "command",
+        cadence: float = 0.0,
+        depends: Tuple[str, ...] = (),
+        isolate: bool = False,
+        optional: bool = False,
+        essential: bool = False,
+        wakes_disks: bool = False,
+        idle_seconds: float = 0.0,
+        breaker: bool = True,
+        na_is_failure: bool = False,
+        display: Optional[str] = None,
+        source: str = "builtin",
+    ):
+        self.name = name
+        self.function = function
+        self.labels = tuple(labels)
+        self.cost = cost
+        self.cadence = cadence
+        self.depends = tuple(depends)
+        self.isolate = isolate
+        self.optional = optional
+        self.essential = essential
+        self.wakes_disks = wakes_disks
+        self.idle_seconds = idle_seconds
+        self.breaker = breaker
+        self.na_is_failure = na_is_failure
+        self.display = display
+        self.source = source
+        self.pooled = False  # Đang chạy qua COLLECTOR_POOL (CollectorPool.install)
+        self._label_set = frozenset(self.labels)
+        self._warned = False
+
+    def collect(self, inputs: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+        """Chạy collector (trong worker nếu pooled), chỉ giữ các label đã khai báo."""
+        if self.pooled:
+            values = COLLECTOR_POOL.call(self.name, inputs)
+        else:
+            values = self.function(inputs or {}) if self.depends else self.function()
+        extra = [label for label in values if label not in self._label_set]
+        if extra:
+            if not self._warned:
+                self._warned = True
+                print(f"⚠ Collector {self.name} trả về label chưa khai báo (bỏ qua): {', '.join(extra)}", file=sys.stderr)
+            values = {label: value for label, value in values.items() if label in self._label_set}
+        return values
+
+    def describe(self) -> Dict[str, object]:
+        """Khai báo dạng dict cho /api/self."""
+        return {
+            "name": self.name,
+            "labels": list(self.labels),
+            "cost": self.cost,
+            "cadence": self.cadence,
+            "depends": list(self.depends),
+            "isolate": self.isolate,
+            "pooled": self.pooled,
+            "source": self.source,
+        }
+
+
+class CollectorRegistry:
+    """Danh sách collector theo thứ tự chạy (thứ tự đăng ký, phụ thuộc luôn đứng trước).
+
+    Plugin trong thư mục --plugin-dir là file .py có hàm register(registry), gọi
+    registry.add(...) với cùng tham số như CollectorSpec; plugin dùng registry.run_command,
+    registry.proc_path... để có đo thời gian, capability probe và circuit breaker như built-in.
+    """
+
+    run_command = staticmethod(run_command)
+    proc_path = staticmethod(proc_path)
+    sys_path = staticmethod(sys_path)
+    dev_path = staticmethod(dev_path)
+
+    def __init__(self):
+        self.specs: List[CollectorSpec] = []
+        self._by_name: Dict[str, CollectorSpec] = {}
+        self._label_owner: Dict[str, str] = {}
+        # (tên, hàm) theo thứ tự chạy, cho code chỉ cần hàm (bench-collectors.py)
+        self.collectors: List[Tuple[str, Callable[..., Dict[str, str]]]] = []
+        self._source = "builtin"
+
+    def add(self, name: str, function: Callable[..., Dict[str, str]], labels, **options) -> CollectorSpec:
+        """Đăng ký collector; raise ValueError nếu khai báo không hợp lệ.
+
+        Label chưa có trong LABEL_ORDER được thêm vào cuối (và vào WAKEUP_LABELS/DYNAMIC_LABELS
+        nếu display được chỉ định, màn hình chỉ hiển thị nếu firmware có widget cùng tên).
+        """
+        spec = CollectorSpec(name, function, tuple(labels), source=self._source, **options)
+        if name in self._by_name:
+            raise ValueError(f"collector {name} đã được đăng ký")
+        if spec.cost not in COLLECTOR_COSTS:
+            raise ValueError(f"cost của {name} phải là một trong {', '.join(COLLECTOR_COSTS)}")
+        if spec.display is not None and spec.display not in COLLECTOR_DISPLAY_GROUPS:
+            raise ValueError(f"display của {name} phải là một trong {', '.join(COLLECTOR_DISPLAY_GROUPS)}")
+        missing = [dependency for dependency in spec.depends if dependency not in self._by_name]
+        if missing:
+            raise ValueError(f"{name} phụ thuộc collector chưa đăng ký: {', '.join(missing)}")
+        taken = [label for label in spec.labels if label in self._label_owner]
+        if taken:
+            raise ValueError(f"label của {name} đã thuộc collector khác: {', '.join(taken)}")
+        for label in spec.labels:
+            self._label_owner[label] = name
+            if label not in LABEL_ORDER:
+                LABEL_ORDER.append(label)
+                if spec.display == "wakeup":
+                    WAKEUP_LABELS.append(label)
+                elif spec.display == "dynamic":
+                    DYNAMIC_LABELS.append(label)
+        self.specs.append(spec)
+        self._by_name[name] = spec
+        self.collectors.append((name, function))
+        return spec
+
+    def get(self, name: str) -> Optional[CollectorSpec]:
+        return self._by_name.get(name)
+
+    def names(self, flag: str) -> frozenset:
+        """Tên các collector có thuộc tính flag (isolate, optional, wakes_disks...) là True."""
+        return frozenset(spec.name for spec in self.specs if getattr(spec, flag))
+
+    def load_directory(self, directory: Path, verbose: bool = True) -> List[str]:
+        """Load plugin *.py trong directory (theo tên file); plugin lỗi bị bỏ qua kèm cảnh báo.
+
+        verbose=False (worker process): không in gì, daemon chính đã báo khi load cùng thư mục.
+
+        Returns:
+            Tên các collector plugin đã đăng ký
+        """
+        if not directory.is_dir():
+            return []
+        import importlib.util
+        loaded: List[str] = []
+        for path in sorted(directory.glob("*.py")):
+            before = len(self.specs)
+            self._source = path.name
+            try:
+                module_spec = importlib.util.spec_from_file_location(f"n4_plugin_{path.stem}", path)
+                module = importlib.util.module_from_spec(module_spec)
+                module_spec.loader.exec_module(module)
+                register = getattr(module, "register", None)
+                if register is None:
+                    raise ValueError("thiếu hàm register(registry)")
+                register(self)
+            except Exception as exc:
+                if verbose:
+                    print(f"⚠ Bỏ qua plugin {path.name}: {exc}", file=sys.stderr)
+                self._rollback(before)
+                continue
+            finally:
+                self._source = "builtin"
+            names = [spec.name for spec in self.specs[before:]]
+            loaded += names
+            if verbose:
+                print(f"✓ Plugin {path.name}: {', '.join(names) or '(không có collector)'}")
+        return loaded
+
+    def _rollback(self, count: int) -> None:
+        """Gỡ các collector đăng ký sau vị trí count (plugin lỗi giữa chừng)."""
+        for spec in self.specs[count:]:
+            del self._by_name[spec.name]
+            for label in spec.labels:
+                self._label_owner.pop(label, None)
+                for labels in (LABEL_ORDER, WAKEUP_LABELS, DYNAMIC_LABELS):
+                    if label in labels:
+                        labels.remove(label)
+        del self.specs[count:]
+        del self.collectors[count:]
+
+    def describe(self) -> List[Dict[str, object]]:
+        return [spec.describe() for spec in self.specs]
+
+
+def _numbered(template: str, numbers) -> Tuple[str, ...]:
+    return tuple(template.format(number) for number in numbers)
+
+
+COLLECTOR_REGISTRY = CollectorRegistry()
+# Thứ tự gọi trong aggregate_metrics: (tên, hàm)
+COLLECTORS = COLLECTOR_REGISTRY.collectors
+
+COLLECTOR_REGISTRY.add(
+    "storage", read_storage_volumes,
+    labels=_numbered("label_storage_{}", range(1, 5)) + _numbered("label_storage_total_{}", range(1, 5)),
+    cadence=30.0, isolate=True,
+)
+COLLECTOR_REGISTRY.add("fans", read_fan_speeds, labels=_numbered("label_fan{}_value", range(1, 8)), cost="cheap")
+COLLECTOR_REGISTRY.add(
+    "cpu", _collect_cpu, labels=("label_cpu_usage", "label_cpu_usage_per", "bar_cpu_usage"),
+    cost="cheap", essential=True, breaker=False,
+)
+COLLECTOR_REGISTRY.add(
+    "ram", _collect_ram, labels=("label_ram_usage", "label_ram_usage_per", "bar_ram_usage"),
+    cost="cheap", essential=True, breaker=False,
+)
+COLLECTOR_REGISTRY.add(
+    "gpu", _collect_gpu,
+    labels=("label_gpu_usage", "label_gpu_usage_per", "bar_gpu_usage", "label_gpu_fan_speed"),
+    optional=True, na_is_failure=True,
+)
+COLLECTOR_REGISTRY.add(
+    "disk_temps", read_disk_temps,
+    labels=_numbered("label_temp_drive{}", range(6)) + _numbered("label_temp_nvme{}", range(1, 6)),
+    isolate=True, wakes_disks=True,
+)
+COLLECTOR_REGISTRY.add(
+    "disk_status", read_disk_status,
+    labels=_numbered("label_status_drive{}", range(6)) + _numbered("label_status_nvme{}", range(1, 6)),
+    isolate=True, wakes_disks=True,
+)
+COLLECTOR_REGISTRY.add(
+    "system_temps", read_system_temps,
+    labels=_numbered("label_temp_{}", ("motherboard", "chipset", "cpu", "gpu", "ram")),
+)
+COLLECTOR_REGISTRY.add("system_info", read_system_info, labels=("label_hostname", "label_account"), cadence=60.0)
+COLLECTOR_REGISTRY.add(
+    "system_status", read_system_status,
+    labels=("label_system_status", "label_thermal_status", "label_power_status", "label_system_fan_status",
+            "label_upgrade_available", "label_version"),
+    cadence=30.0,
+)
+COLLECTOR_REGISTRY.add(
+    "network", read_network_speed,
+    labels=("label_download_total", "label_upload_total", "arc_download_total", "arc_upload_total"),
+    cost="wait", isolate=True, idle_seconds=NETWORK_SAMPLE_SECONDS,
+)
+COLLECTOR_REGISTRY.add(
+    "disk_io", read_disk_io, labels=("label_disk_iops", "label_disk_read", "label_disk_write"), isolate=True,
+)
+# ping trả N/A khi mất mạng, cần hiện lại ngay khi có mạng nên không dùng circuit breaker
+COLLECTOR_REGISTRY.add("ping", read_ping, labels=("label_ping_total",), cost="wait", optional=True, breaker=False)
+
+
+class CollectorStats:
+    """Thống kê thời gian chạy và lỗi của từng collector (thread-safe)."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    def record(self, name: str, duration: float, error: bool, na_labels: int) -> None:
+        """Ghi nhận một lần chạy collector.
+
+        Args:
+            name: Tên collector
+            duration: Thời gian chạy (giây)
+            error: True nếu collector raise exception
+            na_labels: Số label trả về "N/A"
+        """
+        with self._lock:
+            stats = self._stats.setdefault(
+                name,
+                {"runs": 0, "errors": 0, "duration_total": 0.0, "last_duration": 0.0,
+                 "last_run": 0.0, "na_labels": 0},
+            )
+            stats["runs"] += 1
+            stats["errors"] += 1 if error else 0
+            stats["duration_total"] += duration
+            stats["last_duration"] = duration
+            stats["last_run"] = time.time()
+            stats["na_labels"] = na_labels
+
+    def last_run(self, name: str) -> float:
+        """Thời điểm (time.time) lần chạy xong gần nhất của collector, 0 nếu chưa chạy."""
+        with self._lock:
+            return self._stats.get(name, {}).get("last_run", 0.0)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """Bản copy thống kê hiện tại, key là tên collector."""
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+
+class SnapshotStore:
+    """Snapshot metrics mới nhất, dùng chung giữa vòng lặp chính và HTTP server.
+
+    HTTP endpoint chỉ đọc snapshot đã có, KHÔNG BAO GIỜ tự gọi collector.
+    Giữ thêm snapshot liền trước (để tính delta) và collector sinh ra từng label.
+    """
+
+    def __init__(self):
+        self._changed = Condition(Lock())
+        self.metrics: Dict[str, str] = {}
+        self.previous: Dict[str, str] = {}
+        self.sources: Dict[str, str] = {}
+        self.stale: Dict[str, Optional[float]] = {}
+        self.timestamp = 0.0
+        self.seq = 0
+
+    def publish(
+        self,
+        metrics: Dict[str, str],
+        sources: Optional[Dict[str, str]] = None,
+        stale: Optional[Dict[str, Optional[float]]] = None,
+    ) -> None:
+        """Lưu snapshot mới (gọi sau mỗi lần aggregate_metrics) và đánh thức các stream client.
+
+        Args:
+            metrics: Snapshot metrics
+            sources: Map label -> tên collector đã sinh ra label đó
+            stale: Collector chưa xong trước deadline -> tuổi (giây) giá trị đang dùng
+        """
+        with self._changed:
+            self.previous = self.metrics
+            self.metrics = dict(metrics)
+            if sources is not None:
+                self.sources = dict(sources)
+            self.stale = dict(stale or {})
+            self.timestamp = time.time()
+            self.seq += 1
+            self._changed.notify_all()
+
+    def latest(self) -> Tuple[Dict[str, str], float, int]:
+        """Trả về (metrics, timestamp, seq) của snapshot mới nhất."""
+        with self._changed:
+            return self.metrics, self.timestamp, self.seq
+
+    def state(self) -> Tuple[Dict[str, str], Dict[str, str], Dict[str, str], Dict[str, Optional[float]], float, int]:
+        """Trả về (metrics, previous, sources, stale, timestamp, seq) nhất quán với nhau."""
+        with self._changed:
+            return self.metrics, self.previous, self.sources, self.stale, self.timestamp, self.seq
+
+    def wait_for_update(self, after_seq: int, timeout: float) -> int:
+        """Chờ tới khi có snapshot mới hơn after_seq (hoặc hết timeout), trả về seq hiện tại."""
+        with self._changed:
+            self._changed.wait_for(lambda: self.seq > after_seq, timeout)
+            return self.seq
+
+
+COLLECTOR_STATS = CollectorStats()
+SNAPSHOT_STORE = SnapshotStore()
+
+def quick_metrics() -> Dict[str, str]:
+    """Metrics từ collector cost="cheap" (chỉ đọc /proc, /sys), để màn hình có số liệu ngay khi vừa bật.
+
+    Không publish vào SNAPSHOT_STORE và không tính vào thống kê collector;
+    aggregate_metrics() của cùng tick sẽ đọc lại đầy đủ.
+    """
+    metrics: Dict[str, str] = {}
+    for spec in COLLECTOR_REGISTRY.specs:
+        if spec.cost == "cheap" and not spec.depends and not spec.pooled:
+            try:
+                metrics.update(spec.collect())
+            except Exception as exc:
+                print(f"⚠ Collector {spec.name} lỗi: {exc}", file=sys.stderr)
+    return metrics
+
+
+class CollectorJob:
+    """Một lần chạy collector, có thể trong thread riêng để tick không phải chờ nó."""
+
+    def __init__(self, name: str, collector: Callable[[], Dict[str, str]]):
+        self.name = name
+        self.collector = collector
+        self.done = Event()
+        self.values: Dict[str, str] = {}
+        self.error = False
+        self.duration = 0.0
+        self.cpu = 0.0
+
+    def run(self) -> None:
+        start = time.perf_counter()
+        start_cpu = thread_cpu_seconds()
+        try:
+            self.values = self.collector()
+        except Exception as exc:
+            print(f"⚠ Collector {self.name} lỗi: {exc}", file=sys.stderr)
+            self.error = True
+        self.duration = time.perf_counter() - start
+        self.cpu = thread_cpu_seconds() - start_cpu
+        self.done.set()
+
+
+class CollectorRunner:
+    """Deadline cứng cho mỗi tick (--tick-deadline).
+
+    Collector vẫn chạy lần lượt (trừ cost="wait", được start() từ đầu tick để chạy song song),
+    nhưng mỗi collector chạy trong thread riêng và tick chỉ chờ tới deadline. Collector chưa xong
+    được để chạy tiếp ở background (không chạy chồng lần nữa): tick dùng giá trị lần trước và
+    đánh dấu stale, kết quả về muộn được gộp vào tick sau.
+    deadline <= 0 hoặc đang profile thì chạy trực tiếp trong thread gọi như trước.
+    """
+
+    def __init__(self, deadline: float = 0.0):
+        self.deadline = deadline
+        self.inflight: Dict[str, CollectorJob] = {}
+
+    def tick_deadline(self) -> Optional[float]:
+        """Thời điểm (time.monotonic) tick phải xong, None nếu không giới hạn."""
+        if self.deadline <= 0 or TICK_PROFILER.active:
+            return None
+        return time.monotonic() + self.deadline
+
+    def run(self, name: str, collector: Callable[[], Dict[str, str]], deadline_at: Optional[float]) -> Optional[CollectorJob]:
+        """Chạy collector, trả về job đã xong hoặc None nếu chưa xong trước deadline.
+
+        Nếu lần chạy trước bị trễ và đã xong thì trả về luôn kết quả đó (không chạy lại),
+        nếu vẫn đang chạy thì trả về None.
+        """
+        job = self.inflight.get(name)
+        if job is not None:
+            if not job.done.is_set():
+                return None
+            del self.inflight[name]
+            return job
+        if deadline_at is None:
+            job = CollectorJob(name, collector)
+            job.run()
+            return job
+        return self.wait(self.start(name, collector), deadline_at)
+
+    def start(self, name: str, collector: Callable[[], Dict[str, str]]) -> CollectorJob:
+        """Chạy collector trong thread riêng, không chờ; job nằm trong inflight tới khi lấy kết quả."""
+        job = self.inflight[name] = CollectorJob(name, collector)
+        Thread(target=job.run, name=f"collector-{name}", daemon=True).start()
+        return job
+
+    def wait(self, job: CollectorJob, deadline_at: float) -> Optional[CollectorJob]:
+        """Chờ job tới deadline, trả về job nếu xong, None nếu vẫn chạy (để lại trong inflight)."""
+        if job.done.wait(max(0.0, deadline_at - time.monotonic())):
+            self.inflight.pop(job.name, None)
+            return job
+        SELF_METRICS.inc("collector_deadline_misses", job.name)
+        print(f"⚠ Collector {job.name} chưa xong sau deadline {self.deadline:g}s, dùng giá trị cũ", file=sys.stderr)
+        return None
+
+    def status(self) -> Dict[str, object]:
+        """Deadline và các collector đang chạy trễ ở background (cho /api/self)."""
+        return {"seconds": self.deadline, "inflight": sorted(list(self.inflight))}
+
+
+COLLECTOR_RUNNER = CollectorRunner()
+
+
+# ---------------------------------------------------------------------------
+# Worker process cho collector gọi lệnh ngoài (synodisk, nvme, snmpwalk, iostat, ethtool)
+# ---------------------------------------------------------------------------
+
+WORKER_POOL_SIZE = 2
+WORKER_CALL_TIMEOUT = 30.0  # Lớn hơn tổng timeout subprocess của disk_temps (synodisk + nvme)
+WORKER_MAX_CALLS = 500
+
+
+class CollectorWorker:
+    """Một worker process (read_sensor.py --collector-worker), nhận yêu cầu qua stdin
+    và trả về kết quả qua stdout (mỗi dòng một JSON)."""
+
+    def __init__(self):
+        env = dict(os.environ)
+        env.update({HOST_ROOT_KIND_ENV[kind]: str(path) for kind, path in HOST_ROOTS.items()})
+        env[METRICS_SCOPE_ENV] = "cgroup" if CGROUP_READER is not None else "host"
+        if COLLECTOR_POOL.plugin_dir is not None:
+            env[PLUGIN_DIR_ENV] = str(COLLECTOR_POOL.plugin_dir)
+        self.process = subprocess.Popen(
+            [sys.executable, str(Path(__file__).resolve()), "--collector-worker"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env,
+            bufsize=0,
+            start_new_session=True,  # Process group riêng: kill cả lệnh con đang treo, không nhận Ctrl+C
+        )
+        self.calls = 0
+        self.cpu_seconds = 0.0  # CPU worker đã báo về (chưa có trong os.times() tới khi được reap)
+        self.breakers: Dict[str, Dict[str, object]] = {}  # Circuit breaker của lệnh chạy trong worker
+        self._buffer = b""
+
+    def call(self, name: str, inputs: Optional[Dict[str, str]], timeout: float) -> Dict[str, object]:
+        """Chạy collector trong worker, raise TimeoutError nếu quá timeout, OSError nếu worker chết."""
+        request = {"collector": name, "inputs": inputs}
+        self.process.stdin.write(json.dumps(request, ensure_ascii=False).encode("utf-8") + b"\n")
+        deadline = time.monotonic() + timeout
+        fd = self.process.stdout.fileno()
+        while b"\n" not in self._buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise TimeoutError(f"quá {timeout:g}s")
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise OSError(f"worker {self.process.pid} đã thoát ({self.process.poll()})")
+            self._buffer += chunk
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        self.calls += 1
+        return json.loads(line.decode("utf-8"))
+
+    def stop(self, kill: bool) -> None:
+        """Đóng stdin (worker tự thoát) hoặc kill ngay cả worker lẫn lệnh con (worker đang treo)."""
+        try:
+            if kill and self.process.poll() is None:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+
+class CollectorPool:
+    """Pool nhỏ các worker process sống lâu cho collector có thể treo (ổ hỏng, snmpd kẹt...).
+
+    Syscall kẹt ở trạng thái D trong worker không làm treo daemon: mỗi lần gọi có timeout,
+    worker quá timeout bị kill và thay bằng worker mới; worker cũng được thay sau max_calls lần
+    gọi. Worker bị kill được reap ở lần gọi sau, không bao giờ chờ.
+    """
+
+    def __init__(self, size: int = WORKER_POOL_SIZE, timeout: float = WORKER_CALL_TIMEOUT,
+                 max_calls: int = WORKER_MAX_CALLS):
+        self.size = size
+        self.timeout = timeout
+        self.max_calls = max_calls
+        self.names: frozenset = frozenset()
+        self._changed = Condition(Lock())
+        self._idle: List[CollectorWorker] = []
+        self._alive = 0  # Worker rảnh + đang chạy
+        self._retired: List[CollectorWorker] = []  # Đã stop, chờ reap
+        self.cpu_seconds = 0.0  # CPU của worker chưa reap (cộng vào process_cpu_seconds)
+        self._local = local()  # CPU worker đã báo về, theo thread gọi (cho thread_cpu_seconds)
+        self.plugin_dir: Optional[Path] = None  # Worker load cùng thư mục plugin với daemon
+
+    def install(self, names: frozenset) -> None:
+        """Chuyển các collector trong names sang chạy qua pool (CollectorSpec.pooled)."""
+        self.names = names
+        for spec in COLLECTOR_REGISTRY.specs:
+            spec.pooled = spec.name in names
+
+    def thread_cpu(self) -> float:
+        """Tổng CPU mà worker đã báo về cho các lần gọi từ thread hiện tại."""
+        return getattr(self._local, "cpu", 0.0)
+
+    def _reap(self) -> None:
+        """Gỡ worker đã thoát; CPU của nó giờ nằm trong os.times().children_*. Gọi khi giữ lock."""
+        for worker in [w for w in self._retired if w.process.poll() is not None]:
+            self._retired.remove(worker)
+            self.cpu_seconds -= worker.cpu_seconds
+            worker.process.stdout.close()
+
+    def _acquire(self) -> CollectorWorker:
+        with self._changed:
+            self._reap()
+            if not self._changed.wait_for(lambda: self._idle or self._alive < self.size, self.timeout):
+                raise TimeoutError(f"không có worker rảnh sau {self.timeout:g}s")
+            if self._idle:
+                return self._idle.pop()
+            self._alive += 1
+        try:
+            worker = CollectorWorker()
+        except OSError:
+            with self._changed:
+                self._alive -= 1
+                self._changed.notify()
+            raise
+        SELF_METRICS.inc("worker_spawns")
+        return worker
+
+    def _release(self, worker: CollectorWorker, retire: bool, kill: bool = False) -> None:
+        if retire:
+            worker.stop(kill)
+        with self._changed:
+            if retire:
+                self._alive -= 1
+                self._retired.append(worker)
+            else:
+                self._idle.append(worker)
+            self._changed.notify()
+
+    def call(self, name: str, inputs: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+        """Chạy collector trong một worker, raise nếu worker treo/chết hoặc collector lỗi."""
+        worker = self._acquire()
+        try:
+            reply = worker.call(name, inputs, self.timeout)
+        except TimeoutError:
+            SELF_METRICS.inc("worker_timeouts", name)
+            self._release(worker, retire=True, kill=True)
+            raise
+        except (OSError, ValueError):
+            SELF_METRICS.inc("worker_errors", name)
+            self._release(worker, retire=True, kill=True)
+            raise
+        with self._changed:
+            worker.cpu_seconds += reply["cpu"]
+            self.cpu_seconds += reply["cpu"]
+            worker.breakers = reply["breakers"]
+        self._local.cpu = self.thread_cpu() + reply["cpu"]
+        for event, kind, event_name, amount in reply["events"]:
+            if event == "observe":
+                SELF_METRICS.observe(kind, event_name, amount)
+            else:
+                SELF_METRICS.inc(kind, event_name, amount)
+        recycle = worker.calls >= self.max_calls
+        if recycle:
+            SELF_METRICS.inc("worker_recycles")
+        self._release(worker, retire=recycle)
+        if reply["error"]:
+            raise RuntimeError(reply["error"])
+        return reply["values"]
+
+    def close(self) -> None:
+        """Dừng mọi worker rảnh (gọi khi thoát; worker đang chạy tự thoát khi stdin đóng)."""
+        with self._changed:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.stop(kill=True)
+
+    def breaker_status(self) -> Dict[str, Dict[str, object]]:
+        """Circuit breaker của lệnh chạy trong các worker rảnh (theo lần báo gần nhất)."""
+        with self._changed:
+            merged: Dict[str, Dict[str, object]] = {}
+            for worker in self._idle:
+                merged.update(worker.breakers)
+            return merged
+
+    def status(self) -> Dict[str, object]:
+        """Trạng thái pool cho /api/self."""
+        with self._changed:
+            return {
+                "collectors": sorted(self.names),
+                "alive": self._alive,
+                "idle": [worker.process.pid for worker in self._idle],
+                "retired": [worker.process.pid for worker in self._retired],
+            }
+
+
+COLLECTOR_POOL = CollectorPool()
+
+
+def plugin_directory(value: Optional[str] = None) -> Path:
+    """Thư mục plugin: --plugin-dir > env N4_PLUGIN_DIR > collectors.d cạnh script."""
+    return Path(value or os.environ.get(PLUGIN_DIR_ENV) or Path(__file__).resolve().parent / PLUGIN_DIR_NAME)
+
+
+def run_collector_worker(plugin_dir: Optional[Path]) -> None:
+    """Vòng lặp của worker process: mỗi dòng stdin là {"collector", "inputs"}, trả về một dòng JSON.
+
+    stdout thật chỉ dùng cho kết quả; print của collector (và của plugin) được chuyển sang stderr.
+    Thoát khi stdin đóng (daemon dừng hoặc recycle worker).
+    """
+    replies = os.fdopen(os.dup(1), "w", encoding="utf-8")
+    os.dup2(2, 1)
+    if plugin_dir is not None:
+        COLLECTOR_REGISTRY.load_directory(plugin_dir, verbose=False)
+    for line in sys.stdin:
+        request = json.loads(line)
+        SELF_METRICS.journal = []
+        start_cpu = process_cpu_seconds()
+        values: Dict[str, str] = {}
+        error = None
+        try:
+            values = COLLECTOR_REGISTRY.get(request["collector"]).collect(request["inputs"])
+        except Exception as exc:
+            error = f"{type(exc).__name__}: {exc}"
+        reply = {
+            "values": values,
+            "error": error,
+            "cpu": process_cpu_seconds() - start_cpu,
+            "events": SELF_METRICS.journal,
+            "breakers": BREAKERS.status(),
+        }
+        try:
+            replies.write(json.dumps(reply, ensure_ascii=False) + "\n")
+            replies.flush()
+        except BrokenPipeError:
+            return  # Daemon đã đóng pipe (dừng hoặc bỏ worker quá hạn)
+
+# Main loop và warm cache (thread riêng) không thu thập đồng thời
+AGGREGATE_LOCK = Lock()
+
+
+def aggregate_metrics(skip: frozenset = frozenset()) -> Dict[str, str]:
     """Thu thập tất cả metrics và trả về dictionary.
     
-    Gọi tất cả các hàm đọc sensor và format metrics, sau đó đảm bảo tất cả labels
-    trong LABEL_ORDER đều có trong dictionary (mặc định "N/A" nếu thiếu).
+    Gọi các collector trong COLLECTOR_REGISTRY theo thứ tự đăng ký (đo thời gian, đếm lỗi),
+    collector cost="wait" chạy song song từ đầu tick, sau đó đảm bảo tất cả labels trong
+    LABEL_ORDER đều có trong dictionary (mặc định "N/A" nếu thiếu).
+    Collector chưa tới cadence, bị TICK_BUDGET giãn chu kỳ hoặc có circuit breaker đang mở
+    (BREAKERS) dùng lại giá trị lần chạy trước.
+    Kết quả cũng được publish vào SNAPSHOT_STORE cho HTTP API.
     
+    Args:
+        skip: Collector không chạy lần này, dùng lại giá trị lần chạy trước
+            (ví dụ collector wakes_disks khi ổ đang standby)
+
     Returns:
         Dictionary chứa tất cả metrics theo thứ tự LABEL_ORDER
     """
+    with AGGREGATE_LOCK:
+        return _collect_metrics(skip)
+
+
+def _reused_values(spec: CollectorSpec, skip: frozenset) -> Tuple[Optional[Dict[str, str]], bool]:
+    """Giá trị dùng lại nếu collector không chạy ở tick này (None nếu cần chạy hoặc có kết quả trễ),
+    kèm cờ stale (giá trị cũ vì collector đang lỗi, không phải vì chưa tới lượt)."""
+    name = spec.name
+    if name in skip:
+        return TICK_BUDGET.last_values.get(name, {}), False
+    if not TICK_BUDGET.should_run(name):
+        return TICK_BUDGET.cached(name), False
+    if name in COLLECTOR_RUNNER.inflight:
+        return None, False
+    if spec.cadence:
+        last_run = COLLECTOR_STATS.last_run(name)
+        if last_run and time.time() - last_run < spec.cadence:
+            return TICK_BUDGET.last_values.get(name, {}), False
+    if spec.breaker and not BREAKERS.allow(f"collector:{name}"):
+        # Collector lỗi liên tục (breaker mở): dùng lại giá trị lần trước, không chạy
+        return TICK_BUDGET.last_values.get(name, {}), True
+    return None, False
+
+
+def _stale_age(name: str) -> Optional[float]:
+    """Tuổi (giây) của giá trị lần chạy trước, None nếu collector chưa chạy lần nào."""
+    last_run = COLLECTOR_STATS.last_run(name)
+    return round(time.time() - last_run, 1) if last_run else None
+
+
+def _collect_metrics(skip: frozenset) -> Dict[str, str]:
+    """Thân aggregate_metrics() (gọi khi đã giữ AGGREGATE_LOCK)."""
     metrics: Dict[str, str] = {}
+    sources: Dict[str, str] = {}
     
-    # Read all sensor data
-    metrics.update(read_storage_volumes())
-    metrics.update(read_fan_speeds())
-    
-    cpu_clock = read_cpu_clock_ghz()
-    cpu_usage = read_cpu_usage()
-    metrics.update(format_cpu_metrics(cpu_clock, cpu_usage))
+    stale: Dict[str, Optional[float]] = {}
+    busy_seconds = 0.0
+    deadline_at = COLLECTOR_RUNNER.tick_deadline()
+    reused = {spec.name: _reused_values(spec, skip) for spec in COLLECTOR_REGISTRY.specs}
     
-    ram_info = read_ram_info()
-    metrics.update(format_ram_metrics(ram_info))
-    
-    gpu_clock = read_gpu_clock_mhz()
-    gpu_usage, gpu_fan_speed = read_gpu_usage_percent()
-    metrics.update(format_gpu_metrics(gpu_clock, gpu_usage, gpu_fan_speed))
+    # Collector cost="wait" (chủ yếu chờ) chạy song song với phần còn lại của tick
+    started: Dict[str, CollectorJob] = {}
+    if deadline_at is not None:
+        for spec in COLLECTOR_REGISTRY.specs:
+            if spec.cost == "wait" and not spec.depends and reused[spec.name][0] is None \
+                    and spec.name not in COLLECTOR_RUNNER.inflight:
+                started[spec.name] = COLLECTOR_RUNNER.start(spec.name, spec.collect)
     
-    metrics.update(read_disk_temps())
-    metrics.update(read_disk_status())
-    metrics.update(read_system_temps())
-    metrics.update(read_system_info())
-    metrics.update(read_system_status())
-    metrics.update(read_network_speed())
-    metrics.update(read_disk_io())
-    metrics.update(read_ping())
+    # Read all sensor data
+    for spec in COLLECTOR_REGISTRY.specs:
+        name = spec.name
+        values, breaker_open = reused[name]
+        if values is not None:
+            metrics.update(values)
+            sources.update(dict.fromkeys(values, name))
+            if breaker_open:
+                stale[name] = _stale_age(name)
+            continue
+        if name in started:
+            job = COLLECTOR_RUNNER.wait(started[name], deadline_at)
+        else:
+            inputs = {
+                label: metrics[label]
+                for dependency in spec.depends
+                for label in COLLECTOR_REGISTRY.get(dependency).labels
+                if label in metrics
+            }
+            job = COLLECTOR_RUNNER.run(name, lambda spec=spec, inputs=inputs: spec.collect(inputs), deadline_at)
+        if job is None:
+            # Chưa xong trước deadline: giá trị lần trước, đánh dấu stale kèm tuổi
+            values = TICK_BUDGET.last_values.get(name, {})
+            metrics.update(values)
+            sources.update(dict.fromkeys(values, name))
+            stale[name] = _stale_age(name)
+            continue
+        values = job.values
+        busy_seconds += TICK_BUDGET.record(name, job.duration, job.cpu, values)
+        metrics.update(values)
+        sources.update(dict.fromkeys(values, name))
+        na_labels = sum(1 for value in values.values() if value == "N/A")
+        if spec.breaker:
+            if job.error or (spec.na_is_failure and values and na_labels == len(values)):
+                BREAKERS.failure(f"collector:{name}")
+            else:
+                BREAKERS.success(f"collector:{name}")
+        COLLECTOR_STATS.record(name, job.duration, job.error, na_labels)
+        SELF_METRICS.observe("collector", name, job.duration)
+        if job.error:
+            SELF_METRICS.inc("collector_errors", name)
+    TICK_BUDGET.end_tick(busy_seconds)
     
     # Ensure all labels exist
     for label in LABEL_ORDER:
         metrics.setdefault(label, "N/A")
     
+    SNAPSHOT_STORE.publish(metrics, sources, stale)
+    METRIC_HISTORY.record(metrics, time.time())
     return metrics
 
 
-def _format_metrics_payload(metrics: Dict[str, str], labels: List[str]) -> str:
-    """Format metrics thành chuỗi theo thứ tự labels được chỉ định.
-    
-    Args:
-        metrics: Dictionary chứa tất cả metrics
-        labels: Danh sách label cần format (có thể là WAKEUP_LABELS hoặc DYNAMIC_LABELS)
-    
-    Returns:
-        Chuỗi đã format với các dòng "label: value"
-    """
-    lines = [f"{label}: {metrics[label]}" for label in labels]
-    return "\n".join(lines) + "\n"
+# ---------------------------------------------------------------------------
+# Warm cache: đọc metrics chậm khi màn hình tắt để wake up gửi được ngay
+# ---------------------------------------------------------------------------
 
+# Block device nguyên ổ trong /proc/diskstats (bỏ qua partition)
+WHOLE_DISK_RE = re.compile(r"^(sd[a-z]+|sata\d+|hd[a-z]+|x?vd[a-z]+|nvme\d+n\d+)$")
 
-def _format_all_metrics_payload(metrics: Dict[str, str]) -> str:
-    """Format tất cả metrics thành chuỗi theo thứ tự LABEL_ORDER (tương thích với code cũ)."""
+
+def read_disk_activity() -> Optional[int]:
+    """Tổng số lần đọc + ghi đã hoàn tất của các ổ trong /proc/diskstats, None nếu không đọc được."""
+    try:
+        total = 0
+        for line in proc_path("diskstats").read_text(encoding="utf-8").splitlines():
+            fields = line.split()
+            if len(fields) > 7 and WHOLE_DISK_RE.match(fields[2]):
+                total += int(fields[3]) + int(fields[7])
+        return total
+    except (OSError, ValueError):
+        return None
+
+
+class WarmCache:
+    """Background thread giữ snapshot "ấm" khi không có màn hình local nào đang bật.
+
+    Mỗi interval giây (tính từ snapshot gần nhất, kể cả của main loop) gọi aggregate_metrics()
+    để SNAPSHOT_STORE luôn có số liệu gần đây; khi màn hình bật, main loop gửi ngay snapshot
+    này thay vì chờ thu thập. Các collector đọc SMART chỉ chạy nếu ổ có I/O kể từ lần
+    refresh trước (ổ đang quay), để không đánh thức ổ đang standby.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.idle = Event()  # Set bởi main loop khi không có màn hình local nào bật
+        self.refreshes = 0
+        self._disk_activity: Optional[int] = None
+
+    def start(self) -> None:
+        """Start refresher trong daemon thread."""
+        Thread(target=self.run, daemon=True).start()
+
+    def run(self) -> None:
+        """Vòng lặp refresher (chạy trong background thread)."""
+        while True:
+            self.idle.wait()
+            _, timestamp, seq = SNAPSHOT_STORE.latest()
+            age = time.time() - timestamp if seq else self.interval
+            if age < self.interval:
+                time.sleep(self.interval - age)
+                continue
+            try:
+                self.refresh()
+            except Exception as exc:
+                print(f"⚠ Warm cache lỗi: {exc}", file=sys.stderr)
+                time.sleep(self.interval)
+
+    def refresh(self) -> None:
+        """Đọc lại metrics một lần (bỏ collector SMART nếu ổ không có I/O)."""
+        activity = read_disk_activity()
+        disks_active = activity is not None and self._disk_activity is not None and activity != self._disk_activity
+        # Collector đọc SMART (wakes_disks) có thể đánh thức ổ đang standby
+        aggregate_metrics(skip=frozenset() if disks_active else COLLECTOR_REGISTRY.names("wakes_disks"))
+        self._disk_activity = read_disk_activity()
+        self.refreshes += 1
+
+    def snapshot(self) -> Optional[Dict[str, str]]:
+        """Snapshot mới nhất nếu đủ mới (không quá 2 chu kỳ refresh), ngược lại None."""
+        metrics, timestamp, seq = SNAPSHOT_STORE.latest()
+        if seq and time.time() - timestamp <= self.interval * 2:
+            return metrics
+        return None
+
+
+# ---------------------------------------------------------------------------
+# Budget CPU/thời gian mỗi tick: giãn chu kỳ collector đắt, bỏ collector tùy chọn
+# ---------------------------------------------------------------------------
+
+# Chu kỳ tối đa khi giãn (collector chạy 1 lần mỗi N tick)
+BUDGET_MAX_STRIDE = 16
+# Vượt budget liên tiếp N tick thì giãn thêm một bước
+BUDGET_DEGRADE_TICKS = 3
+# Dưới BUDGET_RECOVER_RATIO * budget liên tiếp N tick thì hoàn lại một bước
+BUDGET_RECOVER_TICKS = 10
+BUDGET_RECOVER_RATIO = 0.7
+BUDGET_EWMA_ALPHA = 0.3
+
+
+def process_cpu_seconds() -> float:
+    """CPU time của process (user + system), kể cả các process con đã kết thúc (synodisk, snmpwalk...)
+    và worker process còn sống."""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system + COLLECTOR_POOL.cpu_seconds
+
+
+def thread_cpu_seconds() -> float:
+    """CPU time của thread hiện tại, kể cả process con đã kết thúc và phần chạy trong worker process.
+
+    Dùng để đo chi phí từng collector khi nhiều collector chạy song song.
+    """
+    times = os.times()
+    return time.thread_time() + times.children_user + times.children_system + COLLECTOR_POOL.thread_cpu()
+
+
+def _ewma(previous: Optional[float], value: float) -> float:
+    return value if previous is None else previous + BUDGET_EWMA_ALPHA * (value - previous)
+
+
+class TickBudget:
+    """Giữ CPU% của daemon và thời gian thu thập mỗi tick trong budget.
+
+    aggregate_metrics() hỏi should_run() trước mỗi collector và báo chi phí qua record().
+    Cuối tick, nếu CPU% (EWMA, tính cả thời gian sleep giữa các tick) hoặc thời gian bận
+    của tick (EWMA) vượt budget BUDGET_DEGRADE_TICKS tick liên tiếp, collector có chi phí
+    trung bình mỗi tick cao nhất bị giãn chu kỳ gấp đôi (collector tùy chọn thì bị bỏ).
+    Khi đã dưới budget đủ lâu, các bước được hoàn lại theo thứ tự ngược.
+    Collector bị giãn dùng lại giá trị của lần chạy trước.
+    """
+
+    def __init__(self, max_cpu_percent: float = 0.0, max_tick_seconds: float = 0.0):
+        self.max_cpu_percent = max_cpu_percent
+        self.max_tick_seconds = max_tick_seconds
+        self.tick = 0
+        self.strides: Dict[str, int] = {}
+        self.skipped: set = set()
+        self.actions: List[str] = []  # Các bước đã giãn/bỏ, để hoàn lại theo thứ tự ngược
+        self.cost_cpu: Dict[str, float] = {}
+        self.cost_wall: Dict[str, float] = {}
+        self.last_run: Dict[str, int] = {}
+        self.last_values: Dict[str, Dict[str, str]] = {}
+        self.cpu_percent: Optional[float] = None
+        self.tick_seconds: Optional[float] = None
+        self._over = 0
+        self._under = 0
+        self._mark: Optional[Tuple[float, float]] = None  # (monotonic, cpu) cuối tick trước
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_cpu_percent > 0 or self.max_tick_seconds > 0
+
+    def should_run(self, name: str) -> bool:
+        """Collector có đến lượt chạy ở tick này không."""
+        if name in self.skipped:
+            return False
+        last = self.last_run.get(name)
+        return last is None or self.tick - last >= self.strides.get(name, 1)
+
+    def cached(self, name: str) -> Dict[str, str]:
+        """Giá trị dùng lại cho collector không chạy tick này (rỗng nếu bị bỏ => "N/A")."""
+        return {} if name in self.skipped else self.last_values.get(name, {})
+
+    def record(self, name: str, wall: float, cpu: float, values: Dict[str, str]) -> float:
+        """Ghi chi phí một lần chạy collector.
+
+        Returns:
+            Thời gian bận (wall trừ thời gian chờ có chủ đích) tính vào budget
+        """
+        # Thời gian chờ có chủ đích trong collector (idle_seconds) không phải tải
+        spec = COLLECTOR_REGISTRY.get(name)
+        busy = max(0.0, wall - (spec.idle_seconds if spec else 0.0))
+        self.last_run[name] = self.tick
+        self.last_values[name] = values
+        self.cost_cpu[name] = _ewma(self.cost_cpu.get(name), cpu)
+        self.cost_wall[name] = _ewma(self.cost_wall.get(name), busy)
+        return busy
+
+    def end_tick(self, busy_seconds: float) -> None:
+        """Cập nhật CPU%/thời gian tick và giãn/hoàn lại một bước nếu cần."""
+        now, cpu = time.monotonic(), process_cpu_seconds()
+        if self._mark is not None and now > self._mark[0]:
+            self.cpu_percent = _ewma(self.cpu_percent, (cpu - self._mark[1]) / (now - self._mark[0]) * 100.0)
+        self._mark = (now, cpu)
+        self.tick_seconds = _ewma(self.tick_seconds, busy_seconds)
+        self.tick += 1
+        if not self.enabled or self.cpu_percent is None:
+            return
+
+        cpu_over = self.max_cpu_percent > 0 and self.cpu_percent > self.max_cpu_percent
+        wall_over = self.max_tick_seconds > 0 and self.tick_seconds > self.max_tick_seconds
+        if cpu_over or wall_over:
+            self._under = 0
+            self._over += 1
+            if self._over >= BUDGET_DEGRADE_TICKS:
+                self._over = 0
+                reason = (f"CPU {self.cpu_percent:.1f}% > {self.max_cpu_percent:g}%" if cpu_over
+                          else f"tick {self.tick_seconds * 1000:.0f} ms > {self.max_tick_seconds * 1000:.0f} ms")
+                self._degrade(self.cost_cpu if cpu_over else self.cost_wall, reason)
+            return
+
+        self._over = 0
+        cpu_low = self.max_cpu_percent <= 0 or self.cpu_percent < self.max_cpu_percent * BUDGET_RECOVER_RATIO
+        wall_low = self.max_tick_seconds <= 0 or self.tick_seconds < self.max_tick_seconds * BUDGET_RECOVER_RATIO
+        if self.actions and cpu_low and wall_low:
+            self._under += 1
+            if self._under >= BUDGET_RECOVER_TICKS:
+                self._under = 0
+                self._recover()
+        else:
+            self._under = 0
+
+    def _degrade(self, costs: Dict[str, float], reason: str) -> None:
+        """Giãn gấp đôi (hoặc bỏ, nếu là collector tùy chọn) collector đắt nhất tính theo mỗi tick."""
+        candidates = [
+            (cost / self.strides.get(name, 1), name)
+            for name, cost in costs.items()
+            if not COLLECTOR_REGISTRY.get(name).essential and name not in self.skipped
+            and self.strides.get(name, 1) < BUDGET_MAX_STRIDE
+        ]
+        if not candidates:
+            return
+        _, name = max(candidates)
+        if COLLECTOR_REGISTRY.get(name).optional:
+            self.skipped.add(name)
+            action = "bỏ qua"
+        else:
+            self.strides[name] = self.strides.get(name, 1) * 2
+            action = f"chạy mỗi {self.strides[name]} tick"
+        self.actions.append(name)
+        SELF_METRICS.inc("budget_degrade", name)
+        print(f"⚠ Vượt budget ({reason}): {name} {action}")
+
+    def _recover(self) -> None:
+        """Hoàn lại bước giãn gần nhất."""
+        name = self.actions.pop()
+        if name in self.skipped:
+            self.skipped.discard(name)
+        else:
+            self.strides[name] = max(1, self.strides.get(name, 1) // 2)
+            if self.strides[name] == 1:
+                del self.strides[name]
+        SELF_METRICS.inc("budget_recover", name)
+        print(f"✓ Đã dưới budget: khôi phục {name}" + (f" (mỗi {self.strides[name]} tick)" if name in self.strides else ""))
+
+    def status(self) -> Dict[str, object]:
+        """Trạng thái degradation cho /api/self."""
+        return {
+            "enabled": self.enabled,
+            "max_cpu_percent": self.max_cpu_percent or None,
+            "max_tick_ms": self.max_tick_seconds * 1000 or None,
+            "cpu_percent": None if self.cpu_percent is None else round(self.cpu_percent, 2),
+            "tick_ms": None if self.tick_seconds is None else round(self.tick_seconds * 1000, 1),
+            "level": len(self.actions),
+            "strides": dict(self.strides),
+            "skipped": sorted(self.skipped),
+        }
+
+    def prometheus_lines(self) -> List[str]:
+        lines = [
+            "# HELP jonsbo_budget_level Số bước degradation đang áp dụng (0 = bình thường)",
+            "# TYPE jonsbo_budget_level gauge",
+            f"jonsbo_budget_level {len(self.actions)}",
+            "# HELP jonsbo_collector_stride Collector chạy 1 lần mỗi N tick (0 = đang bị bỏ qua)",
+            "# TYPE jonsbo_collector_stride gauge",
+        ]
+        for name, _ in COLLECTORS:
+            stride = 0 if name in self.skipped else self.strides.get(name, 1)
+            lines.append(f'jonsbo_collector_stride{{collector="{name}"}} {stride}')
+        if self.cpu_percent is not None:
+            lines.append("# HELP jonsbo_process_cpu_percent CPU% của daemon (EWMA, % của một core)")
+            lines.append("# TYPE jonsbo_process_cpu_percent gauge")
+            lines.append(f"jonsbo_process_cpu_percent {self.cpu_percent!r}")
+        return lines
+
+
+TICK_BUDGET = TickBudget()
+
+
+# ---------------------------------------------------------------------------
+# Giá trị số từ chuỗi hiển thị + Prometheus exporter
+# ---------------------------------------------------------------------------
+
+# Giá trị hiển thị: số + đơn vị (đơn vị dài đặt trước để regex không match nhầm)
+METRIC_VALUE_RE = re.compile(
+    r"^\s*(-?\d+(?:\.\d+)?)\s*(MB/s|Mbps|Kbps|GHz|MHz|RPM|°C|ms|%|TB|GB|MB|KB|Tb|Gb|B)?\s*$"
+)
+
+# Đơn vị hiển thị -> (đơn vị chuẩn, hệ số nhân)
+METRIC_UNIT_SCALE: Dict[str, Tuple[str, float]] = {
+    "%": ("percent", 1.0),
+    "°C": ("celsius", 1.0),
+    "RPM": ("rpm", 1.0),
+    "GHz": ("hertz", 1e9),
+    "MHz": ("hertz", 1e6),
+    "Tb": ("bytes", 1024.0 ** 4),
+    "Gb": ("bytes", 1024.0 ** 3),
+    "TB": ("bytes", 1024.0 ** 4),
+    "GB": ("bytes", 1024.0 ** 3),
+    "MB": ("bytes", 1024.0 ** 2),
+    "KB": ("bytes", 1024.0),
+    "B": ("bytes", 1.0),
+    "Mbps": ("bits_per_second", 1024.0 * 1024.0),
+    "Kbps": ("bits_per_second", 1024.0),
+    "MB/s": ("bytes_per_second", 1024.0 * 1024.0),
+    "ms": ("seconds", 0.001),
+}
+
+# Các label hiển thị status dạng chữ (map ngược về mã số SNMP)
+STATUS_TEXT_LABELS: Dict[str, Dict[int, str]] = {
+    "label_system_status": SYSTEM_STATUS_MAP,
+    "label_thermal_status": SYSTEM_STATUS_MAP,
+    "label_power_status": SYSTEM_STATUS_MAP,
+    "label_system_fan_status": SYSTEM_STATUS_MAP,
+    "label_upgrade_available": UPGRADE_STATUS_MAP,
+}
+
+# Các label chỉ là chuỗi thông tin (không có giá trị số)
+INFO_LABELS = ("label_hostname", "label_account", "label_version")
+
+
+def parse_metric_value(label: str, value: str) -> Optional[Tuple[float, str]]:
+    """Chuyển giá trị hiển thị (ví dụ "45°C", "1.5 GB / 16.0 GB", "12.3 Mbps") về số + đơn vị chuẩn.
+
+    Args:
+        label: Tên label (để xử lý các label đặc biệt như status)
+        value: Chuỗi giá trị đã format cho màn hình
+
+    Returns:
+        Tuple (giá trị theo đơn vị chuẩn, tên đơn vị) hoặc None nếu không có giá trị số
+        (ví dụ "N/A", hostname). Đơn vị chuẩn: percent, celsius, rpm, hertz, bytes,
+        bits_per_second, bytes_per_second, seconds, status hoặc "" (không đơn vị).
+    """
+    if not value or value == "N/A" or label in INFO_LABELS:
+        return None
+
+    status_map = STATUS_TEXT_LABELS.get(label)
+    if status_map is not None:
+        for code, text in status_map.items():
+            if value == text:
+                return float(code), "status"
+        try:
+            return float(int(value)), "status"
+        except ValueError:
+            return None
+
+    # "used / total" -> lấy phần used
+    if " / " in value:
+        value = value.split(" / ", 1)[0]
+
+    match = METRIC_VALUE_RE.match(value)
+    if not match:
+        return None
+    number = float(match.group(1))
+    unit = match.group(2)
+    if unit is None:
+        return number, "status" if label.startswith("label_status_") else ""
+    unit_name, scale = METRIC_UNIT_SCALE[unit]
+    return number * scale, unit_name
+
+
+# Đơn vị chuẩn -> (tên metric Prometheus, mô tả)
+PROMETHEUS_UNIT_FAMILIES: Dict[str, Tuple[str, str]] = {
+    "celsius": ("jonsbo_temperature_celsius", "Nhiệt độ (°C) theo label hiển thị"),
+    "percent": ("jonsbo_ratio_percent", "Tỉ lệ phần trăm (0-100) theo label hiển thị"),
+    "bytes": ("jonsbo_size_bytes", "Dung lượng (bytes) theo label hiển thị"),
+    "hertz": ("jonsbo_clock_hertz", "Xung nhịp (Hz) theo label hiển thị"),
+    "rpm": ("jonsbo_fan_rpm", "Tốc độ quạt (RPM) theo label hiển thị"),
+    "bits_per_second": ("jonsbo_network_bits_per_second", "Băng thông mạng (bit/s) theo label hiển thị"),
+    "bytes_per_second": ("jonsbo_disk_bytes_per_second", "Thông lượng disk (bytes/s) theo label hiển thị"),
+    "seconds": ("jonsbo_latency_seconds", "Độ trễ (giây) theo label hiển thị"),
+    "status": ("jonsbo_status_code", "Mã trạng thái (SNMP) theo label hiển thị"),
+    "": ("jonsbo_value", "Giá trị không đơn vị theo label hiển thị"),
+}
+
+_prometheus_cache_lock = Lock()
+_prometheus_cache: Tuple[int, bytes] = (-1, b"")
+
+
+def breaker_status() -> Dict[str, Dict[str, object]]:
+    """Circuit breaker đang lỗi của daemon và của các worker process."""
+    status = COLLECTOR_POOL.breaker_status()
+    status.update(BREAKERS.status())
+    return status
+
+
+def breaker_prometheus_lines() -> List[str]:
+    """State circuit breaker: 0 = closed (đang đếm lỗi), 1 = open, 2 = half-open."""
+    lines = [
+        "# HELP jonsbo_breaker_state Circuit breaker của lệnh/collector đang lỗi (0 closed, 1 open, 2 half-open)",
+        "# TYPE jonsbo_breaker_state gauge",
+    ]
+    codes = {"closed": 0, "open": 1, "half_open": 2}
+    for key, state in breaker_status().items():
+        lines.append(f'jonsbo_breaker_state{{key="{_prometheus_escape(key)}"}} {codes[state["state"]]}')
+    return lines
+
+
+def _prometheus_escape(value: str) -> str:
+    """Escape giá trị label theo Prometheus text format."""
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render_prometheus_metrics() -> bytes:
+    """Render snapshot mới nhất + thống kê collector theo Prometheus text format (0.0.4).
+
+    Chỉ đọc SNAPSHOT_STORE/COLLECTOR_STATS, không gọi collector. Kết quả được cache
+    theo seq của snapshot nên nhiều lần scrape giữa 2 tick chỉ tốn một lần serialize;
+    riêng phần SELF_METRICS (nhỏ) được render lại mỗi lần.
+
+    Returns:
+        Nội dung response (UTF-8)
+    """
+    global _prometheus_cache
+    metrics, _, _, stale, timestamp, seq = SNAPSHOT_STORE.state()
+    # Self-metrics (histogram, bộ đếm, RSS) đổi giữa 2 tick nên render lại mỗi lần scrape
+    self_lines = SELF_METRICS.prometheus_lines() + TICK_BUDGET.prometheus_lines() + breaker_prometheus_lines()
+    self_body = ("\n".join(self_lines) + "\n").encode("utf-8")
+    with _prometheus_cache_lock:
+        if _prometheus_cache[0] == seq and seq > 0:
+            return _prometheus_cache[1] + self_body
+
+    lines: List[str] = []
+    families: Dict[str, List[str]] = {}
+    for label in LABEL_ORDER:
+        parsed = parse_metric_value(label, metrics.get(label, "N/A"))
+        if parsed is None:
+            continue
+        number, unit = parsed
+        families.setdefault(unit, []).append(f'{{label="{label}"}} {number!r}')
+
+    for unit, (metric_name, help_text) in PROMETHEUS_UNIT_FAMILIES.items():
+        samples = families.get(unit)
+        if not samples:
+            continue
+        lines.append(f"# HELP {metric_name} {help_text}")
+        lines.append(f"# TYPE {metric_name} gauge")
+        lines.extend(f"{metric_name}{sample}" for sample in samples)
+
+    if metrics:
+        info_labels = ",".join(
+            f'{label[len("label_"):]}="{_prometheus_escape(metrics.get(label, "N/A"))}"'
+            for label in INFO_LABELS
+        )
+        lines.append("# HELP jonsbo_info Thông tin host (hostname, account, version)")
+        lines.append("# TYPE jonsbo_info gauge")
+        lines.append(f"jonsbo_info{{{info_labels}}} 1")
+
+    lines.append("# HELP jonsbo_snapshot_timestamp_seconds Thời điểm (unix) của snapshot mới nhất")
+    lines.append("# TYPE jonsbo_snapshot_timestamp_seconds gauge")
+    lines.append(f"jonsbo_snapshot_timestamp_seconds {timestamp:.3f}")
+    lines.append("# HELP jonsbo_snapshot_seq Số thứ tự snapshot (tăng mỗi lần thu thập)")
+    lines.append("# TYPE jonsbo_snapshot_seq gauge")
+    lines.append(f"jonsbo_snapshot_seq {seq}")
+
+    collector_stats = COLLECTOR_STATS.snapshot()
+    collector_families = (
+        ("jonsbo_collector_runs_total", "counter", "Số lần chạy collector", "runs"),
+        ("jonsbo_collector_errors_total", "counter", "Số lần collector lỗi (exception)", "errors"),
+        ("jonsbo_collector_duration_seconds_total", "counter", "Tổng thời gian chạy collector (giây)", "duration_total"),
+        ("jonsbo_collector_last_duration_seconds", "gauge", "Thời gian chạy lần gần nhất (giây)", "last_duration"),
+        ("jonsbo_collector_na_labels", "gauge", "Số label N/A ở lần chạy gần nhất", "na_labels"),
+    )
+    for metric_name, metric_type, help_text, key in collector_families:
+        lines.append(f"# HELP {metric_name} {help_text}")
+        lines.append(f"# TYPE {metric_name} {metric_type}")
+        for name, stats in collector_stats.items():
+            lines.append(f'{metric_name}{{collector="{name}"}} {float(stats[key])!r}')
+    lines.append("# HELP jonsbo_collector_stale 1 nếu snapshot đang dùng giá trị cũ vì collector chưa xong trước deadline")
+    lines.append("# TYPE jonsbo_collector_stale gauge")
+    for name in collector_stats:
+        lines.append(f'jonsbo_collector_stale{{collector="{name}"}} {1 if name in stale else 0}')
+
+    body = ("\n".join(lines) + "\n").encode("utf-8")
+    with _prometheus_cache_lock:
+        _prometheus_cache = (seq, body)
+    return body + self_body
+
+
+# ---------------------------------------------------------------------------
+# Lịch sử metrics trên disk: ring file mmap gồm các block nén cố định
+# ---------------------------------------------------------------------------
+
+# Chỉ lưu tầng 1 phút; tầng 15 phút được tính lại từ các bucket 1 phút khi query
+HISTORY_FILE_STEP = 60
+HISTORY_FILE_MAGIC = b"N4HIST01"
+# magic, block_size, block_count, step, cursor, next_seq
+HISTORY_FILE_HEADER = struct.Struct("<8sIIIII")
+HISTORY_BLOCK_SIZE = 1024
+HISTORY_BLOCK_MAGIC = b"HB"
+# magic, seq, first_ts, last_ts, count, nbytes, crc32, label
+HISTORY_BLOCK_HEADER = struct.Struct("<2sIIIHHI40s")
+HISTORY_FILE_DEFAULT_MB = 16
+HISTORY_FLUSH_SECONDS = 300.0
+# Ổ không có I/O thì hoãn flush, nhưng không quá ngần này (giới hạn dữ liệu mất khi mất điện)
+HISTORY_FLUSH_MAX_DEFER = 24 * 3600.0
+HISTORY_FILE_NAME = "history.bin"
+_FLOAT32 = struct.Struct("<f")
+_UINT32 = struct.Struct("<I")
+
+
+def _float32_bits(value: float) -> int:
+    """Bit pattern float32 của value (giá trị lưu giống HistoryTier)."""
+    return _UINT32.unpack(_FLOAT32.pack(value))[0]
+
+
+def _bits_float32(bits: int) -> float:
+    """Ngược lại của _float32_bits."""
+    return _FLOAT32.unpack(_UINT32.pack(bits))[0]
+
+
+class HistoryBlock:
+    """Block nén các bucket 1 phút (t, min, max, mean) của một label.
+
+    Timestamp mã hoá delta-of-delta, mỗi giá trị float32 XOR với giá trị cùng loại
+    trước đó (kiểu Gorilla). Bucket liên tiếp và giá trị không đổi chỉ tốn 1 bit.
+    """
+
+    __slots__ = ("label", "capacity_bits", "seq", "slot", "dirty", "first_ts", "last_ts",
+                 "count", "bits", "nbits", "prev_delta", "prev_values", "windows")
+
+    def __init__(self, label: str, capacity_bits: int):
+        self.label = label
+        self.capacity_bits = capacity_bits
+        self.seq = 0
+        self.slot: Optional[int] = None
+        self.dirty = False
+        self.first_ts = self.last_ts = 0
+        self.count = 0
+        self.bits = 0
+        self.nbits = 0
+        self.prev_delta = HISTORY_FILE_STEP
+        self.prev_values = [0, 0, 0]
+        self.windows: List[Optional[Tuple[int, int]]] = [None, None, None]
+
+    def _write(self, value: int, width: int) -> None:
+        self.bits = (self.bits << width) | (value & ((1 << width) - 1))
+        self.nbits += width
+
+    def _write_dod(self, dod: int) -> None:
+        if dod == 0:
+            self._write(0, 1)
+        elif -63 <= dod <= 64:
+            self._write(0b10, 2)
+            self._write(dod + 63, 7)
+        elif -255 <= dod <= 256:
+            self._write(0b110, 3)
+            self._write(dod + 255, 9)
+        elif -2047 <= dod <= 2048:
+            self._write(0b1110, 4)
+            self._write(dod + 2047, 12)
+        else:
+            self._write(0b1111, 4)
+            self._write(dod, 32)
+
+    def _write_xor(self, index: int, bits: int) -> None:
+        xor = bits ^ self.prev_values[index]
+        self.prev_values[index] = bits
+        if xor == 0:
+            self._write(0, 1)
+            return
+        leading = 32 - xor.bit_length()
+        trailing = (xor & -xor).bit_length() - 1
+        window = self.windows[index]
+        if window is not None and leading >= window[0] and trailing >= window[1]:
+            self._write(0b10, 2)
+            self._write(xor >> window[1], 32 - window[0] - window[1])
+            return
+        meaningful = 32 - leading - trailing
+        self._write(0b11, 2)
+        self._write(leading, 5)
+        self._write(meaningful - 1, 5)
+        self._write(xor >> trailing, meaningful)
+        self.windows[index] = (leading, trailing)
+
+    def append(self, timestamp: int, values: Tuple[float, float, float]) -> bool:
+        """Thêm một bucket; trả về False (block không đổi) nếu không còn chỗ."""
+        saved = (self.bits, self.nbits, self.prev_delta, list(self.prev_values), list(self.windows))
+        value_bits = [_float32_bits(value) for value in values]
+        if self.count == 0:
+            self.first_ts = timestamp
+            for index, bits in enumerate(value_bits):
+                self._write(bits, 32)
+                self.prev_values[index] = bits
+        else:
+            delta = timestamp - self.last_ts
+            self._write_dod(delta - self.prev_delta)
+            self.prev_delta = delta
+            for index, bits in enumerate(value_bits):
+                self._write_xor(index, bits)
+        if self.nbits > self.capacity_bits or self.count == 0xFFFF:
+            self.bits, self.nbits, self.prev_delta, self.prev_values, self.windows = saved
+            return False
+        self.last_ts = timestamp
+        self.count += 1
+        self.dirty = True
+        return True
+
+    def data(self) -> bytes:
+        """Dữ liệu nén đã pad tới byte."""
+        pad = -self.nbits % 8
+        return (self.bits << pad).to_bytes((self.nbits + pad) // 8, "big")
+
+    def to_bytes(self, block_size: int) -> bytes:
+        """Block hoàn chỉnh (header có CRC32 + dữ liệu + padding) để ghi vào slot."""
+        data = self.data()
+        label = self.label.encode("utf-8")
+        header = HISTORY_BLOCK_HEADER.pack(HISTORY_BLOCK_MAGIC, self.seq, self.first_ts, self.last_ts,
+                                           self.count, len(data), 0, label)
+        crc = zlib.crc32(data, zlib.crc32(header)) & 0xFFFFFFFF
+        header = HISTORY_BLOCK_HEADER.pack(HISTORY_BLOCK_MAGIC, self.seq, self.first_ts, self.last_ts,
+                                           self.count, len(data), crc, label)
+        return header + data + bytes(block_size - len(header) - len(data))
+
+
+def decode_history_block(data: bytes, count: int, first_ts: int) -> List[Tuple[int, float, float, float]]:
+    """Giải nén dữ liệu của HistoryBlock thành danh sách (t, min, max, mean)."""
+    value = int.from_bytes(data, "big")
+    remaining = len(data) * 8
+
+    def read(width: int) -> int:
+        nonlocal remaining
+        remaining -= width
+        return (value >> remaining) & ((1 << width) - 1)
+
+    records = []
+    prev_values = [read(32), read(32), read(32)]
+    windows: List[Tuple[int, int]] = [(0, 0), (0, 0), (0, 0)]
+    timestamp, prev_delta = first_ts, HISTORY_FILE_STEP
+    records.append((timestamp,) + tuple(_bits_float32(bits) for bits in prev_values))
+    for _ in range(count - 1):
+        if read(1) == 0:
+            dod = 0
+        elif read(1) == 0:
+            dod = read(7) - 63
+        elif read(1) == 0:
+            dod = read(9) - 255
+        elif read(1) == 0:
+            dod = read(12) - 2047
+        else:
+            dod = read(32)
+            dod = dod - (1 << 32) if dod >= 1 << 31 else dod
+        prev_delta += dod
+        timestamp += prev_delta
+        for index in range(3):
+            if read(1) == 0:
+                continue
+            if read(1) == 0:
+                leading, trailing = windows[index]
+            else:
+                leading = read(5)
+                meaningful = read(5) + 1
+                trailing = 32 - leading - meaningful
+                windows[index] = (leading, trailing)
+            prev_values[index] ^= read(32 - leading - trailing) << trailing
+        records.append((timestamp,) + tuple(_bits_float32(bits) for bits in prev_values))
+    return records
+
+
+class HistoryFile:
+    """Ring file cố định dung lượng chứa lịch sử 1 phút của mọi label, map bằng mmap.
+
+    File gồm một header (cursor, seq tiếp theo) và block_count slot, mỗi slot một
+    HistoryBlock của một label. Block đang ghi nằm trong RAM; chỉ khi flush (mỗi
+    flush_interval giây) mới copy vào mmap và msync, nên giữa hai lần flush không
+    có page dirty nào làm đánh thức ổ đĩa. Nếu từ lần kiểm tra trước ổ không có I/O
+    nào (/proc/diskstats), flush được hoãn tới khi ổ quay lại (tối đa max_defer giây),
+    vì warm cache vẫn ghi lịch sử khi màn hình tắt. Khi ring đầy, slot cũ nhất bị ghi đè.
+
+    Mở lại là O(1): chỉ đọc header. Index label -> slot được dựng khi query lần đầu.
+    Block hỏng (mất điện giữa lúc ghi) bị bỏ qua nhờ CRC32; header cũ hơn block
+    (crash giữa msync dữ liệu và header) được phát hiện và sửa bằng một lần quét.
+    """
+
+    def __init__(self, path: Path, size_mb: float = HISTORY_FILE_DEFAULT_MB,
+                 flush_interval: float = HISTORY_FLUSH_SECONDS, max_defer: float = HISTORY_FLUSH_MAX_DEFER):
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self.max_defer = max_defer
+        self.deferred = 0
+        self.block_size = HISTORY_BLOCK_SIZE
+        self.block_count = max(16, int(size_mb * 1024 * 1024) // self.block_size - 1)
+        self.capacity_bits = (self.block_size - HISTORY_BLOCK_HEADER.size) * 8
+        self.cursor = 0
+        self.next_seq = 1
+        self._lock = Lock()
+        self._file = None
+        self._mm: Optional[mmap.mmap] = None
+        self._open: Dict[str, HistoryBlock] = {}
+        self._sealed: List[HistoryBlock] = []
+        # label -> [(seq, slot, first_ts, last_ts)], dựng lười khi query lần đầu
+        self._index: Optional[Dict[str, List[Tuple[int, int, int, int]]]] = None
+        self._last_flush = time.monotonic()
+        self._last_check = self._last_flush
+        # Số I/O của ổ lúc kiểm tra trước; None = chưa có mốc (vừa mở hoặc vừa flush)
+        self._disk_activity: Optional[int] = None
+
+    def _slot_offset(self, slot: int) -> int:
+        return self.block_size * (slot + 1)
+
+    def open(self) -> "HistoryFile":
+        """Mở (hoặc tạo và cấp phát trước) file; trả về self."""
+        size = self.block_size * (self.block_count + 1)
+        self._file = open(os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o644), "r+b")
+        header = self._file.read(HISTORY_FILE_HEADER.size)
+        valid = (
+            len(header) == HISTORY_FILE_HEADER.size
+            and os.fstat(self._file.fileno()).st_size == size
+            and HISTORY_FILE_HEADER.unpack(header)[:4]
+            == (HISTORY_FILE_MAGIC, self.block_size, self.block_count, HISTORY_FILE_STEP)
+        )
+        if not valid:
+            # File mới hoặc đổi dung lượng: tạo lại, cấp phát trước để không bị ENOSPC giữa chừng
+            self._file.truncate(0)
+            try:
+                os.posix_fallocate(self._file.fileno(), 0, size)
+            except (AttributeError, OSError):
+                self._file.truncate(size)
+        self._mm = mmap.mmap(self._file.fileno(), size)
+        if valid:
+            _, _, _, _, self.cursor, self.next_seq = HISTORY_FILE_HEADER.unpack(header)
+            self._recover()
+        else:
+            self._write_header()
+            self._mm.flush()
+        return self
+
+    def _read_block_header(self, slot: int) -> Optional[Tuple]:
+        fields = HISTORY_BLOCK_HEADER.unpack_from(self._mm, self._slot_offset(slot))
+        return fields if fields[0] == HISTORY_BLOCK_MAGIC else None
+
+    def _recover(self) -> None:
+        """Sửa cursor/seq nếu header chưa kịp ghi sau khi các block đã được ghi."""
+        fields = self._read_block_header(self.cursor % self.block_count)
+        if fields is None or fields[1] < self.next_seq:
+            return
+        newest = max(
+            ((fields[1], slot) for slot in range(self.block_count)
+             for fields in [self._read_block_header(slot)] if fields is not None),
+            default=(0, -1),
+        )
+        self.next_seq = newest[0] + 1
+        self.cursor = (newest[1] + 1) % self.block_count
+
+    def _write_header(self) -> None:
+        HISTORY_FILE_HEADER.pack_into(self._mm, 0, HISTORY_FILE_MAGIC, self.block_size, self.block_count,
+                                      HISTORY_FILE_STEP, self.cursor, self.next_seq)
+
+    def _ensure_index(self) -> Dict[str, List[Tuple[int, int, int, int]]]:
+        if self._index is None:
+            index: Dict[str, List[Tuple[int, int, int, int]]] = {}
+            for slot in range(self.block_count):
+                fields = self._read_block_header(slot)
+                if fields is not None:
+                    label = fields[7].rstrip(b"\0").decode("utf-8", "replace")
+                    index.setdefault(label, []).append((fields[1], slot, fields[2], fields[3]))
+            self._index = index
+        return self._index
+
+    def append(self, label: str, timestamp: int, low: float, high: float, mean: float) -> None:
+        """Thêm một bucket 1 phút đã đóng; flush nếu đã đến hạn."""
+        with self._lock:
+            block = self._open.get(label)
+            if block is None or not block.append(timestamp, (low, high, mean)):
+                if block is not None:
+                    self._sealed.append(block)
+                block = HistoryBlock(label, self.capacity_bits)
+                block.append(timestamp, (low, high, mean))
+                self._open[label] = block
+        now = time.monotonic()
+        if now - self._last_check < self.flush_interval:
+            return
+        self._last_check = now
+        if now - self._last_flush < self.max_defer and self._disks_idle():
+            self.deferred += 1
+            return
+        self.flush()
+
+    def _disks_idle(self) -> bool:
+        """True nếu ổ không có I/O kể từ lần kiểm tra trước (hoặc chưa có mốc để so sánh).
+
+        Mốc được đặt lại sau mỗi flush, nên I/O do chính lần flush đó (kể cả journal
+        commit ngay sau msync) không bị tính là ổ đang quay.
+        """
+        activity = read_disk_activity()
+        previous, self._disk_activity = self._disk_activity, activity
+        if activity is None:
+            return False  # Không đọc được diskstats: flush theo lịch như cũ
+        return previous is None or activity == previous
+
+    def flush(self) -> None:
+        """Ghi các block thay đổi vào mmap rồi msync: dữ liệu trước, header sau."""
+        with self._lock:
+            self._last_flush = self._last_check = time.monotonic()
+            self._disk_activity = None
+            dirty = self._sealed + [block for block in self._open.values() if block.dirty]
+            if self._mm is None or not dirty:
+                return
+            for block in dirty:
+                # Slot đã bị ring cấp lại cho block khác thì cần slot mới
+                if block.slot is None or self.next_seq - block.seq >= self.block_count:
+                    block.slot, block.seq = self.cursor, self.next_seq
+                    self.cursor = (self.cursor + 1) % self.block_count
+                    self.next_seq += 1
+                offset = self._slot_offset(block.slot)
+                self._mm[offset:offset + self.block_size] = block.to_bytes(self.block_size)
+                block.dirty = False
+                if self._index is not None:
+                    entries = [e for e in self._index.get(block.label, []) if e[1] != block.slot]
+                    entries.append((block.seq, block.slot, block.first_ts, block.last_ts))
+                    self._index[block.label] = entries
+            self._sealed = []
+            self._mm.flush()
+            self._write_header()
+            self._mm.flush(0, mmap.PAGESIZE)
+
+    def close(self) -> None:
+        """Flush lần cuối và đóng file."""
+        self.flush()
+        with self._lock:
+            if self._mm is not None:
+                self._mm.close()
+                self._file.close()
+                self._mm = self._file = None
+
+    def query(self, label: str, start: float, end: float) -> List[Tuple[int, float, float, float]]:
+        """Các bucket 1 phút của label trong [start, end], gồm cả block chưa flush."""
+        found: Dict[int, Tuple[int, float, float, float]] = {}
+        with self._lock:
+            if self._mm is None:
+                return []
+            for seq, slot, first_ts, last_ts in self._ensure_index().get(label, []):
+                if last_ts < start or first_ts > end:
+                    continue
+                offset = self._slot_offset(slot)
+                raw = self._mm[offset:offset + self.block_size]
+                fields = HISTORY_BLOCK_HEADER.unpack_from(raw)
+                _, block_seq, first_ts, last_ts, count, nbytes, crc, _ = fields
+                data = raw[HISTORY_BLOCK_HEADER.size:HISTORY_BLOCK_HEADER.size + nbytes]
+                header = HISTORY_BLOCK_HEADER.pack(*fields[:6], 0, fields[7])
+                if block_seq != seq or zlib.crc32(data, zlib.crc32(header)) & 0xFFFFFFFF != crc:
+                    continue  # Slot đã bị ghi đè hoặc block hỏng
+                for record in decode_history_block(data, count, first_ts):
+                    found[record[0]] = record
+            memory_blocks = [block for block in self._sealed if block.label == label]
+            if label in self._open:
+                memory_blocks.append(self._open[label])
+            for block in memory_blocks:
+                if block.count and block.last_ts >= start and block.first_ts <= end:
+                    for record in decode_history_block(block.data(), block.count, block.first_ts):
+                        found[record[0]] = record
+        return [found[t] for t in sorted(found) if start <= t <= end]
+
+
+# ---------------------------------------------------------------------------
+# Lịch sử metrics trong RAM: ring buffer cố định, nhiều tầng downsampling
+# ---------------------------------------------------------------------------
+
+# (bước thời gian giây, số bucket): 1s trong 1 giờ, 1 phút trong 24 giờ, 15 phút trong 30 ngày
+HISTORY_TIERS: Tuple[Tuple[int, int], ...] = ((1, 3600), (60, 1440), (900, 2880))
+
+
+class HistoryTier:
+    """Một tầng lịch sử: ring buffer theo bucket thời gian, lưu min/max/mean mỗi bucket.
+
+    Slot của bucket b là b % capacity; mảng ids lưu bucket thực sự nằm trong slot
+    để phân biệt dữ liệu cũ đã bị ghi đè. Bucket đang mở được gộp trong biến thường
+    và chỉ ghi vào mảng khi chuyển sang bucket mới.
+    """
+
+    __slots__ = ("step", "capacity", "ids", "mins", "maxs", "means",
+                 "open_id", "open_min", "open_max", "open_sum", "open_count")
+
+    def __init__(self, step: int, capacity: int):
+        self.step = step
+        self.capacity = capacity
+        self.ids = array("q", [-1]) * capacity
+        self.mins = array("f", [0.0]) * capacity
+        self.maxs = array("f", [0.0]) * capacity
+        self.means = array("f", [0.0]) * capacity
+        self.open_id = -1
+        self.open_min = self.open_max = self.open_sum = 0.0
+        self.open_count = 0
+
+    @property
+    def retention(self) -> int:
+        """Khoảng thời gian (giây) tầng này giữ được."""
+        return self.step * self.capacity
+
+    def nbytes(self) -> int:
+        """Bộ nhớ của các mảng (bytes)."""
+        return sum(buf.itemsize * len(buf) for buf in (self.ids, self.mins, self.maxs, self.means))
+
+    def add(self, timestamp: float, value: float) -> Optional[Tuple[int, float, float, float]]:
+        """Thêm một mẫu vào bucket tương ứng.
+
+        Returns:
+            (thời điểm, min, max, mean) của bucket vừa đóng nếu mẫu mở bucket mới, ngược lại None
+        """
+        bucket = int(timestamp // self.step)
+        if bucket == self.open_id:
+            self.open_min = min(self.open_min, value)
+            self.open_max = max(self.open_max, value)
+            self.open_sum += value
+            self.open_count += 1
+            return None
+        if bucket < self.open_id:
+            return None  # Đồng hồ lùi: bỏ mẫu thay vì ghi đè bucket mới hơn
+        closed = self._close()
+        self.open_id = bucket
+        self.open_min = self.open_max = self.open_sum = value
+        self.open_count = 1
+        return closed
+
+    def _close(self) -> Optional[Tuple[int, float, float, float]]:
+        """Ghi bucket đang mở vào ring buffer."""
+        if self.open_count == 0:
+            return None
+        slot = self.open_id % self.capacity
+        mean = self.open_sum / self.open_count
+        self.ids[slot] = self.open_id
+        self.mins[slot] = self.open_min
+        self.maxs[slot] = self.open_max
+        self.means[slot] = mean
+        return self.open_id * self.step, self.open_min, self.open_max, mean
+
+    def query(self, start: float, end: float) -> List[Tuple[int, float, float, float]]:
+        """Các bucket có dữ liệu trong [start, end]: (thời điểm bắt đầu bucket, min, max, mean)."""
+        last = int(end // self.step)
+        first = max(int(start // self.step), last - self.capacity + 1)
+        points = []
+        for bucket in range(first, last + 1):
+            if bucket == self.open_id and self.open_count:
+                points.append((bucket * self.step, self.open_min, self.open_max,
+                               self.open_sum / self.open_count))
+                continue
+            slot = bucket % self.capacity
+            if self.ids[slot] == bucket:
+                points.append((bucket * self.step, self.mins[slot], self.maxs[slot], self.means[slot]))
+        return points
+
+
+class MetricHistory:
+    """Lịch sử mọi metric có giá trị số (thread-safe, bộ nhớ cố định theo số label).
+
+    Mỗi label có một HistoryTier cho mỗi tầng trong HISTORY_TIERS, nên bộ nhớ là
+    số label × tổng số bucket × 20 bytes, không tăng theo thời gian chạy.
+    Nếu có store (HistoryFile), các bucket 1 phút được lưu xuống disk và query các
+    tầng >= 1 phút đọc thêm từ đó, nên lịch sử còn nguyên sau khi restart.
+    """
+
+    def __init__(self, tiers: Tuple[Tuple[int, int], ...] = HISTORY_TIERS,
+                 store: Optional[HistoryFile] = None):
+        self.tiers = tiers
+        self.store = store
+        self._lock = Lock()
+        self._series: Dict[str, Tuple[str, List[HistoryTier]]] = {}
+        self._started: Optional[float] = None
+
+    def record(self, metrics: Dict[str, str], timestamp: float) -> None:
+        """Ghi các giá trị số của một snapshot."""
+        with self._lock:
+            for label, value in metrics.items():
+                parsed = parse_metric_value(label, value)
+                if parsed is None:
+                    continue
+                number, unit = parsed
+                series = self._series.get(label)
+                if series is None:
+                    series = (unit, [HistoryTier(step, capacity) for step, capacity in self.tiers])
+                    self._series[label] = series
+                for tier in series[1]:
+                    closed = tier.add(timestamp, number)
+                    if closed is not None and self.store is not None and tier.step == HISTORY_FILE_STEP:
+                        self.store.append(label, *closed)
+            if self._started is None:
+                self._started = timestamp
+
+    def labels(self) -> Dict[str, str]:
+        """Các label đang có lịch sử, kèm đơn vị chuẩn."""
+        with self._lock:
+            return {label: unit for label, (unit, _) in self._series.items()}
+
+    def nbytes(self) -> int:
+        """Tổng bộ nhớ các ring buffer (bytes)."""
+        with self._lock:
+            return sum(tier.nbytes() for _, tiers in self._series.values() for tier in tiers)
+
+    def query(
+        self,
+        label: str,
+        start: float,
+        end: float,
+        max_points: Optional[int] = None,
+        now: Optional[float] = None,
+    ) -> Optional[Dict[str, object]]:
+        """Lấy lịch sử của label trong [start, end].
+
+        Chọn tầng mịn nhất vẫn còn giữ được start và cho ra không quá max_points điểm.
+
+        Returns:
+            {"label", "unit", "step", "points": [(t, min, max, mean), ...]} hoặc None nếu không có label
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            series = self._series.get(label)
+            if series is None:
+                return None
+            unit, tiers = series
+            chosen = tiers[-1]
+            for tier in tiers:
+                covers = start >= now - tier.retention
+                fits = max_points is None or (end - start) / tier.step <= max_points
+                if covers and fits:
+                    chosen = tier
+                    break
+            points = chosen.query(start, end)
+            started = self._started
+        if self.store is not None and chosen.step >= HISTORY_FILE_STEP:
+            points = self._merge_stored(label, chosen.step, start, end, points, started)
+        return {"label": label, "unit": unit, "step": chosen.step, "points": points}
+
+    def _merge_stored(self, label: str, step: int, start: float, end: float,
+                      points: List[Tuple[int, float, float, float]],
+                      started: Optional[float]) -> List[Tuple[int, float, float, float]]:
+        """Gộp bucket 1 phút trên disk theo step rồi ghép với điểm trong RAM.
+
+        Bucket bắt đầu trước khi process chạy chỉ có một phần trong RAM, nên dùng bản trên disk.
+        """
+        merged: Dict[int, Tuple[int, float, float, float]] = {}
+        sums: Dict[int, Tuple[float, int]] = {}
+        for t, low, high, mean in self.store.query(label, start, end):
+            bucket = t // step * step
+            if bucket in merged:
+                _, old_low, old_high, _ = merged[bucket]
+                low, high = min(low, old_low), max(high, old_high)
+                total, count = sums[bucket]
+                sums[bucket] = (total + mean, count + 1)
+            else:
+                sums[bucket] = (mean, 1)
+            total, count = sums[bucket]
+            merged[bucket] = (bucket, low, high, total / count)
+        for point in points:
+            if started is None or point[0] >= started or point[0] not in merged:
+                merged[point[0]] = point
+        return [merged[t] for t in sorted(merged)]
+
+
+METRIC_HISTORY = MetricHistory()
+
+
+# ---------------------------------------------------------------------------
+# JSON snapshot API + Server-Sent Events
+# ---------------------------------------------------------------------------
+
+# Response nhỏ hơn ngưỡng này không nén (gzip header + CPU không đáng)
+API_GZIP_MIN_SIZE = 1024
+# Gửi comment SSE khi không có tick mới để proxy/browser không đóng connection
+SSE_KEEPALIVE_SECONDS = 15.0
+# Định danh lần chạy: seq reset về 0 khi restart, nên ETag/event id kèm token này
+API_INSTANCE = f"{os.getpid():x}{int(time.time()):x}"
+
+
+class SnapshotPayload:
+    """Các bản serialize của một snapshot, dùng chung cho mọi client."""
+
+    def __init__(self, seq: int, body: bytes, full_event: bytes, delta_event: bytes):
+        self.seq = seq
+        self.body = body
+        self.etag = f'"{API_INSTANCE}-{seq}"'
+        self.full_event = full_event
+        self.delta_event = delta_event
+        self._gzip_body: Optional[bytes] = None
+        self._gzip_lock = Lock()
+
+    @property
+    def gzip_body(self) -> Optional[bytes]:
+        """Body đã nén gzip (nén lần đầu được yêu cầu), None nếu body quá nhỏ."""
+        if len(self.body) < API_GZIP_MIN_SIZE:
+            return None
+        with self._gzip_lock:
+            if self._gzip_body is None:
+                # mtime=0 để nội dung nén ổn định (cùng snapshot -> cùng bytes)
+                import gzip
+                self._gzip_body = gzip.compress(self.body, compresslevel=6, mtime=0)
+            return self._gzip_body
+
+
+def _snapshot_metric_entry(
+    label: str, value: str, sources: Dict[str, str], stale: Dict[str, Optional[float]]
+) -> Dict[str, object]:
+    """Một metric trong JSON: giá trị hiển thị, giá trị số + đơn vị chuẩn, collector, stale."""
+    parsed = parse_metric_value(label, value)
+    return {
+        "value": value,
+        "number": parsed[0] if parsed else None,
+        "unit": parsed[1] if parsed else None,
+        "collector": sources.get(label),
+        "stale": sources.get(label) in stale,
+    }
+
+
+def _snapshot_sse_event(event: str, seq: int, data: Dict[str, object]) -> bytes:
+    """Format một event Server-Sent Events."""
+    payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    return f"id: {API_INSTANCE}-{seq}\nevent: {event}\ndata: {payload}\n\n".encode("utf-8")
+
+
+class SnapshotSerializer:
+    """Serialize snapshot mới nhất đúng MỘT lần mỗi tick cho /api/snapshot và /api/stream."""
+
+    def __init__(self, store: SnapshotStore, stats: CollectorStats):
+        self.store = store
+        self.stats = stats
+        self._lock = Lock()
+        self._payload: Optional[SnapshotPayload] = None
+
+    def current(self) -> SnapshotPayload:
+        """Payload của snapshot mới nhất (tính lại chỉ khi seq thay đổi)."""
+        with self._lock:
+            payload = self._payload
+            if payload is not None and payload.seq == self.store.seq:
+                return payload
+
+            metrics, previous, sources, stale, timestamp, seq = self.store.state()
+
+            collectors = {
+                name: {
+                    "timestamp": round(stats["last_run"], 3),
+                    "duration": stats["last_duration"],
+                    "runs": int(stats["runs"]),
+                    "errors": int(stats["errors"]),
+                    "stale": name in stale,
+                    "age": stale.get(name),
+                }
+                for name, stats in self.stats.snapshot().items()
+            }
+            entries = {
+                label: _snapshot_metric_entry(label, value, sources, stale)
+                for label, value in metrics.items()
+            }
+            snapshot = {
+                "seq": seq,
+                "timestamp": round(timestamp, 3),
+                "metrics": entries,
+                "collectors": collectors,
+            }
+            delta = {
+                "seq": seq,
+                "timestamp": round(timestamp, 3),
+                "changed": {
+                    label: entry for label, entry in entries.items() if previous.get(label) != metrics[label]
+                },
+                "removed": [label for label in previous if label not in metrics],
+                "collectors": collectors,
+            }
+            payload = SnapshotPayload(
+                seq,
+                json.dumps(snapshot, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+                _snapshot_sse_event("snapshot", seq, snapshot),
+                _snapshot_sse_event("delta", seq, delta),
+            )
+            self._payload = payload
+            return payload
+
+
+SNAPSHOT_SERIALIZER = SnapshotSerializer(SNAPSHOT_STORE, COLLECTOR_STATS)
+
+
+def parse_sse_event_id(event_id: Optional[str]) -> int:
+    """Lấy seq từ Last-Event-ID, -1 nếu không có hoặc thuộc lần chạy khác."""
+    if not event_id:
+        return -1
+    instance, _, seq = event_id.strip().rpartition("-")
+    if instance != API_INSTANCE or not seq.isdigit():
+        return -1
+    return int(seq)
+
+
+def _format_metrics_payload(metrics: Dict[str, str], labels: List[str]) -> str:
+    """Format metrics thành chuỗi theo thứ tự labels được chỉ định.
+    
+    Args:
+        metrics: Dictionary chứa tất cả metrics
+        labels: Danh sách label cần format (có thể là WAKEUP_LABELS hoặc DYNAMIC_LABELS)
+    
+    Returns:
+        Chuỗi đã format với các dòng "label: value"
+    """
+    lines = [f"{label}: {metrics[label]}" for label in labels]
+    return "\n".join(lines) + "\n"
+
+
+def _format_all_metrics_payload(metrics: Dict[str, str]) -> str:
+    """Format tất cả metrics thành chuỗi theo thứ tự LABEL_ORDER (tương thích với code cũ)."""
     return _format_metrics_payload(metrics, LABEL_ORDER)
 
 
-def write_output(metrics: Dict[str, str], output_file: Path) -> None:
-    """Ghi metrics ra file theo thứ tự LABEL_ORDER.
+class OutputSink:
+    """Ghi file output (sensors.txt) một cách nguyên tử và chỉ khi nội dung thay đổi.
+
+    - So sánh với bytes đã ghi lần trước trong RAM, nội dung không đổi thì không chạm disk.
+    - Ghi vào file tạm cùng thư mục rồi os.replace, reader không bao giờ thấy file ghi dở.
+    - fsync tối đa mỗi fsync_interval giây (0 = không fsync, để kernel tự writeback).
+      Output trên tmpfs (ví dụ /dev/shm/sensors.txt) không cần fsync.
+    """
+
+    def __init__(self, path: Path, fsync_interval: float = 0.0):
+        self.path = Path(path)
+        self.fsync_interval = fsync_interval
+        self._tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        self._last_bytes: Optional[bytes] = None
+        self._last_fsync = 0.0
+
+    def write(self, metrics: Dict[str, str]) -> bool:
+        """Ghi snapshot; trả về False nếu bỏ qua vì nội dung không đổi."""
+        data = _format_all_metrics_payload(metrics).encode("utf-8")
+        if self._last_bytes is None:
+            # Lần đầu (kể cả sau restart): so với file đang có trên disk
+            try:
+                self._last_bytes = self.path.read_bytes()
+            except OSError:
+                self._last_bytes = b""
+        if data == self._last_bytes:
+            return False
+
+        now = time.monotonic()
+        sync = self.fsync_interval > 0 and now - self._last_fsync >= self.fsync_interval
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self._tmp_path, "wb") as tmp_file:
+            tmp_file.write(data)
+            if sync:
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+        os.replace(self._tmp_path, self.path)
+        if sync:
+            # fsync thư mục để rename cũng bền vững
+            dir_fd = os.open(str(self.path.parent), os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+            self._last_fsync = now
+        self._last_bytes = data
+        return True
+
+
+_OUTPUT_SINKS: Dict[Path, OutputSink] = {}
+
+
+def write_output(metrics: Dict[str, str], output_file: Path) -> bool:
+    """Ghi metrics ra file theo thứ tự LABEL_ORDER (nguyên tử, bỏ qua nếu không đổi).
     
     Args:
         metrics: Dictionary chứa tất cả metrics
         output_file: Đường dẫn file output cần ghi
+
+    Returns:
+        True nếu đã ghi, False nếu nội dung giống lần ghi trước
+    """
+    sink = _OUTPUT_SINKS.get(output_file)
+    if sink is None:
+        sink = _OUTPUT_SINKS[output_file] = OutputSink(output_file)
+    return sink.write(metrics)
+
+
+# Snapshot cuối cùng, gửi (đánh dấu cũ) ngay khi màn hình kết nối sau restart/reconnect
+STATE_FILE_NAME = "read_sensor_state.json"
+STATE_FILE_FORMAT = 1
+# Snapshot cũ hơn ngần này không gửi nữa (số liệu không còn ý nghĩa)
+STATE_MAX_AGE_SECONDS = 24 * 3600.0
+# Dòng báo tuổi snapshot cho ESP32: > 0 = snapshot cũ (màn hình làm mờ), 0 = số liệu live
+STALE_LABEL = "snapshot_stale"
+
+
+def default_state_path(script_dir: Path) -> Path:
+    """File state mặc định: trên tmpfs (/dev/shm) nếu có, để không đánh thức volume."""
+    shm = Path("/dev/shm")
+    if shm.is_dir() and os.access(str(shm), os.W_OK):
+        return shm / STATE_FILE_NAME
+    return script_dir / STATE_FILE_NAME
+
+
+class SnapshotStateFile:
+    """Lưu snapshot metrics gần nhất và thời điểm chạy của từng collector ra file JSON nhỏ.
+
+    save() chỉ ghi khi metrics thay đổi và tối đa mỗi interval giây (ghi nguyên tử
+    qua file tạm + os.replace); flush() ghi phần còn chờ khi thoát.
     """
-    output_file.parent.mkdir(parents=True, exist_ok=True)
-    output_file.write_text(_format_all_metrics_payload(metrics), encoding="utf-8")
+
+    def __init__(self, path: Path, interval: float = 10.0):
+        self.path = Path(path)
+        self.interval = interval
+        self._tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        self._pending: Optional[Dict[str, str]] = None
+        self._saved: Optional[Dict[str, str]] = None
+        self._last_save = 0.0
+
+    def load(self) -> Optional[Tuple[Dict[str, str], float]]:
+        """Đọc snapshot đã lưu.
+
+        Returns:
+            (metrics, thời điểm lưu) hoặc None nếu không có, hỏng hoặc quá cũ
+        """
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+            if data.get("format") != STATE_FILE_FORMAT:
+                return None
+            metrics = {str(k): str(v) for k, v in data["metrics"].items()}
+            saved = float(data["saved"])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+        if not metrics or time.time() - saved > STATE_MAX_AGE_SECONDS:
+            return None
+        self._saved = metrics
+        return metrics, saved
+
+    def save(self, metrics: Dict[str, str]) -> bool:
+        """Ghi nhận snapshot mới; trả về True nếu đã ghi file."""
+        if metrics == self._saved:
+            self._pending = None
+            return False
+        self._pending = metrics
+        if time.monotonic() - self._last_save < self.interval:
+            return False
+        return self.flush()
+
+    def flush(self) -> bool:
+        """Ghi snapshot đang chờ (nếu có)."""
+        metrics = self._pending
+        if metrics is None:
+            return False
+        collected = {
+            name: round(stats["last_run"], 3)
+            for name, stats in COLLECTOR_STATS.snapshot().items() if stats.get("last_run")
+        }
+        data = {"format": STATE_FILE_FORMAT, "saved": round(time.time(), 3),
+                "collected": collected, "metrics": metrics}
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._tmp_path.write_text(json.dumps(data, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+            os.replace(self._tmp_path, self.path)
+        except OSError as exc:
+            print(f"⚠ Không ghi được snapshot vào {self.path}: {exc}", file=sys.stderr)
+            return False
+        finally:
+            self._last_save = time.monotonic()
+        self._saved = metrics
+        self._pending = None
+        return True
 
 
 def write_serial(metrics: Dict[str, str], serial_path: str, retries: int = 3, retry_delay: float = 0.5, labels: Optional[List[str]] = None) -> bool:
@@ -2116,14 +5073,20 @@ def write_serial_optimized(serial_file, metrics: Dict[str, str], labels: Optiona
     Returns:
         True nếu ghi thành công, False nếu thất bại
     """
+    start = time.perf_counter()
     try:
         labels_to_send = labels if labels is not None else LABEL_ORDER
         payload_bytes = _format_metrics_payload(metrics, labels_to_send).encode("utf-8")
         serial_file.write(payload_bytes)
         serial_file.flush()  # Đảm bảo dữ liệu được gửi ngay
-        return True
     except OSError:
+        SELF_METRICS.inc("serial_write_errors")
         return False
+    finally:
+        SELF_METRICS.observe("serial_write", "", time.perf_counter() - start)
+    SELF_METRICS.inc("serial_bytes", "", len(payload_bytes))
+    SELF_METRICS.inc("serial_frames")
+    return True
 
 
 def write_serial_with_retry(
@@ -2153,11 +5116,13 @@ def write_serial_with_retry(
         if write_serial_optimized(serial_file, metrics, labels):
             return True
         if attempt < max_attempts:
+            SELF_METRICS.inc("serial_retries")
             print(
                 f"⚠ Không gửi được {dataset_name} (attempt {attempt}/{max_attempts}), "
                 f"đang retry sau {delay_seconds:.2f}s..."
             )
             time.sleep(delay_seconds)
+    SELF_METRICS.inc("serial_write_failures")
     return False
 
 
@@ -2179,7 +5144,7 @@ def find_esp32_usb_device(vendor_id: str = "303a", model_id: str = "4001") -> Op
     model_id_lower = model_id.lower()
     
     # Cách 1: Tìm trong /dev/serial/by-id/
-    by_id_path = Path("/dev/serial/by-id")
+    by_id_path = dev_path("serial/by-id")
     if by_id_path.exists():
         try:
             for symlink in by_id_path.iterdir():
@@ -2196,7 +5161,7 @@ def find_esp32_usb_device(vendor_id: str = "303a", model_id: str = "4001") -> Op
             pass
     
     # Cách 2: Tìm trong /sys/bus/usb/devices/
-    usb_devices_path = Path("/sys/bus/usb/devices")
+    usb_devices_path = sys_path("bus/usb/devices")
     if usb_devices_path.exists():
         try:
             for device_dir in usb_devices_path.iterdir():
@@ -2223,12 +5188,12 @@ def find_esp32_usb_device(vendor_id: str = "303a", model_id: str = "4001") -> Op
                                         # Tìm tty device name
                                         for tty_name in tty_path.iterdir():
                                             if tty_name.name.startswith("tty"):
-                                                device_path = Path(f"/dev/{tty_name.name}")
+                                                device_path = dev_path(tty_name.name)
                                                 if device_path.exists():
                                                     return str(device_path)
                                     
                                     # Hoặc tìm trong /sys/class/tty/
-                                    tty_class_path = Path("/sys/class/tty")
+                                    tty_class_path = sys_path("class/tty")
                                     if tty_class_path.exists():
                                         for tty_class in tty_class_path.iterdir():
                                             device_link = tty_class / "device"
@@ -2236,7 +5201,7 @@ def find_esp32_usb_device(vendor_id: str = "303a", model_id: str = "4001") -> Op
                                                 device_real = device_link.resolve()
                                                 if str(device_real).startswith(str(subdir.resolve())):
                                                     tty_name = tty_class.name
-                                                    device_path = Path(f"/dev/{tty_name}")
+                                                    device_path = dev_path(tty_name)
                                                     if device_path.exists():
                                                         return str(device_path)
                     except (OSError, ValueError, PermissionError):
@@ -2246,21 +5211,103 @@ def find_esp32_usb_device(vendor_id: str = "303a", model_id: str = "4001") -> Op
     
     # Cách 3: Fallback - tìm trong /dev/ttyACM* và /dev/ttyUSB*
     # Kiểm tra xem có device nào match không (ít chính xác hơn)
-    for pattern in ["/dev/ttyACM*", "/dev/ttyUSB*"]:
+    for pattern in ["ttyACM*", "ttyUSB*"]:
         try:
-            import glob
-            for device_path in glob.glob(pattern):
-                device = Path(device_path)
+            for device in sorted(dev_path().glob(pattern)):
                 if device.exists() and device.is_char_device():
                     # Có thể kiểm tra thêm bằng cách đọc từ sysfs
                     # Nhưng cách này không chắc chắn, chỉ dùng làm fallback
-                    return device_path
+                    return str(device)
         except Exception:
             pass
     
     return None
 
 
+def _usb_interface_ttys(device_dir: Path) -> List[str]:
+    """Liệt kê các tty device (/dev/ttyACM*) thuộc về một USB device trong sysfs.
+
+    Args:
+        device_dir: Thư mục USB device trong /sys/bus/usb/devices (ví dụ: 1-1.4)
+
+    Returns:
+        Danh sách đường dẫn tty device (đã sort), rỗng nếu không tìm thấy
+    """
+    ttys: List[str] = []
+    try:
+        for subdir in sorted(device_dir.iterdir()):
+            # Interface của USB device có dạng "1-1.4:1.0"
+            if not subdir.is_dir() or ":" not in subdir.name:
+                continue
+            tty_path = subdir / "tty"
+            if not tty_path.exists():
+                continue
+            for tty_name in sorted(tty_path.iterdir()):
+                if tty_name.name.startswith("tty"):
+                    device_path = dev_path(tty_name.name)
+                    if device_path.exists():
+                        ttys.append(str(device_path))
+    except (OSError, PermissionError):
+        pass
+    return ttys
+
+
+def find_esp32_usb_devices(vendor_id: str = "303a", model_id: str = "4001") -> List[Tuple[str, Optional[str]]]:
+    """Tìm TẤT CẢ USB device ESP32 theo vendor ID và model ID (hỗ trợ nhiều màn hình).
+
+    Khác với find_esp32_usb_device() (chỉ trả về device đầu tiên), hàm này trả về
+    mọi device khớp VID/PID kèm USB serial number để có thể phân biệt các màn hình.
+
+    Args:
+        vendor_id: Vendor ID (hex, ví dụ: "303a")
+        model_id: Model ID (hex, ví dụ: "4001")
+
+    Returns:
+        Danh sách tuple (tty device path, USB serial number hoặc None), sort theo path
+    """
+    vendor_id_lower = vendor_id.lower()
+    model_id_lower = model_id.lower()
+    found: Dict[str, Optional[str]] = {}
+
+    # Cách 1: /sys/bus/usb/devices/ - có đủ VID/PID và serial number
+    usb_devices_path = sys_path("bus/usb/devices")
+    if usb_devices_path.exists():
+        try:
+            for device_dir in sorted(usb_devices_path.iterdir()):
+                vendor_file = device_dir / "idVendor"
+                model_file = device_dir / "idProduct"
+                if not (vendor_file.exists() and model_file.exists()):
+                    continue
+                try:
+                    if vendor_file.read_text().strip().lower() != vendor_id_lower:
+                        continue
+                    if model_file.read_text().strip().lower() != model_id_lower:
+                        continue
+                    serial_file = device_dir / "serial"
+                    usb_serial = serial_file.read_text().strip() if serial_file.exists() else None
+                except (OSError, ValueError, PermissionError):
+                    continue
+                for tty in _usb_interface_ttys(device_dir):
+                    found.setdefault(tty, usb_serial or None)
+        except (OSError, PermissionError):
+            pass
+
+    # Cách 2: /dev/serial/by-id/ - bổ sung các device không thấy trong sysfs
+    by_id_path = dev_path("serial/by-id")
+    if by_id_path.exists():
+        try:
+            for symlink in sorted(by_id_path.iterdir()):
+                link_name = symlink.name.lower()
+                if symlink.is_symlink() and vendor_id_lower in link_name and model_id_lower in link_name:
+                    real_path = symlink.resolve()
+                    if real_path.exists():
+                        found.setdefault(str(real_path), None)
+        except (OSError, PermissionError):
+            pass
+
+    return sorted(found.items())
+
+
 def check_usb_device_exists(device_path: str) -> bool:
     """Kiểm tra xem USB device có tồn tại và có thể truy cập được không.
     
@@ -2382,35 +5429,672 @@ def check_esp32_backlight_state(serial_file, debug: bool = False) -> Optional[bo
         return None
 
 
-def acquire_lock(lock_file_path: Path) -> Optional[object]:
-    """Tạo và khóa lock file để tránh chạy nhiều process cùng lúc.
-    
-    Args:
-        lock_file_path: Đường dẫn đến lock file (ví dụ: read_sensor.lock)
-    
+# ---------------------------------------------------------------------------
+# USB OTA: gửi firmware qua chính kết nối USB CDC đang dùng để hiển thị
+# ---------------------------------------------------------------------------
+
+# Frame: magic(2) | seq(u32) | offset(u32) | len(u16) | payload | crc32(u32), little-endian.
+# CRC32 (giống zlib / esp_rom_crc32_le) tính trên seq..payload.
+USB_OTA_FRAME_MAGIC = b"\xa5\x5a"
+USB_OTA_FRAME_HEADER = struct.Struct("<2sIIH")
+USB_OTA_FRAME_CRC = struct.Struct("<I")
+USB_OTA_CHUNK_SIZE = 1024
+# Số frame được gửi trước khi nhận ack (sliding window)
+USB_OTA_WINDOW = 8
+# Không có ack mới sau khoảng này thì gửi lại từ offset đã ack (go-back-N)
+USB_OTA_ACK_TIMEOUT = 2.0
+USB_OTA_MAX_RETRIES = 8
+USB_OTA_BEGIN_TIMEOUT = 10.0
+# ESP32 thoát chế độ nhận frame sau 1 giây không có dữ liệu, nên ota_begin được gửi lại sau 2 giây
+USB_OTA_BEGIN_RETRY = 2.0
+# ESP32 kiểm tra SHA-256 và image trước khi trả lời 'D'
+USB_OTA_FINISH_TIMEOUT = 30.0
+# Số lần thử USB OTA tối đa cho mỗi màn hình trong một lần chạy daemon
+USB_OTA_MAX_ATTEMPTS = 3
+
+
+def build_usb_ota_frame(seq: int, offset: int, chunk: bytes) -> bytes:
+    """Đóng gói một chunk firmware thành frame có sequence number và CRC32."""
+    header = USB_OTA_FRAME_HEADER.pack(USB_OTA_FRAME_MAGIC, seq, offset, len(chunk))
+    crc = zlib.crc32(chunk, zlib.crc32(header[len(USB_OTA_FRAME_MAGIC):]))
+    return header + chunk + USB_OTA_FRAME_CRC.pack(crc & 0xFFFFFFFF)
+
+
+def esp_image_digest(firmware: bytes) -> Optional[str]:
+    """SHA-256 mà ESP-IDF gắn ở cuối image (hash_appended), dùng để so với firmware đang chạy.
+
     Returns:
-        File handle của lock file nếu thành công, None nếu đã có process khác đang chạy
-    
-    Raises:
-        SystemExit: Nếu không thể tạo lock file hoặc đã có process khác đang chạy
+        Hex digest hoặc None nếu image không có hash đính kèm
     """
-    lock_file = None
-    
-    try:
-        # Tạo thư mục chứa lock file nếu chưa có
-        lock_file_path.parent.mkdir(parents=True, exist_ok=True)
-        
-        # Mở lock file ở chế độ read+write
-        lock_file = open(lock_file_path, "w+")
-        
-        # Thử khóa file (non-blocking)
-        try:
-            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except BlockingIOError:
-            # File đã bị khóa bởi process khác
-            lock_file.close()
-            print(
-                f"Lỗi: Đã có process khác đang chạy (lock file: {lock_file_path})",
+    # esp_image_header_t.hash_appended nằm ở byte 23
+    if len(firmware) < 24 + 32 or firmware[0] != ESP_IMAGE_MAGIC or firmware[23] != 1:
+        return None
+    return firmware[-32:].hex()
+
+
+class UsbOtaUploader:
+    """Gửi firmware tới ESP32 qua serial file với ack theo cửa sổ và resume.
+
+    Host gửi frame rỗng (thoát chế độ nhận frame nếu ESP32 còn kẹt ở đó) rồi dòng
+    "ota_begin: <size> <sha256> <app_digest|->", ESP32 trả lời một dòng:
+      B<offset>  bắt đầu/tiếp tục từ offset (resume nếu đã nhận dở cùng image)
+      U          firmware đang chạy đã là image này, không cần cập nhật
+      E<code>    lỗi
+    Trong lúc nhận frame, ESP32 gửi K<offset> (ack tích lũy), N<offset> (yêu cầu gửi lại
+    từ offset), D (đã kiểm tra xong, sắp reboot) hoặc E<code>. Byte W/S (backlight)
+    có thể chen giữa các dòng và được bỏ qua.
+    """
+
+    def __init__(
+        self,
+        serial_file,
+        firmware: bytes,
+        name: str = "",
+        chunk_size: int = USB_OTA_CHUNK_SIZE,
+        window: int = USB_OTA_WINDOW,
+        ack_timeout: float = USB_OTA_ACK_TIMEOUT,
+    ):
+        self.serial_file = serial_file
+        self.firmware = firmware
+        self.name = name or getattr(serial_file, "name", "serial")
+        self.chunk_size = chunk_size
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self._buffer = b""
+
+    def _write(self, data: bytes) -> None:
+        """Ghi toàn bộ data (serial file unbuffered có thể ghi thiếu)."""
+        SELF_METRICS.inc("usb_ota_bytes", "", len(data))
+        view = memoryview(data)
+        while view:
+            written = self.serial_file.write(view)
+            if written is None:
+                select.select([], [self.serial_file], [], self.ack_timeout)
+                continue
+            view = view[written:]
+
+    def _read_replies(self, timeout: float) -> List[str]:
+        """Đọc các dòng trả lời từ ESP32 trong tối đa timeout giây."""
+        deadline = time.monotonic() + timeout
+        while b"\n" not in self._buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            ready, _, _ = select.select([self.serial_file], [], [], remaining)
+            if not ready:
+                return []
+            data = self.serial_file.read(256)
+            if not data:
+                raise OSError("Serial device đã đóng")
+            self._buffer += data
+        *lines, self._buffer = self._buffer.split(b"\n")
+        replies = []
+        for line in lines:
+            line = line.strip(b"\r").lstrip(b"WS")
+            if line:
+                replies.append(line.decode("ascii", errors="replace"))
+        return replies
+
+    def begin(self) -> Optional[int]:
+        """Gửi ota_begin và trả về offset bắt đầu, None nếu ESP32 đã chạy image này.
+
+        Ack cũ (K/N/D) của lần truyền trước còn trong buffer được bỏ qua.
+        """
+        sha256 = hashlib.sha256(self.firmware).hexdigest()
+        digest = esp_image_digest(self.firmware) or "-"
+        request = (
+            build_usb_ota_frame(0, 0, b"") + b"\n"
+            + f"ota_begin: {len(self.firmware)} {sha256} {digest}\n".encode()
+        )
+        deadline = time.monotonic() + USB_OTA_BEGIN_TIMEOUT
+        while time.monotonic() < deadline:
+            self._write(request)
+            retry_at = min(deadline, time.monotonic() + USB_OTA_BEGIN_RETRY)
+            while time.monotonic() < retry_at:
+                for reply in self._read_replies(retry_at - time.monotonic()):
+                    if reply == "U":
+                        return None
+                    if reply.startswith("B"):
+                        return int(reply[1:])
+                    if reply.startswith("E"):
+                        raise OSError(f"ESP32 từ chối USB OTA: {reply[1:]}")
+        raise OSError("ESP32 không phản hồi USB OTA")
+
+    def run(self, progress: Optional[Callable[[int, int], None]] = None) -> bool:
+        """Thực hiện toàn bộ quá trình cập nhật.
+
+        Args:
+            progress: Callback(acked_bytes, total_bytes) mỗi khi có ack mới
+
+        Returns:
+            True nếu đã gửi và ESP32 xác nhận (sẽ reboot), False nếu không cần cập nhật
+
+        Raises:
+            OSError: Khi lỗi serial, ESP32 báo lỗi hoặc quá số lần gửi lại
+        """
+        start_offset = self.begin()
+        if start_offset is None:
+            return False
+        size = len(self.firmware)
+        if start_offset:
+            print(f"{self.name}: tiếp tục USB OTA từ offset {start_offset}/{size}")
+
+        acked = next_offset = start_offset
+        retries = 0
+        done = False
+        while not done:
+            # Gửi các frame còn trong cửa sổ
+            while next_offset < size and next_offset - acked < self.window * self.chunk_size:
+                chunk = self.firmware[next_offset:next_offset + self.chunk_size]
+                self._write(build_usb_ota_frame(next_offset // self.chunk_size, next_offset, chunk))
+                SELF_METRICS.inc("usb_ota_frames")
+                next_offset += len(chunk)
+
+            timeout = self.ack_timeout if acked < size else USB_OTA_FINISH_TIMEOUT
+            replies = self._read_replies(timeout)
+            if not replies:
+                retries += 1
+                if retries > USB_OTA_MAX_RETRIES:
+                    raise OSError(f"USB OTA dừng ở offset {acked}/{size}: không nhận được ack")
+                # Go-back-N: gửi lại từ offset đã được ack
+                next_offset = acked
+                continue
+
+            for reply in replies:
+                kind, value = reply[0], reply[1:]
+                if kind == "K" and int(value) > acked:
+                    acked = int(value)
+                    retries = 0
+                    if progress:
+                        progress(acked, size)
+                elif kind == "N":
+                    acked = max(acked, int(value))
+                    next_offset = acked
+                elif kind == "D":
+                    done = True
+                elif kind == "E":
+                    raise OSError(f"ESP32 báo lỗi USB OTA: {value}")
+            next_offset = max(next_offset, acked)
+        return True
+
+
+# ---------------------------------------------------------------------------
+# Sparkline: cửa sổ ngắn các giá trị gần nhất để màn hình vẽ biểu đồ xu hướng
+# ---------------------------------------------------------------------------
+
+# Dòng gửi xuống ESP32: "spark_<tên>: =<hex>" cả cửa sổ (cũ -> mới) sau khi wake up,
+# "spark_<tên>: +<hex>" một điểm mới mỗi tick. Mỗi điểm là 1 byte 0-254, 0xFF = không có dữ liệu.
+SPARKLINE_POINTS = 60
+SPARKLINE_NONE = 0xFF
+# (tên, label nguồn, thang đo, min, max); thang "log" cho throughput trải nhiều bậc độ lớn
+SPARKLINE_SERIES: Tuple[Tuple[str, str, str, float, float], ...] = (
+    ("cpu", "label_cpu_usage_per", "linear", 0.0, 100.0),
+    ("ram", "label_ram_usage_per", "linear", 0.0, 100.0),
+    ("gpu", "label_gpu_usage_per", "linear", 0.0, 100.0),
+    ("temp_cpu", "label_temp_cpu", "linear", 20.0, 100.0),
+    ("download", "label_download_total", "log", 1e3, 1e10),
+    ("upload", "label_upload_total", "log", 1e3, 1e10),
+)
+
+
+def quantize_sparkline_value(label: str, value: Optional[str], scale: str, low: float, high: float) -> int:
+    """Lượng tử hoá giá trị hiển thị của label thành 1 byte (0-254, SPARKLINE_NONE nếu không có)."""
+    parsed = parse_metric_value(label, value) if value is not None else None
+    if parsed is None:
+        return SPARKLINE_NONE
+    number = parsed[0]
+    if scale == "log":
+        number = math.log10(max(number, low))
+        low, high = math.log10(low), math.log10(high)
+    ratio = (number - low) / (high - low)
+    return int(round(min(1.0, max(0.0, ratio)) * (SPARKLINE_NONE - 1)))
+
+
+class SparklineWindows:
+    """Cửa sổ SPARKLINE_POINTS điểm đã lượng tử của mỗi series, cho một nguồn metrics.
+
+    Mỗi tick push() đúng một lần; seq tăng theo tick để từng màn hình biết chỉ cần
+    gửi điểm mới (đã có cửa sổ tới seq - 1) hay phải gửi lại cả cửa sổ.
+    """
+
+    def __init__(self, series: Tuple[Tuple[str, str, str, float, float], ...] = SPARKLINE_SERIES,
+                 points: int = SPARKLINE_POINTS):
+        self.series = series
+        self.windows: Dict[str, deque] = {name: deque(maxlen=points) for name, *_ in series}
+        self.seq = 0
+
+    def push(self, metrics: Dict[str, str]) -> None:
+        """Thêm một điểm cho mọi series từ snapshot của tick hiện tại."""
+        for name, label, scale, low, high in self.series:
+            self.windows[name].append(quantize_sparkline_value(label, metrics.get(label), scale, low, high))
+        self.seq += 1
+
+    def full_lines(self) -> Dict[str, str]:
+        """Cả cửa sổ của mọi series (gửi sau wake up hoặc khi màn hình bị lỡ tick)."""
+        return {f"spark_{name}": "=" + bytes(window).hex() for name, window in self.windows.items()}
+
+    def append_lines(self) -> Dict[str, str]:
+        """Chỉ điểm mới nhất của mọi series."""
+        return {
+            f"spark_{name}": "+" + bytes(window)[-1:].hex()
+            for name, window in self.windows.items() if window
+        }
+
+
+class DisplayConnection:
+    """Trạng thái kết nối của MỘT màn hình ESP32 (một serial device).
+
+    Mỗi màn hình có serial file, trạng thái backlight, cờ đã gửi storage data
+    trong lần wake hiện tại và bộ đếm lỗi riêng. Tất cả màn hình dùng chung
+    một snapshot metrics mỗi tick, nên thêm màn hình chỉ tốn thêm một lần ghi.
+    """
+
+    def __init__(
+        self,
+        device_path: str,
+        usb_serial: Optional[str] = None,
+        no_wait_signal: bool = False,
+        auto_start_timeout: float = 10.0,
+        debug: bool = False,
+        retries: int = 3,
+        retry_delay: float = 0.5,
+    ):
+        self.device_path = device_path
+        self.usb_serial = usb_serial
+        self.no_wait_signal = no_wait_signal
+        self.auto_start_timeout = auto_start_timeout
+        self.debug = debug
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self.serial_file = None
+        self.backlight_is_on = no_wait_signal  # Nếu --no-wait-signal, tự động bật
+        self.previous_backlight_state = False  # Để detect wake up
+        self.storage_sent_this_wake = False  # Đã gửi storage trong lần wake này chưa
+        self.auto_start_triggered = no_wait_signal
+        self.start_time = time.time()
+        self.connection_lost_count = 0
+        self.source = LOCAL_SOURCE  # Host đang hiển thị (local hoặc tên agent)
+        self.updating = False  # Đang cập nhật firmware qua USB (main loop bỏ qua màn hình này)
+        self.firmware_notice: Optional[str] = None  # Thông báo firmware hiện tại (do main loop cập nhật)
+        self.firmware_notice_sent: Optional[str] = None  # Thông báo đã gửi trong kết nối này
+        self.sparkline_seq_sent: Optional[int] = None  # Seq cửa sổ sparkline màn hình đang có
+        self.needs_last_known = True  # Chưa gửi snapshot cũ trong kết nối này
+        self.showing_stale = False  # Màn hình đang hiển thị snapshot cũ (chờ số liệu live)
+
+    @property
+    def name(self) -> str:
+        """Tên hiển thị trong log: device path kèm USB serial (nếu có)."""
+        if self.usb_serial:
+            return f"{self.device_path} [{self.usb_serial}]"
+        return self.device_path
+
+    def open(self) -> bool:
+        """Mở serial device và reset trạng thái wake-up.
+
+        Returns:
+            True nếu mở thành công, False nếu thất bại
+        """
+        try:
+            if not check_usb_device_exists(self.device_path):
+                print(f"⚠ USB device {self.device_path} không còn tồn tại")
+                return False
+
+            self.serial_file = open(self.device_path, "r+b", buffering=0)
+            # QUAN TRỌNG: Set DTR và RTS thành True để ESP32 biết host đã mở port
+            if set_serial_dtr_rts(self.serial_file, dtr=True, rts=True):
+                print(f"✓ Đã kết nối tới {self.name} với DTR=True, RTS=True")
+            else:
+                print(f"⚠ Đã kết nối tới {self.name} (không thể set DTR/RTS)")
+            # Đợi một chút để ESP32 nhận biết trạng thái
+            time.sleep(0.1)
+        except OSError as exc:
+            print(f"⚠ Lỗi mở {self.name}: {exc}")
+            self.serial_file = None
+            self.connection_lost_count += 1
+            return False
+
+        SELF_METRICS.inc("display_connects", self.device_path)
+        # Reset các state khi kết nối mới
+        self.firmware_notice_sent = None
+        self.sparkline_seq_sent = None
+        self.needs_last_known = True
+        self.showing_stale = False
+        self.backlight_is_on = self.no_wait_signal
+        self.previous_backlight_state = False
+        self.storage_sent_this_wake = False
+        self.start_time = time.time()
+        self.auto_start_triggered = self.no_wait_signal
+
+        if self.no_wait_signal:
+            print(f"{self.name}: --no-wait-signal, bắt đầu gửi dữ liệu ngay...")
+        elif self.auto_start_timeout > 0:
+            print(
+                f"{self.name}: sẽ tự động bắt đầu gửi dữ liệu sau {self.auto_start_timeout} giây "
+                "nếu không nhận được tín hiệu từ ESP32..."
+            )
+        return True
+
+    def close(self) -> None:
+        """Đóng serial device (bỏ qua lỗi)."""
+        if self.serial_file:
+            try:
+                self.serial_file.close()
+            except Exception:
+                pass
+            self.serial_file = None
+
+    def start_firmware_update(self, firmware_path: Path) -> None:
+        """Cập nhật firmware qua USB CDC trong background thread.
+
+        Trong lúc cập nhật, main loop không đọc/ghi serial của màn hình này.
+        Sau khi ESP32 xác nhận, nó tự reboot và được kết nối lại ở lần scan sau.
+        """
+        self.updating = True
+        Thread(target=self._run_firmware_update, args=(firmware_path,), daemon=True).start()
+
+    def _run_firmware_update(self, firmware_path: Path) -> None:
+        """Thân thread USB OTA."""
+        last_report = [0.0]
+
+        def report(acked: int, total: int) -> None:
+            now = time.monotonic()
+            if now - last_report[0] >= 5.0 or acked == total:
+                last_report[0] = now
+                print(f"{self.name}: USB OTA {acked * 100 // total}% ({acked}/{total} bytes)")
+
+        try:
+            firmware = Path(firmware_path).read_bytes()
+            start = time.monotonic()
+            if UsbOtaUploader(self.serial_file, firmware, name=self.name).run(report):
+                print(f"✓ {self.name}: đã gửi firmware qua USB trong {time.monotonic() - start:.1f}s, ESP32 đang reboot")
+            else:
+                print(f"✓ {self.name}: firmware đã là bản mới nhất, bỏ qua USB OTA")
+        except (OSError, ValueError) as exc:
+            print(f"⚠ {self.name}: USB OTA thất bại: {exc}", file=sys.stderr)
+        finally:
+            # Gửi lại wake-up labels sau khi cập nhật xong
+            self.storage_sent_this_wake = False
+            self.updating = False
+
+    def push_firmware_notice(self, force: bool = False) -> None:
+        """Gửi thông báo firmware mới nếu khác lần gửi trước (hoặc force sau khi wake up).
+
+        Raises:
+            OSError: Nếu không gửi được (sau khi đã retry)
+        """
+        notice = self.firmware_notice
+        if notice is None or (notice == self.firmware_notice_sent and not force):
+            return
+        if not write_serial_with_retry(
+            self.serial_file,
+            {FIRMWARE_NOTICE_LABEL: notice},
+            [FIRMWARE_NOTICE_LABEL],
+            retries=self.retries,
+            retry_delay=self.retry_delay,
+            dataset_name="firmware notice",
+        ):
+            raise OSError("Không gửi được thông báo firmware")
+        if notice != self.firmware_notice_sent and notice != "-":
+            print(f"{self.name}: đã gửi thông báo firmware {notice.split()[0]} (màn hình hiển thị nếu mới hơn bản đang chạy)")
+        self.firmware_notice_sent = notice
+
+    def poll_backlight(self, iteration: int) -> None:
+        """Đọc tín hiệu W/S từ ESP32 và xử lý auto-start timeout.
+
+        Raises:
+            OSError: Nếu device không còn tồn tại
+        """
+        if not check_usb_device_exists(self.device_path):
+            raise OSError(f"USB device {self.device_path} không còn tồn tại")
+
+        if self.no_wait_signal:
+            return
+
+        backlight_state = check_esp32_backlight_state(self.serial_file, debug=self.debug)
+        if backlight_state is not None:
+            self.previous_backlight_state = self.backlight_is_on
+            self.backlight_is_on = backlight_state
+
+            # Detect wake up: chuyển từ off -> on
+            if self.backlight_is_on and not self.previous_backlight_state:
+                print(f"[{iteration}] {self.name}: Màn hình đã bật - Bắt đầu gửi dữ liệu")
+                self.storage_sent_this_wake = False  # Reset flag để gửi storage lần này
+                self.auto_start_triggered = True  # Đã nhận được tín hiệu, không cần auto-start
+            elif not self.backlight_is_on and self.previous_backlight_state:
+                print(f"[{iteration}] {self.name}: Màn hình đã tắt - Dừng gửi dữ liệu")
+                self.storage_sent_this_wake = False  # Reset flag cho lần wake tiếp theo
+
+        # Auto-start nếu không nhận được tín hiệu sau timeout
+        elapsed_time = time.time() - self.start_time
+        if (
+            not self.auto_start_triggered
+            and self.auto_start_timeout > 0
+            and elapsed_time >= self.auto_start_timeout
+        ):
+            print(
+                f"[{iteration}] {self.name}: Không nhận được tín hiệu từ ESP32 sau {elapsed_time:.1f} giây - "
+                "Tự động bắt đầu gửi dữ liệu"
+            )
+            self.backlight_is_on = True
+            self.auto_start_triggered = True
+            self.storage_sent_this_wake = False
+
+    def send_last_known(self, metrics: Dict[str, str], age: float) -> None:
+        """Gửi snapshot cũ (trước restart/reconnect) kèm dòng STALE_LABEL báo tuổi snapshot.
+
+        ESP32 hiển thị mờ cho tới khi send() gửi số liệu live và "snapshot_stale: 0".
+
+        Raises:
+            OSError: Nếu không gửi được (sau khi đã retry)
+        """
+        frame = dict(metrics)
+        frame[STALE_LABEL] = str(max(1, int(age)))
+        labels = [label for label in LABEL_ORDER if label in frame] + [STALE_LABEL]
+        if not write_serial_with_retry(
+            self.serial_file,
+            frame,
+            labels,
+            retries=self.retries,
+            retry_delay=self.retry_delay,
+            dataset_name="last known snapshot",
+        ):
+            raise OSError("Không gửi được snapshot cũ")
+        self.showing_stale = True
+
+    def send_first_frame(self, metrics: Dict[str, str]) -> None:
+        """Gửi các label đã có (từ quick_metrics) ngay sau wake up, trước snapshot đầy đủ.
+
+        Không đánh dấu storage đã gửi: send() vẫn gửi WAKEUP_LABELS ngay sau đó.
+
+        Raises:
+            OSError: Nếu không gửi được (sau khi đã retry)
+        """
+        labels = [label for label in DYNAMIC_LABELS if label in metrics]
+        if labels and not write_serial_with_retry(
+            self.serial_file,
+            metrics,
+            labels,
+            retries=self.retries,
+            retry_delay=self.retry_delay,
+            dataset_name="first frame",
+        ):
+            raise OSError("Không gửi được frame đầu")
+
+    def send(self, metrics: Dict[str, str], iteration: int,
+             sparklines: Optional[SparklineWindows] = None) -> None:
+        """Gửi snapshot metrics tới màn hình này.
+
+        Lần đầu sau wake up gửi cả WAKEUP_LABELS và DYNAMIC_LABELS,
+        các lần sau chỉ gửi DYNAMIC_LABELS. Sparkline (nếu có) gửi cả cửa sổ
+        sau wake up, sau đó chỉ điểm mới mỗi tick.
+
+        Raises:
+            OSError: Nếu không gửi được (sau khi đã retry)
+        """
+        if not self.storage_sent_this_wake:
+            # Gửi storage labels (1 lần duy nhất)
+            if not write_serial_with_retry(
+                self.serial_file,
+                metrics,
+                WAKEUP_LABELS,
+                retries=self.retries,
+                retry_delay=self.retry_delay,
+                dataset_name="storage data",
+            ):
+                raise OSError("Không gửi được storage data")
+            print(f"[{iteration}] {self.name}: Đã gửi storage data (1 lần duy nhất)")
+            self.storage_sent_this_wake = True
+            # Nhắc lại thông báo firmware mới sau mỗi lần wake up
+            self.push_firmware_notice(force=True)
+            # Màn hình có thể đã reset hoặc đổi host hiển thị: gửi lại cả cửa sổ sparkline
+            self.sparkline_seq_sent = None
+
+        if not write_serial_with_retry(
+            self.serial_file,
+            metrics,
+            DYNAMIC_LABELS,
+            retries=self.retries,
+            retry_delay=self.retry_delay,
+            dataset_name="dynamic data",
+        ):
+            raise OSError("Không gửi được dynamic data")
+        print(f"[{iteration}] Đã gửi dynamic data tới {self.name}")
+        if self.showing_stale:
+            # Đã có số liệu live đầy đủ: bỏ làm mờ
+            if not write_serial_with_retry(
+                self.serial_file,
+                {STALE_LABEL: "0"},
+                [STALE_LABEL],
+                retries=self.retries,
+                retry_delay=self.retry_delay,
+                dataset_name="stale marker",
+            ):
+                raise OSError("Không gửi được trạng thái live")
+            self.showing_stale = False
+        if sparklines is not None:
+            self.push_sparklines(sparklines)
+        self.connection_lost_count = 0
+
+    def push_sparklines(self, sparklines: SparklineWindows) -> None:
+        """Gửi điểm sparkline mới, hoặc cả cửa sổ nếu màn hình chưa có tick trước đó.
+
+        Raises:
+            OSError: Nếu không gửi được (sau khi đã retry)
+        """
+        if self.sparkline_seq_sent == sparklines.seq:
+            return
+        if self.sparkline_seq_sent is not None and self.sparkline_seq_sent + 1 == sparklines.seq:
+            lines = sparklines.append_lines()
+        else:
+            lines = sparklines.full_lines()
+        if not write_serial_with_retry(
+            self.serial_file,
+            lines,
+            list(lines),
+            retries=self.retries,
+            retry_delay=self.retry_delay,
+            dataset_name="sparkline",
+        ):
+            raise OSError("Không gửi được sparkline")
+        self.sparkline_seq_sent = sparklines.seq
+
+
+def wait_for_display_input(displays: List[DisplayConnection], timeout: float) -> bool:
+    """Block tới khi một màn hình gửi dữ liệu (W/S...) hoặc hết timeout.
+
+    Bỏ qua màn hình đang USB OTA (thread OTA đang đọc serial của nó).
+
+    Returns:
+        True nếu có màn hình gửi dữ liệu, False nếu hết timeout
+    """
+    files = [d.serial_file for d in displays if d.serial_file is not None and not d.updating]
+    if not files:
+        time.sleep(timeout)
+        return False
+    try:
+        ready, _, _ = select.select(files, [], [], timeout)
+    except (OSError, ValueError):
+        # Serial bị đóng/rút: để tick tiếp theo phát hiện và kết nối lại
+        return True
+    return bool(ready)
+
+
+def discover_displays(
+    vendor_id: str,
+    model_id: str,
+    fixed_devices: Optional[List[str]] = None,
+    usb_serials: Optional[List[str]] = None,
+) -> List[Tuple[str, Optional[str]]]:
+    """Tìm các màn hình cần quản lý theo cấu hình CLI.
+
+    - fixed_devices: đường dẫn chỉ định thủ công (--serial-device), luôn được dùng nếu tồn tại
+    - usb_serials: chỉ nhận các device VID/PID có USB serial nằm trong danh sách (--usb-serial)
+    - Nếu không chỉ định gì: nhận tất cả device khớp VID/PID, fallback /dev/ttyACM* đầu tiên
+
+    Args:
+        vendor_id: Vendor ID để tìm USB device
+        model_id: Model ID để tìm USB device
+        fixed_devices: Danh sách device path cố định
+        usb_serials: Danh sách USB serial number cần match
+
+    Returns:
+        Danh sách tuple (device path, USB serial hoặc None) đang có mặt
+    """
+    result: Dict[str, Optional[str]] = {}
+
+    for device_path in fixed_devices or []:
+        if check_usb_device_exists(device_path):
+            result[device_path] = None
+
+    if fixed_devices and not usb_serials:
+        return sorted(result.items())
+
+    wanted_serials = {s.lower() for s in usb_serials or []}
+    for device_path, usb_serial in find_esp32_usb_devices(vendor_id, model_id):
+        if wanted_serials and (usb_serial or "").lower() not in wanted_serials:
+            continue
+        if check_usb_device_exists(device_path):
+            result.setdefault(device_path, usb_serial)
+
+    # Fallback giống hành vi cũ: không có device nào khớp VID/PID -> dùng device đầu tiên tìm được
+    if not result and not fixed_devices and not wanted_serials:
+        found_device = find_esp32_usb_device(vendor_id, model_id)
+        if found_device and check_usb_device_exists(found_device):
+            result[found_device] = None
+
+    return sorted(result.items())
+
+
+def acquire_lock(lock_file_path: Path) -> Optional[object]:
+    """Tạo và khóa lock file để tránh chạy nhiều process cùng lúc.
+    
+    Args:
+        lock_file_path: Đường dẫn đến lock file (ví dụ: read_sensor.lock)
+    
+    Returns:
+        File handle của lock file nếu thành công, None nếu đã có process khác đang chạy
+    
+    Raises:
+        SystemExit: Nếu không thể tạo lock file hoặc đã có process khác đang chạy
+    """
+    lock_file = None
+    
+    try:
+        # Tạo thư mục chứa lock file nếu chưa có
+        lock_file_path.parent.mkdir(parents=True, exist_ok=True)
+        
+        # Mở lock file ở chế độ read+write
+        lock_file = open(lock_file_path, "w+")
+        
+        # Thử khóa file (non-blocking)
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # File đã bị khóa bởi process khác
+            lock_file.close()
+            print(
+                f"Lỗi: Đã có process khác đang chạy (lock file: {lock_file_path})",
                 file=sys.stderr,
             )
             print("Vui lòng đợi process hiện tại kết thúc hoặc xóa lock file nếu process đã bị kill.", file=sys.stderr)
@@ -2484,6 +6168,25 @@ def check_stale_lock(lock_file_path: Path) -> bool:
         return True  # Không đọc được, coi như stale
 
 
+def wait_process_exit(pid: int, timeout: float) -> bool:
+    """Đợi process thoát (poll mỗi 50 ms thay vì sleep cố định).
+
+    Returns:
+        True nếu process đã thoát trong timeout
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            return False
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.05)
+
+
 def kill_existing_process(lock_file_path: Path) -> bool:
     """Kill process cũ nếu đang chạy (dựa trên PID trong lock file).
     
@@ -2516,18 +6219,11 @@ def kill_existing_process(lock_file_path: Path) -> bool:
             try:
                 # Gửi SIGTERM trước (graceful shutdown)
                 os.kill(pid, signal.SIGTERM)
-                # Đợi một chút để process tự dừng
-                time.sleep(2.0)
-                # Kiểm tra lại xem process đã dừng chưa
-                try:
-                    os.kill(pid, 0)
-                    # Vẫn còn chạy, dùng SIGKILL (force kill)
+                # Đợi process tự dừng (tối đa 2s), vẫn còn chạy thì dùng SIGKILL (force kill)
+                if not wait_process_exit(pid, 2.0):
                     print(f"Process chưa dừng, đang force kill (SIGKILL)...")
                     os.kill(pid, signal.SIGKILL)
-                    time.sleep(0.5)
-                except ProcessLookupError:
-                    # Process đã dừng
-                    pass
+                    wait_process_exit(pid, 0.5)
             except ProcessLookupError:
                 # Process đã dừng trước đó
                 pass
@@ -2535,10 +6231,7 @@ def kill_existing_process(lock_file_path: Path) -> bool:
                 print(f"Không có quyền kill process {pid}", file=sys.stderr)
                 return False
             
-            # Đợi một chút để lock file được giải phóng
-            time.sleep(0.5)
-            
-            # Xóa lock file nếu vẫn còn
+            # Xóa lock file (flock đã được giải phóng khi process cũ thoát) nếu vẫn còn
             try:
                 if lock_file_path.exists():
                     lock_file_path.unlink()
@@ -2567,30 +6260,32 @@ def kill_existing_process(lock_file_path: Path) -> bool:
         return False
 
 
-def create_version_json(script_dir: Path) -> None:
-    """Tạo file version.json với thông tin version và firmware.
+def create_version_json(script_dir: Path, manifest: Optional["FirmwareManifest"] = None) -> None:
+    """Ghi file version.json từ firmware manifest (chỉ ghi khi nội dung thay đổi).
     
     Args:
         script_dir: Thư mục chứa script (để lưu version.json)
+        manifest: Manifest đã tính sẵn (default: đọc firmware cạnh script)
     """
-    firmware_path = script_dir / 'JonsboN4Monitor.bin'
+    if manifest is None:
+        manifest = FirmwareManifest(script_dir / FIRMWARE_FILENAME).refresh()
     version_json_path = script_dir / 'version.json'
     
     try:
-        firmware_size = firmware_path.stat().st_size if firmware_path.exists() else 0
-        version_info = {
-            "version": VERSION,
-            "firmware_size": firmware_size,
-            "firmware_path": str(firmware_path),
-            "available": firmware_path.exists(),
-            "build_date": datetime.now().isoformat(),
-            "server_script": "read_sensor.py"
-        }
+        json_data = manifest.json_bytes()
+        try:
+            if version_json_path.read_bytes() == json_data:
+                return
+        except OSError:
+            pass
         
-        with open(version_json_path, 'w', encoding='utf-8') as f:
-            json.dump(version_info, f, indent=2, ensure_ascii=False)
+        tmp_path = version_json_path.with_name(version_json_path.name + '.tmp')
+        tmp_path.write_bytes(json_data)
+        os.replace(tmp_path, version_json_path)
         
-        print(f"✓ Đã tạo version.json: version {VERSION}, firmware size: {firmware_size} bytes")
+        info = manifest.info()
+        print(f"✓ Đã cập nhật version.json: version {info['version']}, "
+              f"firmware size: {info['firmware_size']} bytes")
     except Exception as e:
         print(f"⚠ Không thể tạo version.json: {e}", file=sys.stderr)
 
@@ -2614,85 +6309,624 @@ def load_version_json(script_dir: Path) -> Optional[Dict]:
     return None
 
 
+# ---------------------------------------------------------------------------
+# Firmware manifest: version/size/SHA-256 tính 1 lần, cập nhật khi file thay đổi
+# ---------------------------------------------------------------------------
+
+# ESP-IDF image: header 24 bytes + segment header 8 bytes, sau đó là esp_app_desc_t
+ESP_IMAGE_MAGIC = 0xE9
+ESP_APP_DESC_MAGIC = 0xABCD5432
+ESP_APP_DESC_OFFSET = 24 + 8
+# esp_app_desc_t: magic, secure_version, reserv1[2], version[32], project_name[32],
+#                 time[16], date[16], idf_ver[32], app_elf_sha256[32]
+ESP_APP_DESC_STRUCT = struct.Struct("<II8s32s32s16s16s32s32s")
+
+# inotify constants (<sys/inotify.h>)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT_STRUCT = struct.Struct("iIII")
+
+
+def _c_string(raw: bytes) -> str:
+    """Đọc chuỗi C (kết thúc bằng NUL) từ bytes."""
+    return raw.split(b"\0", 1)[0].decode("utf-8", errors="replace")
+
+
+def parse_app_descriptor(header: bytes) -> Optional[Dict[str, str]]:
+    """Parse esp_app_desc_t từ phần đầu file firmware .bin.
+
+    Args:
+        header: Ít nhất ESP_APP_DESC_OFFSET + ESP_APP_DESC_STRUCT.size bytes đầu của file
+
+    Returns:
+        Dict chứa version, project_name, build_time, build_date, idf_version,
+        app_elf_sha256 hoặc None nếu không phải image ESP-IDF hợp lệ
+    """
+    end = ESP_APP_DESC_OFFSET + ESP_APP_DESC_STRUCT.size
+    if len(header) < end or header[0] != ESP_IMAGE_MAGIC:
+        return None
+    (magic, _secure_version, _reserved, version, project_name,
+     build_time, build_date, idf_ver, elf_sha256) = ESP_APP_DESC_STRUCT.unpack(header[ESP_APP_DESC_OFFSET:end])
+    if magic != ESP_APP_DESC_MAGIC:
+        return None
+    return {
+        "version": _c_string(version),
+        "project_name": _c_string(project_name),
+        "build_time": _c_string(build_time),
+        "build_date": _c_string(build_date),
+        "idf_version": _c_string(idf_ver),
+        "app_elf_sha256": elf_sha256.hex(),
+    }
+
+
+# Dòng thông báo firmware mới gửi qua serial: "firmware_available: <version> <size> <sha256>"
+# ("-" khi không có firmware). ESP32 tự so version với firmware đang chạy và chỉ hiển thị
+# khi version này mới hơn (file .bin bị thay bằng bản cũ thì không báo).
+FIRMWARE_NOTICE_LABEL = "firmware_available"
+
+
+def format_firmware_notice(info: Dict[str, object]) -> str:
+    """Giá trị dòng firmware_available từ manifest info."""
+    if not info.get("available"):
+        return "-"
+    return f"{info['version']} {info['firmware_size']} {info['sha256']}"
+
+
+class FirmwareManifest:
+    """Thông tin firmware (version từ app descriptor, size, SHA-256, mtime) giữ trong RAM.
+
+    Chỉ tính lại khi file thay đổi (do FirmwareWatcher báo), nên /version và ETag
+    của /firmware.bin không cần đọc disk ở mỗi request.
+    """
+
+    def __init__(self, firmware_path: Path):
+        self.firmware_path = Path(firmware_path)
+        self._lock = Lock()
+        self._info: Dict[str, object] = {}
+        self._json = b""
+
+    def refresh(self) -> "FirmwareManifest":
+        """Đọc lại file firmware và tính SHA-256 (chạy khi start hoặc khi file thay đổi)."""
+        info: Dict[str, object] = {
+            "version": get_version(),
+            "firmware_size": 0,
+            "firmware_path": str(self.firmware_path),
+            "available": False,
+            "sha256": None,
+            "mtime": None,
+            "build_date": None,
+            "server_script": "read_sensor.py",
+        }
+        try:
+            with open(self.firmware_path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                digest = hashlib.sha256()
+                header = f.read(ESP_APP_DESC_OFFSET + ESP_APP_DESC_STRUCT.size)
+                digest.update(header)
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            app_desc = parse_app_descriptor(header)
+            info.update({
+                "firmware_size": stat.st_size,
+                "available": True,
+                "sha256": digest.hexdigest(),
+                "mtime": stat.st_mtime,
+                "mtime_ns": stat.st_mtime_ns,
+                "build_date": datetime.fromtimestamp(stat.st_mtime).isoformat(),
+            })
+            if app_desc:
+                info["version"] = app_desc["version"]
+                info["app_desc"] = app_desc
+            else:
+                print(f"⚠ Không đọc được app descriptor trong {self.firmware_path}, dùng version {get_version()}",
+                      file=sys.stderr)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"⚠ Không thể đọc firmware {self.firmware_path}: {e}", file=sys.stderr)
+
+        public_info = {k: v for k, v in info.items() if k != "mtime_ns"}
+        json_data = json.dumps(public_info, indent=2, ensure_ascii=False).encode("utf-8")
+        with self._lock:
+            self._info = info
+            self._json = json_data
+        return self
+
+    def info(self) -> Dict[str, object]:
+        """Bản copy thông tin firmware hiện tại."""
+        with self._lock:
+            return dict(self._info)
+
+    def json_bytes(self) -> bytes:
+        """JSON đã serialize sẵn cho endpoint /version."""
+        with self._lock:
+            return self._json
+
+    @property
+    def etag(self) -> Optional[str]:
+        """ETag theo SHA-256 của firmware, None nếu không có file."""
+        with self._lock:
+            sha256 = self._info.get("sha256")
+        return f'"{sha256}"' if sha256 else None
+
+    def etag_for(self, stat: os.stat_result) -> str:
+        """ETag cho file đang mở: dùng SHA-256 nếu manifest khớp với file, ngược lại dùng mtime-size."""
+        with self._lock:
+            matches = (
+                self._info.get("mtime_ns") == stat.st_mtime_ns
+                and self._info.get("firmware_size") == stat.st_size
+            )
+            sha256 = self._info.get("sha256")
+        if matches and sha256:
+            return f'"{sha256}"'
+        return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+class FirmwareWatcher:
+    """Theo dõi file firmware bằng inotify (fallback: stat polling) và refresh manifest khi thay đổi."""
+
+    def __init__(self, manifest: FirmwareManifest, poll_interval: float = 5.0,
+                 on_change: Optional[Callable[[FirmwareManifest], None]] = None):
+        self.manifest = manifest
+        self.poll_interval = poll_interval
+        self.on_change = on_change
+
+    def _inotify_fd(self) -> Optional[int]:
+        """Tạo inotify watch cho thư mục chứa firmware, None nếu không hỗ trợ."""
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                return None
+            # Watch thư mục (không watch file) để bắt được cả rename/replace file
+            mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE | IN_ATTRIB
+            directory = str(self.manifest.firmware_path.parent).encode()
+            if libc.inotify_add_watch(fd, directory, mask) < 0:
+                os.close(fd)
+                return None
+            return fd
+        except (OSError, AttributeError):
+            return None
+
+    def run(self) -> None:
+        """Vòng lặp watcher (chạy trong background thread).
+
+        Gọi on_change một lần khi bắt đầu (ví dụ ghi version.json) để main thread không
+        phải chờ ghi disk lúc khởi động.
+        """
+        if self.on_change is not None:
+            self.on_change(self.manifest)
+        fd = self._inotify_fd()
+        if fd is None:
+            print("⚠ inotify không khả dụng, theo dõi firmware bằng stat polling", file=sys.stderr)
+            self._poll_loop()
+            return
+
+        target = self.manifest.firmware_path.name
+        while True:
+            select.select([fd], [], [])
+            try:
+                data = os.read(fd, 4096)
+            except BlockingIOError:
+                continue
+            changed = False
+            offset = 0
+            while offset + INOTIFY_EVENT_STRUCT.size <= len(data):
+                _wd, _mask, _cookie, name_len = INOTIFY_EVENT_STRUCT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT_STRUCT.size
+                name = data[offset:offset + name_len].split(b"\0", 1)[0].decode(errors="replace")
+                offset += name_len
+                if name == target:
+                    changed = True
+            if changed:
+                self._refresh()
+
+    def _poll_loop(self) -> None:
+        """Fallback khi không có inotify: so sánh mtime/size định kỳ."""
+        last = None
+        while True:
+            try:
+                stat = self.manifest.firmware_path.stat()
+                current = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                current = None
+            if last is not None and current != last:
+                self._refresh()
+            last = current
+            time.sleep(self.poll_interval)
+
+    def _refresh(self) -> None:
+        """Tính lại manifest và log version mới."""
+        info = self.manifest.refresh().info()
+        if info.get("available"):
+            print(f"✓ Firmware thay đổi: version {info.get('version')}, {info.get('firmware_size')} bytes, "
+                  f"sha256 {str(info.get('sha256'))[:12]}...")
+        else:
+            print("⚠ Firmware đã bị xóa")
+        if self.on_change is not None:
+            self.on_change(self.manifest)
+
+    def start(self) -> None:
+        """Start watcher trong daemon thread."""
+        Thread(target=self.run, daemon=True).start()
+
+
+# Tên file firmware được serve qua OTA server
+FIRMWARE_FILENAME = "JonsboN4Monitor.bin"
+
+# Regex cho header Range (chỉ hỗ trợ một range: bytes=start-end, bytes=start-, bytes=-suffix)
+RANGE_HEADER_RE = re.compile(r"^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$")
+
+
+def parse_range_header(header: Optional[str], file_size: int) -> Optional[Tuple[int, int]]:
+    """Parse header Range của HTTP request.
+
+    Args:
+        header: Giá trị header Range (None nếu không có)
+        file_size: Kích thước file (bytes)
+
+    Returns:
+        Tuple (start, end) inclusive nếu là range hợp lệ, None nếu không có Range
+        hoặc Range không parse được (khi đó serve toàn bộ file)
+
+    Raises:
+        ValueError: Nếu Range hợp lệ về cú pháp nhưng nằm ngoài file (416)
+    """
+    if not header:
+        return None
+    match = RANGE_HEADER_RE.match(header)
+    if not match:
+        # Multi-range hoặc unit lạ: bỏ qua Range, trả về toàn bộ file (RFC 7233 cho phép)
+        return None
+    start_str, end_str = match.groups()
+    if not start_str and not end_str:
+        return None
+    if not start_str:
+        # bytes=-N: N byte cuối
+        suffix = int(end_str)
+        if suffix == 0:
+            raise ValueError("Suffix range rỗng")
+        return max(0, file_size - suffix), file_size - 1
+    start = int(start_str)
+    end = int(end_str) if end_str else file_size - 1
+    if start >= file_size or end < start:
+        raise ValueError(f"Range {header} nằm ngoài file ({file_size} bytes)")
+    return start, min(end, file_size - 1)
+
+
+def is_loopback_address(address: str) -> bool:
+    """True nếu địa chỉ client là loopback (127.0.0.0/8, ::1, kể cả dạng ::ffff:127.0.0.1)."""
+    try:
+        ip = ipaddress.ip_address(address.split('%', 1)[0])
+    except ValueError:
+        return False
+    mapped = getattr(ip, "ipv4_mapped", None)
+    return (mapped or ip).is_loopback
+
+
+# Route được ghi histogram riêng, các path khác gộp vào "other"
+HTTP_ROUTES = frozenset((
+    '/', '/firmware.bin', '/version', '/version.json', '/metrics', '/api/snapshot',
+    '/api/history', '/api/profile', '/api/self', '/health', '/status',
+))
+
+
 class OTARequestHandler(BaseHTTPRequestHandler):
     """HTTP Request Handler cho OTA server.
     
     Serve firmware file và version info cho ESP32 OTA update.
+    Dùng HTTP/1.1 keep-alive, gửi firmware bằng sendfile (zero-copy),
+    hỗ trợ Range (resume OTA), ETag/If-None-Match và HEAD.
     """
-    
-    def do_GET(self):
-        """Handle GET requests."""
-        script_dir = Path(__file__).parent
-        firmware_path = script_dir / 'JonsboN4Monitor.bin'
-        
-        if self.path == '/firmware.bin' or self.path == '/':
-            # Serve firmware file
-            if firmware_path.exists():
-                try:
-                    file_size = firmware_path.stat().st_size
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/octet-stream')
-                    self.send_header('Content-Length', str(file_size))
-                    self.send_header('Content-Disposition', 'attachment; filename="JonsboN4Monitor.bin"')
-                    self.end_headers()
-                    
-                    # Stream file in chunks
-                    with open(firmware_path, 'rb') as f:
-                        while True:
-                            chunk = f.read(8192)  # 8KB chunks
-                            if not chunk:
-                                break
-                            self.wfile.write(chunk)
-                except Exception as e:
-                    self.send_response(500)
-                    self.end_headers()
-                    self.wfile.write(f"Error serving file: {e}".encode())
-            else:
-                self.send_response(404)
-                self.send_header('Content-Type', 'text/plain')
+
+    protocol_version = "HTTP/1.1"
+    # Đóng connection keep-alive nếu client không gửi request mới sau 30 giây
+    timeout = 30
+    # Header và body được ghi riêng, tắt Nagle để response nhỏ không bị trễ ~40ms
+    disable_nagle_algorithm = True
+
+    @property
+    def firmware_path(self) -> Path:
+        """File firmware đang được serve (cấu hình trên OTAHTTPServer)."""
+        return self.server.firmware_path
+
+    def _send_body(self, status: int, content_type: str, body: bytes,
+                   headers: Optional[Dict[str, str]] = None) -> None:
+        """Gửi response có body nhỏ (JSON/text), luôn kèm Content-Length cho keep-alive."""
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _serve_firmware(self) -> None:
+        """Serve firmware file với Range/ETag, body gửi bằng sendfile."""
+        try:
+            firmware_file = open(self.firmware_path, 'rb')
+        except OSError:
+            self._send_body(404, 'text/plain', b'Firmware file not found')
+            return
+
+        with firmware_file:
+            # fstat trên fd đã mở: size/mtime khớp đúng với nội dung sẽ gửi
+            stat = os.fstat(firmware_file.fileno())
+            file_size = stat.st_size
+            etag = self.server.manifest.etag_for(stat)
+            common_headers = {
+                'ETag': etag,
+                'Accept-Ranges': 'bytes',
+                'Last-Modified': self.date_time_string(int(stat.st_mtime)),
+            }
+
+            if_none_match = self.headers.get('If-None-Match')
+            if if_none_match and (if_none_match.strip() == '*' or etag in if_none_match):
+                self.send_response(304)
+                for name, value in common_headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', '0')
                 self.end_headers()
-                self.wfile.write(b'Firmware file not found')
-        
-        elif self.path == '/version' or self.path == '/version.json':
-            # Return version info as JSON (đọc từ version.json nếu có)
+                return
+
+            range_header = self.headers.get('Range')
+            if_range = self.headers.get('If-Range')
+            if if_range and if_range.strip() != etag:
+                # Firmware đã thay đổi kể từ lần tải trước: gửi lại toàn bộ file
+                range_header = None
             try:
-                version_info = load_version_json(script_dir)
-                if version_info is None:
-                    # Fallback nếu không có version.json
-                    firmware_size = firmware_path.stat().st_size if firmware_path.exists() else 0
-                    version_info = {
-                        "version": VERSION,
-                        "firmware_size": firmware_size,
-                        "firmware_path": str(firmware_path),
-                        "available": firmware_path.exists()
-                    }
-                
-                # Convert to JSON string first to get length
-                json_data = json.dumps(version_info, indent=2).encode('utf-8')
-                
+                byte_range = parse_range_header(range_header, file_size)
+            except ValueError:
+                self._send_body(416, 'text/plain', b'Requested range not satisfiable',
+                                {'Content-Range': f'bytes */{file_size}', **common_headers})
+                return
+
+            if byte_range is None:
+                start, end = 0, file_size - 1
                 self.send_response(200)
-                self.send_header('Content-Type', 'application/json; charset=utf-8')
-                self.send_header('Content-Length', str(len(json_data)))
-                self.end_headers()
-                self.wfile.write(json_data)
-            except Exception as e:
-                self.send_response(500)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": str(e)}).encode())
+            else:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{file_size}')
+            length = max(0, end - start + 1)
+
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(length))
+            self.send_header('Content-Disposition', f'attachment; filename="{FIRMWARE_FILENAME}"')
+            for name, value in common_headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+
+            if self.command == 'HEAD' or length == 0:
+                return
+            # socket.sendfile dùng os.sendfile (zero-copy) trên Linux
+            self.connection.sendfile(firmware_file, offset=start, count=length)
+
+    def _serve_version(self) -> None:
+        """Trả về version info dạng JSON từ manifest trong RAM (không đọc disk)."""
+        manifest = self.server.manifest
+        etag = manifest.etag
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'} if etag else {'Cache-Control': 'no-cache'}
+        if etag and etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self._send_body(200, 'application/json; charset=utf-8', manifest.json_bytes(), headers)
+
+    def _serve_snapshot(self) -> None:
+        """JSON snapshot mới nhất (serialize sẵn mỗi tick), hỗ trợ ETag/304 và gzip."""
+        payload = SNAPSHOT_SERIALIZER.current()
+        headers = {'ETag': payload.etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+        if payload.etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = payload.body
+        gzip_body = payload.gzip_body if 'gzip' in self.headers.get('Accept-Encoding', '') else None
+        if gzip_body is not None:
+            body = gzip_body
+            headers['Content-Encoding'] = 'gzip'
+        self._send_body(200, 'application/json; charset=utf-8', body, headers)
+
+    def _serve_stream(self) -> None:
+        """Server-Sent Events: full snapshot khi kết nối, sau đó delta mỗi tick.
+
+        Client bị lỡ tick (chậm hoặc reconnect với Last-Event-ID cũ) nhận lại full snapshot.
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.end_headers()
+        # Không có Content-Length: stream kết thúc khi đóng connection
+        self.close_connection = True
+        if self.command == 'HEAD':
+            return
+
+        self.wfile.write(b"retry: 5000\n\n")
+        last_seq = parse_sse_event_id(self.headers.get('Last-Event-ID'))
+        while True:
+            payload = SNAPSHOT_SERIALIZER.current()
+            if payload.seq > max(last_seq, 0):
+                self.wfile.write(payload.delta_event if payload.seq == last_seq + 1 else payload.full_event)
+                last_seq = payload.seq
+                continue
+            if SNAPSHOT_STORE.wait_for_update(payload.seq, SSE_KEEPALIVE_SECONDS) <= payload.seq:
+                self.wfile.write(b": keepalive\n\n")
+
+    def _serve_history(self) -> None:
+        """Lịch sử một label trong khoảng thời gian: /api/history?label=&start=&end=&points=.
+
+        start/end là epoch giây; giá trị <= 0 tính tương đối so với hiện tại (start=-3600 là 1 giờ trước).
+        Không có label thì trả về danh sách label, các tầng và bộ nhớ đang dùng.
+        """
+        query = parse_qs(self.path.split('?', 1)[1] if '?' in self.path else '')
+        label = query.get('label', [''])[0]
+        if not label:
+            data = {
+                "labels": METRIC_HISTORY.labels(),
+                "tiers": [{"step": step, "points": capacity} for step, capacity in METRIC_HISTORY.tiers],
+                "memory_bytes": METRIC_HISTORY.nbytes(),
+            }
+            self._send_body(200, 'application/json; charset=utf-8',
+                            json.dumps(data, ensure_ascii=False).encode('utf-8'), {'Cache-Control': 'no-cache'})
+            return
+
+        now = time.time()
+        try:
+            start = float(query.get('start', ['-3600'])[0])
+            end = float(query.get('end', ['0'])[0])
+            max_points = int(query['points'][0]) if 'points' in query else None
+        except ValueError:
+            self._send_body(400, 'text/plain', b'Bad Request')
+            return
+        start = now + start if start <= 0 else start
+        end = now + end if end <= 0 else end
+        if max_points is not None and max_points <= 0 or end < start:
+            self._send_body(400, 'text/plain', b'Bad Request')
+            return
+
+        history = METRIC_HISTORY.query(label, start, end, max_points, now)
+        if history is None:
+            self._send_body(404, 'text/plain', b'Not Found')
+            return
+        # Giá trị lưu dạng float32: làm tròn 7 chữ số có nghĩa để JSON không kèm nhiễu
+        history["points"] = [
+            [t, float(f"{lo:.7g}"), float(f"{hi:.7g}"), float(f"{mean:.7g}")]
+            for t, lo, hi, mean in history["points"]
+        ]
+        history["start"], history["end"] = int(start), int(end)
+        self._send_body(200, 'application/json; charset=utf-8',
+                        json.dumps(history, ensure_ascii=False, separators=(",", ":")).encode('utf-8'),
+                        {'Cache-Control': 'no-cache'})
+
+    def _serve_profile(self) -> None:
+        """GET: trạng thái profiler và các dump gần nhất. POST ?ticks=&mode=: profile N tick tiếp theo.
+
+        POST chỉ nhận từ localhost (OTA server lắng nghe trên 0.0.0.0 cho cả LAN) và
+        trả về 409 nếu đang có phiên profile chạy hoặc chờ bắt đầu.
+        """
+        if self.command == 'POST':
+            if not is_loopback_address(self.client_address[0]):
+                self._send_body(403, 'text/plain', b'Forbidden')
+                return
+            query = parse_qs(self.path.split('?', 1)[1] if '?' in self.path else '')
+            mode = query.get('mode', [None])[0]
+            try:
+                ticks = int(query['ticks'][0]) if 'ticks' in query else None
+            except ValueError:
+                ticks = 0
+            if ticks is not None and ticks <= 0 or mode is not None and mode not in PROFILE_MODES:
+                self._send_body(400, 'text/plain', b'Bad Request')
+                return
+            if not TICK_PROFILER.request(ticks, mode, exclusive=True):
+                self._send_body(409, 'application/json; charset=utf-8',
+                                json.dumps(TICK_PROFILER.status(), ensure_ascii=False).encode('utf-8'),
+                                {'Cache-Control': 'no-cache'})
+                return
+        self._send_body(202 if self.command == 'POST' else 200, 'application/json; charset=utf-8',
+                        json.dumps(TICK_PROFILER.status(), ensure_ascii=False).encode('utf-8'),
+                        {'Cache-Control': 'no-cache'})
+
+    def _route(self) -> None:
+        """Điều hướng request GET/HEAD tới handler tương ứng."""
+        path = self.path.split('?', 1)[0]
+
+        if path == '/firmware.bin' or path == '/':
+            self._serve_firmware()
+        
+        elif path == '/version' or path == '/version.json':
+            self._serve_version()
+        
+        elif path == '/metrics':
+            # Prometheus exporter: chỉ serialize snapshot đã có, không thu thập lại
+            self._send_body(200, 'text/plain; version=0.0.4; charset=utf-8', render_prometheus_metrics())
+        
+        elif path == '/api/snapshot':
+            self._serve_snapshot()
+        
+        elif path == '/api/stream':
+            self._serve_stream()
+        
+        elif path == '/api/history':
+            self._serve_history()
         
-        elif self.path == '/health' or self.path == '/status':
+        elif path == '/api/profile':
+            self._serve_profile()
+        
+        elif path == '/api/self':
+            # Histogram độ trễ, bộ đếm và RSS/CPU của chính daemon
+            data = SELF_METRICS.snapshot()
+            data["budget"] = TICK_BUDGET.status()
+            data["startup_ms"] = STARTUP_TIMER.to_dict()
+            data["deadline"] = COLLECTOR_RUNNER.status()
+            data["workers"] = COLLECTOR_POOL.status()
+            data["capabilities"] = CAPABILITIES.status()
+            data["collectors"] = COLLECTOR_REGISTRY.describe()
+            data["breakers"] = breaker_status()
+            self._send_body(200, 'application/json; charset=utf-8',
+                            json.dumps(data, ensure_ascii=False).encode('utf-8'), {'Cache-Control': 'no-cache'})
+        
+        elif path == '/health' or path == '/status':
             # Health check endpoint
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({"status": "ok", "service": "OTA Server"}).encode())
+            self._send_body(200, 'application/json',
+                            json.dumps({"status": "ok", "service": "OTA Server"}).encode())
         
         else:
-            self.send_response(404)
-            self.send_header('Content-Type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b'Not Found')
+            self._send_body(404, 'text/plain', b'Not Found')
+
+    def _observe_request(self, start: float) -> None:
+        """Ghi thời gian xử lý request vào histogram "http" (bỏ qua SSE stream vì chạy đến khi client ngắt)."""
+        path = self.path.split('?', 1)[0]
+        if path != '/api/stream':
+            SELF_METRICS.observe("http", path if path in HTTP_ROUTES else "other", time.perf_counter() - start)
+
+    def do_GET(self):
+        """Handle GET requests."""
+        start = time.perf_counter()
+        try:
+            self._route()
+        except (BrokenPipeError, ConnectionResetError):
+            # Client (ESP32) ngắt kết nối giữa chừng, sẽ resume bằng Range
+            self.close_connection = True
+        finally:
+            self._observe_request(start)
+
+    def do_HEAD(self):
+        """Handle HEAD requests (giống GET nhưng không gửi body)."""
+        self.do_GET()
+
+    def do_POST(self):
+        """Handle POST requests (chỉ /api/profile), bỏ qua body để giữ keep-alive."""
+        start = time.perf_counter()
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > 0:
+                self.rfile.read(length)
+            if self.path.split('?', 1)[0] == '/api/profile':
+                self._serve_profile()
+            else:
+                self._send_body(404, 'text/plain', b'Not Found')
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        finally:
+            self._observe_request(start)
     
     def log_message(self, format, *args):
         """Suppress default logging to avoid cluttering output."""
@@ -2701,18 +6935,42 @@ class OTARequestHandler(BaseHTTPRequestHandler):
         pass
 
 
-def start_ota_server(port: int = 8888) -> None:
+class OTAHTTPServer(ThreadingHTTPServer):
+    """HTTP server đa luồng: mỗi connection một thread, tải firmware chậm không block /version, /health."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int], firmware_path: Optional[Path] = None,
+                 manifest: Optional[FirmwareManifest] = None):
+        super().__init__(address, OTARequestHandler)
+        if manifest is None:
+            firmware_path = Path(firmware_path) if firmware_path else Path(__file__).parent / FIRMWARE_FILENAME
+            manifest = FirmwareManifest(firmware_path).refresh()
+        self.manifest = manifest
+        self.firmware_path = manifest.firmware_path
+
+
+def start_ota_server(port: int = 8888, firmware_path: Optional[Path] = None,
+                     manifest: Optional[FirmwareManifest] = None) -> None:
     """Start OTA HTTP server trong background thread.
     
     Args:
         port: Port để bind HTTP server (default: 8888)
+        firmware_path: File firmware cần serve (default: JonsboN4Monitor.bin cạnh script)
+        manifest: Firmware manifest dùng chung với watcher (default: tạo mới)
     """
     try:
-        server = HTTPServer(('0.0.0.0', port), OTARequestHandler)
+        server = OTAHTTPServer(('0.0.0.0', port), firmware_path, manifest)
         print(f"✓ OTA HTTP Server đang chạy trên port {port}")
         print(f"  - Firmware: http://localhost:{port}/firmware.bin")
         print(f"  - Version:  http://localhost:{port}/version")
         print(f"  - Health:   http://localhost:{port}/health")
+        print(f"  - Metrics:  http://localhost:{port}/metrics")
+        print(f"  - API:      http://localhost:{port}/api/snapshot, http://localhost:{port}/api/stream (SSE)")
+        print(f"  - History:  http://localhost:{port}/api/history?label=...&start=-3600")
+        print(f"  - Self:     http://localhost:{port}/api/self")
+        print(f"  - Profile:  curl -X POST 'http://localhost:{port}/api/profile?ticks={PROFILE_DEFAULT_TICKS}'")
         server.serve_forever()
     except OSError as e:
         if e.errno == 98:  # Address already in use
@@ -2723,6 +6981,608 @@ def start_ota_server(port: int = 8888) -> None:
         print(f"⚠ Lỗi OTA server: {e}", file=sys.stderr)
 
 
+# ---------------------------------------------------------------------------
+# Profiling theo yêu cầu: --profile, SIGUSR1 hoặc POST /api/profile
+# ---------------------------------------------------------------------------
+
+PROFILE_MODES = ("sample", "cprofile", "both")
+PROFILE_DEFAULT_TICKS = 10
+# Lấy mẫu stack 200 lần/giây (wall clock, nên thấy cả thời gian chờ subprocess/serial)
+PROFILE_SAMPLE_INTERVAL = 0.005
+# Số dòng pstats / stack nóng nhất ghi vào file tóm tắt .txt
+PROFILE_SUMMARY_LINES = 40
+
+
+class StackSampler:
+    """Sampling profiler: lấy stack của main thread bằng setitimer(ITIMER_REAL) + SIGALRM.
+
+    Chỉ chạy trong lúc tick đang được profile (không lấy mẫu lúc sleep giữa các tick).
+    Kết quả là collapsed stacks ("a;b;c count") dùng trực tiếp cho flamegraph.pl/speedscope.
+    """
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.counts: Dict[str, int] = {}
+        self._previous_handler = None
+
+    @staticmethod
+    def available() -> bool:
+        return hasattr(signal, "setitimer") and hasattr(signal, "SIGALRM")
+
+    def _on_signal(self, signum, frame) -> None:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        key = ";".join(reversed(stack))
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def start(self) -> None:
+        self._previous_handler = signal.signal(signal.SIGALRM, self._on_signal)
+        signal.setitimer(signal.ITIMER_REAL, self.interval, self.interval)
+
+    def stop(self) -> None:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, self._previous_handler or signal.SIG_DFL)
+
+    def collapsed(self) -> str:
+        """Collapsed stacks, stack nhiều mẫu nhất trước."""
+        ordered = sorted(self.counts.items(), key=lambda item: -item[1])
+        return "".join(f"{stack} {count}\n" for stack, count in ordered)
+
+    def top_functions(self, limit: int) -> List[Tuple[str, int]]:
+        """Các hàm ở đỉnh stack (self time) nhiều mẫu nhất."""
+        leaves: Dict[str, int] = {}
+        for stack, count in self.counts.items():
+            leaf = stack.rsplit(";", 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + count
+        return sorted(leaves.items(), key=lambda item: -item[1])[:limit]
+
+
+class TickProfiler:
+    """Profile N tick tiếp theo của vòng lặp chính rồi ghi dump ra thư mục.
+
+    Yêu cầu đến từ --profile, SIGUSR1 (handler chạy trong main thread) hoặc
+    POST /api/profile (thread HTTP); chỉ gán một tuple nên signal handler không cần lock,
+    riêng yêu cầu exclusive (từ nhiều thread HTTP) kiểm tra và gán dưới _request_lock.
+    Phiên profile bắt đầu ở tick_start() kế tiếp, vòng lặp vẫn gửi dữ liệu bình thường
+    và dump được ghi trong background thread.
+    """
+
+    def __init__(self, output_dir: Optional[Path] = None, mode: str = "sample",
+                 default_ticks: int = PROFILE_DEFAULT_TICKS):
+        self.output_dir = output_dir or Path(__file__).parent / "profiles"
+        self.mode = mode
+        self.default_ticks = default_ticks
+        self.dumps: deque = deque(maxlen=10)
+        self._pending: Optional[Tuple[int, str]] = None
+        self._session_mode: Optional[str] = None
+        self._ticks_left = 0
+        self._tick_times: List[float] = []
+        self._tick_started: Optional[float] = None
+        self._profile = None
+        self._sampler: Optional[StackSampler] = None
+        self._request_lock = Lock()
+
+    @property
+    def active(self) -> bool:
+        return self._ticks_left > 0
+
+    def request(self, ticks: Optional[int] = None, mode: Optional[str] = None, exclusive: bool = False) -> bool:
+        """Yêu cầu profile `ticks` tick tiếp theo (an toàn khi gọi từ signal handler/thread khác).
+
+        exclusive=True: không nhận yêu cầu nếu đang profile hoặc đã có yêu cầu chờ (trả về False).
+        """
+        if not exclusive:
+            self._pending = (max(1, ticks or self.default_ticks), mode or self.mode)
+            return True
+        with self._request_lock:
+            if self.active or self._pending is not None:
+                return False
+            self._pending = (max(1, ticks or self.default_ticks), mode or self.mode)
+            return True
+
+    def status(self) -> Dict[str, object]:
+        pending = self._pending
+        return {
+            "active": self.active,
+            "mode": self._session_mode if self.active else None,
+            "ticks_left": self._ticks_left,
+            "pending": {"ticks": pending[0], "mode": pending[1]} if pending else None,
+            "output_dir": str(self.output_dir),
+            "dumps": list(self.dumps),
+        }
+
+    def tick_start(self) -> None:
+        """Gọi ở đầu mỗi tick (main thread): bắt đầu phiên mới nếu có yêu cầu, bật profiler."""
+        if not self.active and self._pending is not None:
+            with self._request_lock:
+                # Chuyển pending -> active trong lock để POST đồng thời thấy phiên đang chạy
+                (ticks, mode), self._pending = self._pending, None
+                if mode in ("sample", "both") and not StackSampler.available():
+                    print("⚠ setitimer không khả dụng, dùng cProfile", file=sys.stderr)
+                    mode = "cprofile"
+                self._session_mode = mode
+                self._ticks_left = ticks
+            self._tick_times = []
+            import cProfile
+            self._profile = cProfile.Profile() if mode in ("cprofile", "both") else None
+            self._sampler = StackSampler() if mode in ("sample", "both") else None
+            print(f"✓ Bắt đầu profile {ticks} tick ({mode})")
+        if not self.active:
+            return
+        self._tick_started = time.perf_counter()
+        if self._sampler is not None:
+            self._sampler.start()
+        if self._profile is not None:
+            self._profile.enable()
+
+    def tick_end(self) -> None:
+        """Gọi ở cuối mỗi tick (trước khi sleep): tạm dừng profiler, ghi dump khi đủ tick."""
+        if not self.active or self._tick_started is None:
+            return
+        if self._profile is not None:
+            self._profile.disable()
+        if self._sampler is not None:
+            self._sampler.stop()
+        self._tick_times.append(time.perf_counter() - self._tick_started)
+        self._tick_started = None
+        self._ticks_left -= 1
+        if self._ticks_left == 0:
+            Thread(
+                target=self._write,
+                args=(self._session_mode, self._profile, self._sampler, self._tick_times),
+                daemon=True,
+            ).start()
+            self._profile = None
+            self._sampler = None
+
+    def cancel(self) -> None:
+        """Dừng phiên đang chạy không ghi dump (tick lỗi, thoát): tắt itimer để SIGALRM không kill process."""
+        if self._tick_started is not None:
+            if self._profile is not None:
+                self._profile.disable()
+            if self._sampler is not None:
+                self._sampler.stop()
+        self._tick_started = None
+        self._ticks_left = 0
+        self._profile = None
+        self._sampler = None
+
+    def _write(self, mode: str, profile, sampler: Optional[StackSampler], tick_times: List[float]) -> None:
+        """Ghi .pstats, .collapsed và file tóm tắt .txt của một phiên profile."""
+        base = self.output_dir / f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{mode}"
+        files = []
+        try:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            ordered = sorted(tick_times)
+            summary = io.StringIO()
+            summary.write(
+                f"mode: {mode}\nticks: {len(tick_times)}\n"
+                f"tick ms: min {ordered[0] * 1000:.1f}, median {ordered[len(ordered) // 2] * 1000:.1f}, "
+                f"max {ordered[-1] * 1000:.1f}, total {sum(ordered) * 1000:.1f}\n\n"
+            )
+            if profile is not None:
+                profile.dump_stats(str(base) + ".pstats")
+                files.append(str(base) + ".pstats")
+                import pstats
+                stats = pstats.Stats(profile, stream=summary)
+                stats.sort_stats("cumulative").print_stats(PROFILE_SUMMARY_LINES)
+            if sampler is not None:
+                collapsed_path = Path(str(base) + ".collapsed")
+                collapsed_path.write_text(sampler.collapsed(), encoding="utf-8")
+                files.append(str(collapsed_path))
+                total = sum(sampler.counts.values()) or 1
+                summary.write(f"Samples: {total} (mỗi {PROFILE_SAMPLE_INTERVAL * 1000:g} ms)\n")
+                for function, count in sampler.top_functions(PROFILE_SUMMARY_LINES):
+                    summary.write(f"{count / total * 100:6.1f}%  {count:6d}  {function}\n")
+            summary_path = Path(str(base) + ".txt")
+            summary_path.write_text(summary.getvalue(), encoding="utf-8")
+            files.append(str(summary_path))
+        except OSError as exc:
+            print(f"⚠ Không ghi được profile vào {self.output_dir}: {exc}", file=sys.stderr)
+            return
+        self.dumps.append({"time": int(time.time()), "mode": mode, "ticks": len(tick_times), "files": files})
+        print(f"✓ Đã ghi profile {len(tick_times)} tick: {', '.join(files)}")
+
+
+TICK_PROFILER = TickProfiler()
+
+
+# ---------------------------------------------------------------------------
+# Chu kỳ tick thích ứng: nhanh sau wake-up/khi số liệu biến động, giãn dần khi ổn định
+# ---------------------------------------------------------------------------
+
+# Khi mọi màn hình tắt, block trên serial fd tối đa ngần này giây rồi mới quét màn hình mới
+ADAPTIVE_IDLE_WAKE_SECONDS = 30.0
+# Một metric "biến động" nếu thay đổi hơn max(ngưỡng tuyệt đối theo đơn vị, 20% giá trị)
+ADAPTIVE_CHANGE_RATIO = 0.2
+ADAPTIVE_CHANGE_FLOOR: Dict[str, float] = {
+    "percent": 5.0,
+    "celsius": 2.0,
+    "rpm": 100.0,
+    "hertz": 200e6,
+    "bytes": 64 * 1024.0 ** 2,
+    "bits_per_second": 1024.0 ** 2,
+    "bytes_per_second": 1024.0 ** 2,
+    "seconds": 0.005,
+    "status": 0.5,
+    "": 1.0,
+}
+
+
+class AdaptiveInterval:
+    """Chọn khoảng sleep giữa các tick khi có màn hình đang bật (--adaptive-interval).
+
+    Sau wake-up hoặc khi có metric trong DYNAMIC_LABELS biến động, chu kỳ về ngay
+    minimum; mỗi tick số liệu đứng yên thì chu kỳ gấp đôi, tối đa maximum.
+    """
+
+    def __init__(self, minimum: float, maximum: float, initial: float):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.current = min(max(initial, self.minimum), self.maximum)
+        self.previous: Dict[Tuple[str, str], float] = {}
+
+    def reset(self) -> None:
+        """Về chu kỳ nhanh nhất (màn hình vừa bật hoặc đổi host hiển thị)."""
+        self.current = self.minimum
+
+    def moving_labels(self, source: str, metrics: Dict[str, str]) -> List[str]:
+        """Các label đã thay đổi đáng kể so với lần update trước của cùng nguồn."""
+        moving = []
+        for label in DYNAMIC_LABELS:
+            parsed = parse_metric_value(label, metrics.get(label, ""))
+            if parsed is None:
+                continue
+            value, unit = parsed
+            previous = self.previous.get((source, label))
+            self.previous[(source, label)] = value
+            if previous is None:
+                continue
+            threshold = max(ADAPTIVE_CHANGE_FLOOR.get(unit, 0.0), ADAPTIVE_CHANGE_RATIO * max(abs(value), abs(previous)))
+            if abs(value - previous) > threshold:
+                moving.append(label)
+        return moving
+
+    def update(self, snapshots: Dict[str, Optional[Dict[str, str]]]) -> float:
+        """Cập nhật chu kỳ theo snapshot vừa gửi (key: nguồn metrics).
+
+        Returns:
+            Số giây sleep trước tick tiếp theo
+        """
+        moving = False
+        for source, metrics in snapshots.items():
+            if metrics is not None and self.moving_labels(source, metrics):
+                moving = True
+        self.current = self.minimum if moving else min(self.current * 2, self.maximum)
+        return self.current
+
+
+# ---------------------------------------------------------------------------
+# Agent / Hub: stream snapshot từ máy khác về máy có màn hình
+# ---------------------------------------------------------------------------
+
+# Tên nguồn dữ liệu của chính máy đang gắn màn hình
+LOCAL_SOURCE = "local"
+
+# Mỗi bao nhiêu frame delta thì agent gửi lại full snapshot (phòng khi hub lệch trạng thái)
+AGENT_FULL_SNAPSHOT_EVERY = 60
+# Backoff tối đa (giây) khi agent không kết nối được tới hub
+AGENT_MAX_BACKOFF = 60.0
+# Độ dài tối đa một dòng frame hub chấp nhận (full snapshot thực tế chỉ vài KB)
+HUB_MAX_LINE_BYTES = 256 * 1024
+
+
+def parse_host_port(value: str, default_port: int = 9777) -> Tuple[str, int]:
+    """Parse chuỗi "host:port" (port có thể bỏ trống).
+
+    Args:
+        value: Chuỗi dạng "192.168.1.10:9777" hoặc "nas2"
+        default_port: Port mặc định nếu không chỉ định
+
+    Returns:
+        Tuple (host, port)
+
+    Raises:
+        ValueError: Nếu port không hợp lệ
+    """
+    host, sep, port_str = value.rpartition(":")
+    if not sep:
+        return value, default_port
+    return host or "127.0.0.1", int(port_str)
+
+
+class SnapshotDeltaEncoder:
+    """Encode snapshot metrics thành frame JSON-line gọn (full hoặc delta).
+
+    Frame full gửi danh sách key + value; frame delta chỉ gửi các cặp
+    [index, value] đã thay đổi so với frame trước, index tham chiếu tới
+    danh sách key của frame full gần nhất. Khi tập key thay đổi (thêm hoặc
+    bớt, ví dụ rút ổ) thì gửi full để hub không giữ key đã mất.
+    """
+
+    def __init__(self, full_every: int = AGENT_FULL_SNAPSHOT_EVERY):
+        self.full_every = max(1, full_every)
+        self.reset()
+
+    def reset(self) -> None:
+        """Buộc frame tiếp theo là full snapshot (dùng khi reconnect/resync)."""
+        self.keys: List[str] = []
+        self.index: Dict[str, int] = {}
+        self.last: Dict[str, str] = {}
+        self.seq = 0
+        self.frames_since_full = 0
+
+    def encode(self, metrics: Dict[str, str]) -> bytes:
+        """Tạo frame cho snapshot mới.
+
+        Args:
+            metrics: Dictionary metrics hiện tại
+
+        Returns:
+            Một dòng JSON (bytes, kết thúc bằng '\\n')
+        """
+        self.seq += 1
+        need_full = (
+            not self.keys
+            or self.frames_since_full >= self.full_every
+            or metrics.keys() != self.index.keys()
+        )
+        if need_full:
+            self.keys = list(metrics.keys())
+            self.index = {key: idx for idx, key in enumerate(self.keys)}
+            frame = {"t": "full", "s": self.seq, "k": self.keys, "v": [metrics[k] for k in self.keys]}
+            self.frames_since_full = 0
+        else:
+            changes = [
+                [self.index[key], value]
+                for key, value in metrics.items()
+                if self.last.get(key) != value
+            ]
+            frame = {"t": "delta", "s": self.seq, "d": changes}
+            self.frames_since_full += 1
+        self.last = dict(metrics)
+        return (json.dumps(frame, separators=(",", ":"), ensure_ascii=False) + "\n").encode("utf-8")
+
+
+class SnapshotDeltaDecoder:
+    """Giải mã frame từ SnapshotDeltaEncoder, giữ snapshot đầy đủ hiện tại."""
+
+    def __init__(self):
+        self.keys: List[str] = []
+        self.metrics: Dict[str, str] = {}
+        self.seq = 0
+
+    def apply(self, frame: Dict) -> Dict[str, str]:
+        """Áp dụng một frame vào snapshot hiện tại.
+
+        Args:
+            frame: Frame đã json.loads
+
+        Returns:
+            Snapshot đầy đủ sau khi áp dụng frame
+
+        Raises:
+            ValueError: Nếu frame không hợp lệ hoặc bị lệch sequence (cần resync)
+        """
+        kind = frame.get("t")
+        seq = int(frame.get("s", 0))
+        if kind == "full":
+            keys = [str(k) for k in frame["k"]]
+            values = [str(v) for v in frame["v"]]
+            if len(keys) != len(values):
+                raise ValueError("Frame full có số key và value khác nhau")
+            self.keys = keys
+            self.metrics = dict(zip(keys, values))
+        elif kind == "delta":
+            if not self.keys or seq != self.seq + 1:
+                raise ValueError(f"Frame delta lệch sequence (nhận {seq}, đang ở {self.seq})")
+            for idx, value in frame["d"]:
+                self.metrics[self.keys[int(idx)]] = str(value)
+        else:
+            raise ValueError(f"Loại frame không hợp lệ: {kind}")
+        self.seq = seq
+        return dict(self.metrics)
+
+
+class RemoteHostTable:
+    """Bảng snapshot mới nhất của các agent, dùng chung giữa các thread của hub."""
+
+    def __init__(self, stale_timeout: float = 30.0):
+        self.stale_timeout = stale_timeout
+        self._lock = Lock()
+        # host -> (metrics, thời điểm cập nhật, kết nối đang sở hữu entry)
+        self._hosts: Dict[str, Tuple[Dict[str, str], float, object]] = {}
+
+    def update(self, host: str, metrics: Dict[str, str], owner: object = None) -> None:
+        """Lưu snapshot mới nhất của một host; kết nối gửi gần nhất trở thành owner."""
+        with self._lock:
+            self._hosts[host] = (metrics, time.time(), owner)
+
+    def remove(self, host: str, owner: object = None) -> None:
+        """Xóa host khi agent ngắt kết nối, chỉ nếu entry vẫn thuộc kết nối owner.
+
+        Agent reconnect trước khi socket cũ timeout (hoặc hai máy trùng tên) thì
+        kết nối cũ đóng sau không xóa mất entry của kết nối đang sống.
+        """
+        with self._lock:
+            entry = self._hosts.get(host)
+            if entry is not None and entry[2] is owner:
+                del self._hosts[host]
+
+    def host_names(self) -> List[str]:
+        """Danh sách host còn hoạt động (chưa quá stale_timeout), đã sort."""
+        now = time.time()
+        with self._lock:
+            return sorted(
+                host for host, (_, updated, _) in self._hosts.items()
+                if now - updated <= self.stale_timeout
+            )
+
+    def get(self, host: str) -> Optional[Dict[str, str]]:
+        """Lấy snapshot của host, None nếu không có."""
+        with self._lock:
+            entry = self._hosts.get(host)
+        return dict(entry[0]) if entry else None
+
+
+class HubRequestHandler(socketserver.StreamRequestHandler):
+    """Nhận stream frame từ một agent và cập nhật RemoteHostTable."""
+
+    def handle(self):
+        table: RemoteHostTable = self.server.host_table
+        decoder = SnapshotDeltaDecoder()
+        host = None
+        peer = f"{self.client_address[0]}:{self.client_address[1]}"
+        try:
+            while True:
+                raw_line = self.rfile.readline(HUB_MAX_LINE_BYTES + 1)
+                if not raw_line:
+                    break
+                if len(raw_line) > HUB_MAX_LINE_BYTES:
+                    print(f"⚠ Hub: dòng dài quá {HUB_MAX_LINE_BYTES} bytes từ {host or peer} - đóng kết nối",
+                          file=sys.stderr)
+                    break
+                try:
+                    frame = json.loads(raw_line.decode("utf-8"))
+                    if frame.get("t") == "hello":
+                        host = str(frame.get("host") or peer)
+                        print(f"✓ Hub: agent '{host}' đã kết nối từ {peer}")
+                        continue
+                    metrics = decoder.apply(frame)
+                except (ValueError, KeyError, TypeError, IndexError) as exc:
+                    # Lệch trạng thái: yêu cầu agent gửi lại full snapshot
+                    print(f"⚠ Hub: frame lỗi từ {host or peer}: {exc} - yêu cầu resync", file=sys.stderr)
+                    self.wfile.write(b"R\n")
+                    continue
+                table.update(host or peer, metrics, owner=self)
+        except OSError:
+            pass
+        finally:
+            table.remove(host or peer, owner=self)
+            if host:
+                print(f"⚠ Hub: agent '{host}' đã ngắt kết nối")
+
+
+class HubServer(socketserver.ThreadingTCPServer):
+    """TCP server của hub, mỗi agent được xử lý trong một thread riêng."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int], host_table: RemoteHostTable):
+        super().__init__(address, HubRequestHandler)
+        self.host_table = host_table
+
+
+def start_hub_server(host_table: RemoteHostTable, port: int, bind: str = "0.0.0.0") -> None:
+    """Start hub TCP server (chạy trong background thread).
+
+    Args:
+        host_table: Bảng lưu snapshot của các agent
+        port: Port lắng nghe agent
+        bind: Địa chỉ bind (default: 0.0.0.0)
+    """
+    try:
+        server = HubServer((bind, port), host_table)
+        print(f"✓ Hub đang nhận agent trên {bind}:{port}")
+        server.serve_forever()
+    except OSError as e:
+        print(f"⚠ Không thể khởi động hub trên port {port}: {e}", file=sys.stderr)
+
+
+def pick_display_source(sources: List[str], display_index: int, now: float, rotate_seconds: float) -> str:
+    """Chọn nguồn dữ liệu (host) mà một màn hình sẽ hiển thị tại thời điểm now.
+
+    Các màn hình xoay vòng qua danh sách nguồn mỗi rotate_seconds giây, lệch nhau
+    theo display_index để nhiều màn hình hiển thị các host khác nhau cùng lúc.
+
+    Args:
+        sources: Danh sách nguồn (LOCAL_SOURCE + tên các agent)
+        display_index: Thứ tự của màn hình
+        now: Thời điểm hiện tại (time.time())
+        rotate_seconds: Thời gian hiển thị mỗi nguồn (<= 0: không xoay vòng)
+
+    Returns:
+        Tên nguồn dữ liệu
+    """
+    if not sources:
+        return LOCAL_SOURCE
+    slot = int(now // rotate_seconds) if rotate_seconds > 0 else 0
+    return sources[(slot + display_index) % len(sources)]
+
+
+def run_agent(hub_address: str, interval: float, agent_name: Optional[str] = None,
+              stats_log_interval: float = 0.0) -> None:
+    """Chế độ agent: đọc metrics định kỳ và stream về hub qua TCP (tự reconnect với backoff).
+
+    Args:
+        hub_address: Địa chỉ hub dạng "host:port"
+        interval: Khoảng thời gian (giây) giữa các lần đọc metrics
+        agent_name: Tên host hiển thị trên hub (default: hostname)
+        stats_log_interval: In dòng self-metrics mỗi N giây (0 = tắt)
+    """
+    host, port = parse_host_port(hub_address)
+    name = agent_name or socket.gethostname()
+    encoder = SnapshotDeltaEncoder()
+    backoff = 1.0
+    last_stats_log_time = time.monotonic()
+
+    print(f"Chế độ agent: gửi snapshot của '{name}' tới hub {host}:{port} mỗi {interval} giây")
+    while True:
+        try:
+            sock = socket.create_connection((host, port), timeout=10)
+        except OSError as exc:
+            SELF_METRICS.inc("agent_reconnects")
+            delay = backoff + random.uniform(0, backoff / 2)
+            print(f"⚠ Không kết nối được hub {host}:{port}: {exc} - thử lại sau {delay:.1f}s")
+            time.sleep(delay)
+            backoff = min(backoff * 2, AGENT_MAX_BACKOFF)
+            continue
+
+        print(f"✓ Đã kết nối tới hub {host}:{port}")
+        encoder.reset()
+        try:
+            hello = {"t": "hello", "host": name, "version": get_version()}
+            sock.sendall((json.dumps(hello, separators=(",", ":")) + "\n").encode("utf-8"))
+            while True:
+                # Hub gửi "R" khi cần full snapshot
+                ready, _, _ = select.select([sock], [], [], 0)
+                if ready:
+                    data = sock.recv(64)
+                    if not data:
+                        raise OSError("Hub đã đóng kết nối")
+                    if b"R" in data:
+                        encoder.reset()
+
+                TICK_PROFILER.tick_start()
+                try:
+                    sock.sendall(encoder.encode(aggregate_metrics()))
+                except BaseException:
+                    TICK_PROFILER.cancel()
+                    raise
+                TICK_PROFILER.tick_end()
+                STARTUP_TIMER.report("snapshot đầu")
+                backoff = 1.0  # Gửi thành công, reset backoff
+                if stats_log_interval > 0 and time.monotonic() - last_stats_log_time >= stats_log_interval:
+                    print(SELF_METRICS.log_line())
+                    last_stats_log_time = time.monotonic()
+                time.sleep(interval)
+        except OSError as exc:
+            SELF_METRICS.inc("agent_reconnects")
+            print(f"⚠ Mất kết nối tới hub: {exc}")
+        finally:
+            try:
+                sock.close()
+            except OSError:
+                pass
+        delay = backoff + random.uniform(0, backoff / 2)
+        time.sleep(delay)
+        backoff = min(backoff * 2, AGENT_MAX_BACKOFF)
+
+
 def parse_args() -> argparse.Namespace:
     """Parse command line arguments.
     
@@ -2737,10 +7597,23 @@ def parse_args() -> argparse.Namespace:
         default="sensors.txt",
         help="File output (default: sensors.txt)",
     )
+    parser.add_argument(
+        "--output-fsync",
+        type=float,
+        default=0.0,
+        help="fsync file output tối đa mỗi N giây (default: 0 = không fsync, để kernel tự ghi xuống disk).",
+    )
     parser.add_argument(
         "--serial-device",
+        action="append",
+        default=None,
+        help="Thiết bị serial để gửi dữ liệu (ví dụ: /dev/ttyACM0). Có thể lặp lại để dùng nhiều màn hình. Nếu không chỉ định, sẽ tự động tìm tất cả ESP32 USB device (vendor ID 303a, model ID 4001).",
+    )
+    parser.add_argument(
+        "--usb-serial",
+        action="append",
         default=None,
-        help="Thiết bị serial để gửi dữ liệu (ví dụ: /dev/ttyACM0). Nếu không chỉ định, sẽ tự động tìm ESP32 USB device (vendor ID 303a, model ID 4001).",
+        help="Chỉ quản lý các ESP32 có USB serial number này (có thể lặp lại để chọn nhiều màn hình).",
     )
     parser.add_argument(
         "--vendor-id",
@@ -2770,6 +7643,41 @@ def parse_args() -> argparse.Namespace:
         default=5.0,
         help="Khoảng thời gian (giây) giữa các lần gửi dữ liệu khi dùng serial (default: 5.0). Chỉ áp dụng khi có --serial-device.",
     )
+    parser.add_argument(
+        "--adaptive-interval",
+        action="store_true",
+        help="Chu kỳ thích ứng: nhanh sau wake-up hoặc khi số liệu biến động, giãn dần khi ổn định, block trên serial khi màn hình tắt.",
+    )
+    parser.add_argument(
+        "--interval-min",
+        type=float,
+        default=1.0,
+        help="Chu kỳ nhỏ nhất của --adaptive-interval (giây, default: 1.0).",
+    )
+    parser.add_argument(
+        "--interval-max",
+        type=float,
+        default=30.0,
+        help="Chu kỳ lớn nhất của --adaptive-interval (giây, default: 30.0).",
+    )
+    parser.add_argument(
+        "--warm-interval",
+        type=float,
+        default=60.0,
+        help="Khi mọi màn hình tắt, vẫn đọc metrics mỗi N giây để wake up hiển thị ngay; đọc SMART chỉ khi ổ có I/O (default: 60, 0 = tắt).",
+    )
+    parser.add_argument(
+        "--state-file",
+        metavar="PATH",
+        default=None,
+        help=f"File lưu snapshot cuối cùng để hiển thị ngay sau restart/reconnect (default: /dev/shm/{STATE_FILE_NAME}, hoặc cạnh script nếu không có /dev/shm).",
+    )
+    parser.add_argument(
+        "--state-interval",
+        type=float,
+        default=10.0,
+        help="Ghi snapshot vào --state-file tối đa mỗi N giây, chỉ khi thay đổi (default: 10, 0 = tắt).",
+    )
     parser.add_argument(
         "--file-interval",
         type=float,
@@ -2803,6 +7711,159 @@ def parse_args() -> argparse.Namespace:
         default=8888,
         help="Port cho OTA HTTP server (default: 8888). Set 0 để tắt OTA server.",
     )
+    parser.add_argument(
+        "--usb-ota",
+        action="store_true",
+        help="Cập nhật firmware cho màn hình qua USB CDC (JonsboN4Monitor.bin cạnh script), bỏ qua nếu ESP32 đã chạy bản này.",
+    )
+    parser.add_argument(
+        "--history-file",
+        default=None,
+        help=f"File lưu lịch sử metrics (default: {HISTORY_FILE_NAME} cạnh script, giữ qua reboot). File trên /dev/shm không ghi volume nhưng mất khi reboot.",
+    )
+    parser.add_argument(
+        "--history-size-mb",
+        type=float,
+        default=HISTORY_FILE_DEFAULT_MB,
+        help=f"Dung lượng cố định của file lịch sử (MB, default: {HISTORY_FILE_DEFAULT_MB}). Set 0 để chỉ giữ lịch sử trong RAM.",
+    )
+    parser.add_argument(
+        "--history-flush",
+        type=float,
+        default=HISTORY_FLUSH_SECONDS,
+        help=f"Khoảng thời gian (giây) giữa các lần ghi lịch sử xuống disk (default: {HISTORY_FLUSH_SECONDS:.0f}).",
+    )
+    parser.add_argument(
+        "--host-root",
+        default=None,
+        help=f"Prefix cho /proc, /sys, /dev của host khi chạy trong container (ví dụ: /host). Env: {HOST_ROOT_ENV}.",
+    )
+    parser.add_argument(
+        "--proc-root",
+        default=None,
+        help=f"Thư mục procfs (default: /proc). Env: {HOST_ROOT_KIND_ENV['proc']}.",
+    )
+    parser.add_argument(
+        "--sys-root",
+        default=None,
+        help=f"Thư mục sysfs (default: /sys). Env: {HOST_ROOT_KIND_ENV['sys']}.",
+    )
+    parser.add_argument(
+        "--dev-root",
+        default=None,
+        help=f"Thư mục device (default: /dev). Env: {HOST_ROOT_KIND_ENV['dev']}.",
+    )
+    parser.add_argument(
+        "--metrics-scope",
+        choices=METRICS_SCOPES,
+        default=None,
+        help=f"CPU/RAM của cả host hoặc của cgroup (container) đang chạy script (default: host). Env: {METRICS_SCOPE_ENV}.",
+    )
+    parser.add_argument(
+        "--budget-cpu",
+        type=float,
+        metavar="PERCENT",
+        default=0.0,
+        help="CPU tối đa của daemon (%% của một core, ví dụ 2). Vượt budget thì giãn chu kỳ collector đắt nhất và bỏ ping/GPU (default: 0 = không giới hạn).",
+    )
+    parser.add_argument(
+        "--budget-tick-ms",
+        type=float,
+        metavar="MS",
+        default=0.0,
+        help="Thời gian thu thập tối đa mỗi tick (ms, ví dụ 500, không tính 1s lấy mẫu mạng) (default: 0 = không giới hạn).",
+    )
+    parser.add_argument(
+        "--tick-deadline",
+        type=float,
+        metavar="SECONDS",
+        default=3.0,
+        help="Thời gian tối đa mỗi tick chờ collector; collector chậm hơn chạy tiếp ở background, tick dùng giá trị cũ (đánh dấu stale) (default: 3.0, 0 = chờ hết).",
+    )
+    parser.add_argument(
+        "--worker-collectors",
+        metavar="LIST",
+        default=None,
+        help="Collector (cách nhau bởi dấu phẩy) chạy trong worker process riêng, có timeout và bị kill khi treo (default: các collector khai báo isolate, built-in là storage,disk_temps,disk_status,network,disk_io; none = chạy trong daemon).",
+    )
+    parser.add_argument(
+        "--plugin-dir",
+        metavar="PATH",
+        default=None,
+        help=f"Thư mục collector plugin (*.py có hàm register(registry)) (default: {PLUGIN_DIR_NAME}/ cạnh script). Env: {PLUGIN_DIR_ENV}.",
+    )
+    parser.add_argument(
+        "--worker-timeout",
+        type=float,
+        metavar="SECONDS",
+        default=WORKER_CALL_TIMEOUT,
+        help="Timeout mỗi lần gọi collector trong worker; quá timeout thì kill worker (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--worker-max-calls",
+        type=int,
+        metavar="N",
+        default=WORKER_MAX_CALLS,
+        help="Thay worker mới sau N lần gọi (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--collector-worker",
+        action="store_true",
+        help=argparse.SUPPRESS,
+    )
+    parser.add_argument(
+        "--stats-log",
+        type=float,
+        metavar="SECONDS",
+        default=0.0,
+        help="In một dòng self-metrics (RSS, CPU, serial, reconnect, lệnh chậm nhất) mỗi N giây (default: 0 = tắt). Số liệu đầy đủ ở /api/self và /metrics.",
+    )
+    parser.add_argument(
+        "--profile",
+        type=int,
+        metavar="TICKS",
+        default=0,
+        help=f"Profile TICKS tick đầu tiên (default: 0 = không). Khi đang chạy: kill -USR1 <pid> hoặc POST /api/profile để profile {PROFILE_DEFAULT_TICKS} tick tiếp theo.",
+    )
+    parser.add_argument(
+        "--profile-mode",
+        choices=PROFILE_MODES,
+        default="sample",
+        help="sample: lấy mẫu stack bằng setitimer, overhead thấp (collapsed stacks cho flamegraph); cprofile: cProfile (pstats); both: cả hai (default: sample).",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default=None,
+        help="Thư mục ghi dump profile (default: profiles/ cạnh script).",
+    )
+    parser.add_argument(
+        "--agent",
+        metavar="HOST:PORT",
+        default=None,
+        help="Chế độ agent: đọc metrics và stream về hub (máy có màn hình) qua TCP, không dùng USB/serial.",
+    )
+    parser.add_argument(
+        "--agent-name",
+        default=None,
+        help="Tên host hiển thị trên hub (default: hostname).",
+    )
+    parser.add_argument(
+        "--hub-port",
+        type=int,
+        default=0,
+        help="Port để nhận snapshot từ các agent (default: 0 = tắt hub).",
+    )
+    parser.add_argument(
+        "--hub-bind",
+        default="0.0.0.0",
+        help="Địa chỉ bind cho hub (default: 0.0.0.0).",
+    )
+    parser.add_argument(
+        "--hub-rotate",
+        type=float,
+        default=15.0,
+        help="Thời gian (giây) hiển thị mỗi host trên màn hình khi hub có nhiều host (default: 15.0).",
+    )
     return parser.parse_args()
 
 
@@ -2812,9 +7873,30 @@ def main() -> None:
     Parse arguments, thu thập metrics, và ghi ra file output.
     Nếu có serial device, sẽ chạy trong vòng lặp liên tục gửi dữ liệu mỗi interval giây.
     """
+    STARTUP_TIMER.mark("import")
     args = parse_args()
+    if args.collector_worker:
+        # Worker process của COLLECTOR_POOL: thư mục gốc và scope nhận qua env, không print ra stdout
+        configure_metrics_scope()
+        run_collector_worker(plugin_directory(args.plugin_dir))
+        return
     file_only_mode = bool(args.file_only)
 
+    # Collector plugin (site-specific), load trước mọi lần thu thập để có mặt ở cả file-only
+    COLLECTOR_POOL.plugin_dir = plugin_directory(args.plugin_dir)
+    COLLECTOR_REGISTRY.load_directory(COLLECTOR_POOL.plugin_dir)
+
+    TICK_BUDGET.max_cpu_percent = max(0.0, args.budget_cpu)
+    TICK_BUDGET.max_tick_seconds = max(0.0, args.budget_tick_ms) / 1000.0
+    if TICK_BUDGET.enabled:
+        print(f"✓ Budget: CPU {args.budget_cpu or '-'}%, tick {args.budget_tick_ms or '-'} ms")
+
+    roots = configure_host_roots(args.host_root, args.proc_root, args.sys_root, args.dev_root)
+    if any(str(path) != f"/{kind}" for kind, path in roots.items()):
+        print("✓ Thư mục gốc: " + ", ".join(f"{kind}={path}" for kind, path in roots.items()))
+    if configure_metrics_scope(args.metrics_scope) == "cgroup":
+        print(f"✓ CPU/RAM theo cgroup: {CGROUP_READER.path} (v{2 if CGROUP_READER.v2 else 1})")
+
     # Heuristic: nếu user chỉ truyền --output (hoặc mặc định tương tự) mà không có flag serial,
     # coi như họ muốn chạy chế độ file-only giống hướng dẫn ban đầu.
     if not file_only_mode and args.serial_device:
@@ -2836,11 +7918,37 @@ def main() -> None:
         write_output(metrics, output_path)
         print(f"Đã ghi {len(LABEL_ORDER)} label vào {output_path}")
         return
+
+    # File-only chỉ thu thập một lần nên cần đủ số liệu; deadline chỉ áp dụng cho vòng lặp
+    COLLECTOR_RUNNER.deadline = max(0.0, args.tick_deadline)
+
+    if args.worker_collectors is None:
+        worker_collectors = COLLECTOR_REGISTRY.names("isolate")
+    else:
+        worker_collectors = frozenset(
+            name.strip() for name in args.worker_collectors.split(",") if name.strip() and name.strip() != "none"
+        )
+    unknown = worker_collectors - {name for name, _ in COLLECTORS}
+    if unknown:
+        print(f"⚠ Bỏ qua collector không tồn tại trong --worker-collectors: {', '.join(sorted(unknown))}", file=sys.stderr)
+    if worker_collectors - unknown:
+        COLLECTOR_POOL.timeout = max(1.0, args.worker_timeout)
+        COLLECTOR_POOL.max_calls = max(1, args.worker_max_calls)
+        COLLECTOR_POOL.install(worker_collectors - unknown)
+        atexit.register(COLLECTOR_POOL.close)
+        print(f"✓ Collector chạy trong worker process: {', '.join(sorted(COLLECTOR_POOL.names))}")
+
+    capabilities = CAPABILITIES.probe()
+    missing = [name for name, found in capabilities["tools"].items() if not found]
+    missing += [f"/{PROBE_PATHS[name][0]}/{PROBE_PATHS[name][1]}" for name, found in capabilities["paths"].items() if not found]
+    if missing:
+        print(f"ℹ️ Không có trên máy này (bỏ qua, không fork): {', '.join(missing)}")
     
     # Tạo lock file để tránh chạy nhiều process cùng lúc
     # Lock file sẽ được tạo trong cùng thư mục với script
     script_dir = Path(__file__).parent
-    lock_file_path = script_dir / "read_sensor.lock"
+    # Agent dùng lock riêng để có thể chạy song song với daemon màn hình trên cùng máy
+    lock_file_path = script_dir / ("read_sensor_agent.lock" if args.agent else "read_sensor.lock")
     
     # QUAN TRỌNG: Nếu có process cũ đang chạy, kill nó trước
     # Điều này cho phép restart script bằng cách nhấn Run lại trong DSM Task Scheduler
@@ -2861,20 +7969,94 @@ def main() -> None:
     lock_file = acquire_lock(lock_file_path)
     if lock_file is None:
         sys.exit(1)
-    
-    # Tạo version.json khi script start
-    create_version_json(script_dir)
+    STARTUP_TIMER.mark("lock")
+    
+    # Profiling theo yêu cầu: --profile N, SIGUSR1 hoặc POST /api/profile
+    TICK_PROFILER.output_dir = Path(args.profile_dir) if args.profile_dir else script_dir / "profiles"
+    TICK_PROFILER.mode = args.profile_mode
+    if args.profile > 0:
+        TICK_PROFILER.default_ticks = args.profile
+        TICK_PROFILER.request(args.profile)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: TICK_PROFILER.request())
+
+    # Chế độ agent: chỉ đọc metrics và gửi về hub
+    if args.agent:
+        try:
+            run_agent(args.agent, max(0.1, args.interval), args.agent_name, max(0.0, args.stats_log))
+        except KeyboardInterrupt:
+            print("\nĐang dừng agent...")
+        return
+
+    # Lịch sử metrics trên disk: mở lại chỉ đọc header, flush lần cuối khi thoát
+    if args.history_size_mb > 0:
+        history_path = Path(args.history_file) if args.history_file else script_dir / HISTORY_FILE_NAME
+        try:
+            METRIC_HISTORY.store = HistoryFile(
+                history_path, args.history_size_mb, max(1.0, args.history_flush)
+            ).open()
+            atexit.register(METRIC_HISTORY.store.close)
+            # SIGTERM (restart từ DSM Task Scheduler) thoát qua atexit để không mất lịch sử chưa flush
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            print(f"✓ Lịch sử metrics: {history_path} ({args.history_size_mb:g} MB, flush mỗi {args.history_flush:g}s)")
+        except (OSError, ValueError) as exc:
+            print(f"⚠ Không mở được file lịch sử {history_path}: {exc}, chỉ giữ lịch sử trong RAM", file=sys.stderr)
+
+    # Firmware manifest: hash/version tính 1 lần, watcher cập nhật khi file .bin thay đổi
+    # (version.json được ghi trong thread của watcher, không chặn khởi động)
+    firmware_manifest = FirmwareManifest(script_dir / FIRMWARE_FILENAME).refresh()
+    STARTUP_TIMER.mark("firmware")
+    FirmwareWatcher(
+        firmware_manifest,
+        on_change=lambda manifest: create_version_json(script_dir, manifest),
+    ).start()
     
     # Start OTA HTTP server nếu được enable
     ota_thread = None
     if args.ota_port > 0:
-        ota_thread = Thread(target=start_ota_server, args=(args.ota_port,), daemon=True)
+        ota_thread = Thread(target=start_ota_server, args=(args.ota_port, None, firmware_manifest), daemon=True)
         ota_thread.start()
-        # Đợi một chút để server khởi động
-        time.sleep(0.5)
     
+    # Start hub nếu được enable (nhận snapshot từ các agent ở máy khác)
+    remote_hosts: Optional[RemoteHostTable] = None
+    if args.hub_port > 0:
+        remote_hosts = RemoteHostTable(stale_timeout=max(30.0, args.interval * 6))
+        Thread(
+            target=start_hub_server,
+            args=(remote_hosts, args.hub_port, args.hub_bind),
+            daemon=True,
+        ).start()
+
+    STARTUP_TIMER.mark("servers")
+
+    # Warm cache: đọc metrics chậm khi màn hình tắt, wake up gửi ngay không chờ thu thập
+    warm_cache: Optional[WarmCache] = None
+    if args.warm_interval > 0:
+        warm_cache = WarmCache(max(1.0, args.warm_interval))
+        warm_cache.start()
+        print(f"✓ Warm cache: đọc metrics mỗi {warm_cache.interval:g}s khi màn hình tắt (SMART chỉ khi ổ đang hoạt động)")
+
+    # Snapshot cuối cùng của lần chạy trước: gửi ngay khi màn hình kết nối
+    state_file: Optional[SnapshotStateFile] = None
+    last_known: Optional[Tuple[Dict[str, str], float]] = None
+    if args.state_interval > 0:
+        state_file = SnapshotStateFile(
+            Path(args.state_file) if args.state_file else default_state_path(script_dir), args.state_interval
+        )
+        last_known = state_file.load()
+        atexit.register(state_file.flush)
+        # SIGTERM (restart từ DSM Task Scheduler) thoát qua atexit để lưu snapshot cuối
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        if last_known is not None:
+            print(f"✓ Snapshot cũ: {state_file.path} ({time.time() - last_known[1]:.0f}s trước)")
+
     output_path = Path(args.output)
+    output_sink = OutputSink(output_path, max(0.0, args.output_fsync))
     interval = max(0.1, args.interval)
+    cadence: Optional[AdaptiveInterval] = None
+    if args.adaptive_interval:
+        cadence = AdaptiveInterval(max(0.1, args.interval_min), args.interval_max, interval)
+        print(f"✓ Chu kỳ thích ứng: {cadence.minimum:g}-{cadence.maximum:g}s, block trên serial khi màn hình tắt")
     file_interval = args.file_interval if args.file_interval else interval
     serial_retry_count = max(0, args.serial_retries)
     serial_retry_delay = max(0.0, args.serial_retry_delay)
@@ -2882,8 +8064,10 @@ def main() -> None:
     # Lưu vendor_id và model_id để dùng khi reconnect
     vendor_id = args.vendor_id
     model_id = args.model_id
-    fixed_serial_device = args.serial_device  # Device cố định nếu user chỉ định
-    
+    fixed_serial_devices = args.serial_device or []  # Device cố định nếu user chỉ định
+    usb_serials = args.usb_serial or []
+    rescan_interval = 2.0  # Khoảng thời gian (giây) giữa các lần tìm màn hình mới
+
     # Serial mode: chạy liên tục và tự động kết nối USB device
     print("=" * 60)
     print("Chế độ 24/7: Script sẽ tự động đợi và kết nối USB device")
@@ -2898,238 +8082,223 @@ def main() -> None:
     print()
 
     last_file_write_time = 0.0
+    last_stats_log_time = time.time()
+    last_scan_time = 0.0
+    last_wait_log_time = 0.0
     iteration = 0
-    serial_file = None
-    serial_device = None  # Sẽ được tìm khi có USB
-    backlight_is_on = args.no_wait_signal  # Nếu --no-wait-signal, tự động bật
-    previous_backlight_state = False  # Trạng thái backlight lần trước, để detect wake up
-    storage_sent_this_wake = False  # Đánh dấu đã gửi storage trong lần wake này chưa
-    connection_lost_count = 0  # Đếm số lần mất kết nối liên tiếp
+    # Các màn hình đang kết nối, key là device path
+    displays: Dict[str, DisplayConnection] = {}
+    # Số lần đã thử USB OTA cho mỗi màn hình (key: USB serial hoặc device path)
+    usb_ota_attempts: Dict[str, int] = {}
+    # Cửa sổ sparkline của từng nguồn metrics (local hoặc tên agent), push 1 lần mỗi tick
+    sparklines: Dict[str, SparklineWindows] = {}
+
+    def drop_display(display: DisplayConnection, exc: Exception) -> None:
+        """Đóng kết nối màn hình bị lỗi, sẽ được tìm lại ở lần scan tiếp theo."""
+        display.connection_lost_count += 1
+        SELF_METRICS.inc("display_disconnects", display.device_path)
+        print(f"⚠ Lỗi kết nối {display.name} (lần {display.connection_lost_count}): {exc}")
+        print(f"⚠ Mất kết nối với {display.name} - Đang đợi kết nối lại...")
+        display.close()
+        displays.pop(display.device_path, None)
 
     try:
-        # Vòng lặp chính: đợi USB -> kết nối -> hoạt động -> mất kết nối -> lặp lại
+        # Vòng lặp chính: tìm màn hình -> kết nối -> đọc metrics 1 lần -> gửi tới tất cả màn hình
         while True:
-            # Bước 1: Đợi USB device xuất hiện (nếu chưa có hoặc đã mất kết nối)
-            if not serial_file or not serial_device:
-                if serial_device:
-                    print(f"⚠ Mất kết nối với {serial_device} - Đang đợi kết nối lại...")
-                else:
-                    if fixed_serial_device:
-                        print(f"Đang đợi USB device {fixed_serial_device} xuất hiện...")
+            current_time = time.time()
+
+            # Bước 1: Tìm màn hình mới định kỳ (không block các màn hình đang hoạt động)
+            if current_time - last_scan_time >= rescan_interval:
+                last_scan_time = current_time
+                for device_path, usb_serial in discover_displays(
+                    vendor_id, model_id, fixed_serial_devices, usb_serials
+                ):
+                    if device_path in displays:
+                        continue
+                    print(f"✓ Đã tìm thấy USB device: {device_path}" + (f" (serial: {usb_serial})" if usb_serial else ""))
+                    display = DisplayConnection(
+                        device_path,
+                        usb_serial=usb_serial,
+                        no_wait_signal=args.no_wait_signal,
+                        auto_start_timeout=args.auto_start_timeout,
+                        debug=args.debug,
+                        retries=serial_retry_count,
+                        retry_delay=serial_retry_delay,
+                    )
+                    # Bước 2: Mở kết nối serial
+                    if display.open():
+                        STARTUP_TIMER.mark("display")
+                        displays[device_path] = display
+                        ota_key = usb_serial or device_path
+                        if (
+                            args.usb_ota
+                            and firmware_manifest.info().get("available")
+                            and usb_ota_attempts.get(ota_key, 0) < USB_OTA_MAX_ATTEMPTS
+                        ):
+                            usb_ota_attempts[ota_key] = usb_ota_attempts.get(ota_key, 0) + 1
+                            display.start_firmware_update(firmware_manifest.firmware_path)
+
+            if not displays:
+                if warm_cache is not None:
+                    warm_cache.idle.set()
+                # Log định kỳ để biết script vẫn đang chạy
+                if current_time - last_wait_log_time >= 10.0:
+                    if fixed_serial_devices:
+                        print(f"Đang đợi USB device {', '.join(fixed_serial_devices)} xuất hiện...")
                     else:
                         print(f"Đang đợi ESP32 USB device (vendor: {vendor_id}, model: {model_id})...")
+                    last_wait_log_time = current_time
+                time.sleep(rescan_interval)
+                continue
 
-                # Đợi USB device (vô hạn, không timeout)
-                found_device = wait_for_usb_connection(
-                    vendor_id,
-                    model_id,
-                    fixed_serial_device,
-                    check_interval=2.0,
-                    max_wait=None,
-                )
-
-                if found_device:
-                    serial_device = found_device
-                    print(f"✓ Đã tìm thấy USB device: {serial_device}")
-                    connection_lost_count = 0  # Reset counter
-                else:
-                    # Không nên xảy ra vì max_wait=None, nhưng để an toàn
-                    time.sleep(2.0)
+            # Bước 3: Hoạt động bình thường - gửi/nhận dữ liệu
+            iteration += 1
+            TICK_PROFILER.tick_start()
+
+            # Kiểm tra trạng thái backlight của từng màn hình (bỏ qua màn hình đang USB OTA)
+            # và báo ngay khi firmware thay đổi (manifest do FirmwareWatcher cập nhật)
+            firmware_notice = format_firmware_notice(firmware_manifest.info())
+            for display in list(displays.values()):
+                if display.updating:
                     continue
-
-            # Bước 2: Mở kết nối serial
-            if not serial_file:
+                display.firmware_notice = firmware_notice
                 try:
-                    # Kiểm tra device vẫn tồn tại trước khi mở
-                    if not check_usb_device_exists(serial_device):
-                        print(f"⚠ USB device {serial_device} không còn tồn tại")
-                        serial_file = None
+                    display.poll_backlight(iteration)
+                    display.push_firmware_notice()
+                except (OSError, IOError, ValueError) as exc:
+                    drop_display(display, exc)
+
+            # Chọn host hiển thị cho từng màn hình (hub xoay vòng local + các agent)
+            sources = [LOCAL_SOURCE] + (remote_hosts.host_names() if remote_hosts else [])
+            for display_index, display in enumerate(sorted(displays.values(), key=lambda d: d.device_path)):
+                source = pick_display_source(sources, display_index, current_time, args.hub_rotate)
+                if display.source != source:
+                    if len(sources) > 1:
+                        print(f"[{iteration}] {display.name}: chuyển sang hiển thị '{source}'")
+                    display.source = source
+                    # Host mới có storage/status khác, cần gửi lại wake-up labels
+                    display.storage_sent_this_wake = False
+
+            active_displays = [d for d in displays.values() if d.backlight_is_on and not d.updating]
+            if warm_cache is not None:
+                if any(d.source == LOCAL_SOURCE for d in active_displays):
+                    warm_cache.idle.clear()
+                else:
+                    warm_cache.idle.set()
+
+            # Chỉ đọc metrics khi có ít nhất một màn hình đang bật,
+            # và chỉ đọc MỘT lần cho tất cả màn hình
+            if active_displays:
+                if cadence is not None and any(not d.storage_sent_this_wake for d in active_displays):
+                    # Vừa wake up hoặc đổi host hiển thị: cập nhật nhanh
+                    cadence.reset()
+                # Màn hình vừa bật: gửi ngay frame đầu từ các collector nhanh (< 1 ms),
+                # storage và các collector chậm (synodisk, mạng...) theo sau trong cùng tick
+                waking = [d for d in active_displays if not d.storage_sent_this_wake and d.source == LOCAL_SOURCE]
+                # Warm cache còn mới: gửi luôn snapshot đó (cả storage) trong tick này, không thu thập
+                warm_metrics = warm_cache.snapshot() if warm_cache is not None and waking else None
+                if warm_metrics is not None:
+                    for display in waking:
+                        display.needs_last_known = False
+                elif waking:
+                    # Vừa kết nối: gửi trước snapshot cũ nhất quán (cả storage), đánh dấu stale
+                    last_metrics, last_timestamp, last_seq = SNAPSHOT_STORE.latest()
+                    if last_seq == 0 and last_known is not None:
+                        last_metrics, last_timestamp = last_known
+                    first_frame = quick_metrics()
+                    for display in waking:
+                        try:
+                            if display.needs_last_known:
+                                # Chỉ ngay sau khi kết nối; wake up sau đó màn hình vẫn giữ số liệu cũ
+                                display.needs_last_known = False
+                                if last_metrics:
+                                    display.send_last_known(last_metrics, time.time() - last_timestamp)
+                            display.send_first_frame(first_frame)
+                        except (OSError, IOError, ValueError) as exc:
+                            drop_display(display, exc)
+                    STARTUP_TIMER.report("frame đầu")
+                    active_displays = [d for d in active_displays if d.device_path in displays]
+
+                snapshots: Dict[str, Optional[Dict[str, str]]] = {}
+                sparklines_pushed = set()  # Mỗi nguồn chỉ thêm 1 điểm sparkline mỗi tick
+                if warm_metrics is not None:
+                    snapshots[LOCAL_SOURCE] = warm_metrics
+                    STARTUP_TIMER.report("frame đầu")
+                elif any(d.source == LOCAL_SOURCE for d in active_displays):
+                    snapshots[LOCAL_SOURCE] = aggregate_metrics()
+
+                for display in active_displays:
+                    if display.source not in snapshots:
+                        snapshots[display.source] = remote_hosts.get(display.source) if remote_hosts else None
+                    source_metrics = snapshots[display.source]
+                    if source_metrics is None:
                         continue
-
-                    serial_file = open(serial_device, "r+b", buffering=0)
-                    # QUAN TRỌNG: Set DTR và RTS thành True để ESP32 biết host đã mở port
-                    if set_serial_dtr_rts(serial_file, dtr=True, rts=True):
-                        print(f"✓ Đã kết nối tới {serial_device} với DTR=True, RTS=True")
-                    else:
-                        print(f"⚠ Đã kết nối tới {serial_device} (không thể set DTR/RTS)")
-                    # Đợi một chút để ESP32 nhận biết trạng thái
-                    time.sleep(0.1)
-
-                    # Reset các state khi kết nối mới
-                    backlight_is_on = args.no_wait_signal
-                    previous_backlight_state = False
-                    storage_sent_this_wake = False
-                    start_time = time.time()
-                    auto_start_triggered = args.no_wait_signal
-
-                    if args.no_wait_signal:
-                        print("Đã bật chế độ --no-wait-signal, bắt đầu gửi dữ liệu ngay...")
-                    elif args.auto_start_timeout > 0:
-                        print(
-                            f"Sẽ tự động bắt đầu gửi dữ liệu sau {args.auto_start_timeout} giây "
-                            "nếu không nhận được tín hiệu từ ESP32..."
-                        )
-
-                except OSError as exc:
-                    print(f"⚠ Lỗi mở {serial_device}: {exc}")
-                    print("Đang đợi và thử lại...")
-                    serial_file = None
-                    connection_lost_count += 1
-                    time.sleep(2.0)
-                    continue
-
-            # Bước 3: Hoạt động bình thường - gửi/nhận dữ liệu
-            try:
-                iteration += 1
-                current_time = time.time()
-                elapsed_time = current_time - start_time
-
-                # Kiểm tra device vẫn tồn tại
-                if not check_usb_device_exists(serial_device):
-                    raise OSError(f"USB device {serial_device} không còn tồn tại")
-
-                # Kiểm tra trạng thái backlight từ ESP32 (trừ khi dùng --no-wait-signal)
-                if not args.no_wait_signal:
-                    backlight_state = check_esp32_backlight_state(serial_file, debug=args.debug)
-                    if backlight_state is not None:
-                        previous_backlight_state = backlight_is_on
-                        backlight_is_on = backlight_state
-
-                        # Detect wake up: chuyển từ off -> on
-                        if backlight_is_on and not previous_backlight_state:
-                            print(f"[{iteration}] ESP32: Màn hình đã bật - Bắt đầu gửi dữ liệu")
-                            storage_sent_this_wake = False  # Reset flag để gửi storage lần này
-                            auto_start_triggered = True  # Đã nhận được tín hiệu, không cần auto-start
-                        elif not backlight_is_on and previous_backlight_state:
-                            print(f"[{iteration}] ESP32: Màn hình đã tắt - Dừng gửi dữ liệu")
-                            storage_sent_this_wake = False  # Reset flag cho lần wake tiếp theo
-
-                    # Auto-start nếu không nhận được tín hiệu sau timeout
-                    if (
-                        not auto_start_triggered
-                        and args.auto_start_timeout > 0
-                        and elapsed_time >= args.auto_start_timeout
-                    ):
-                        print(
-                            f"[{iteration}] Không nhận được tín hiệu từ ESP32 sau {elapsed_time:.1f} giây - "
-                            "Tự động bắt đầu gửi dữ liệu"
-                        )
-                        backlight_is_on = True
-                        auto_start_triggered = True
-                        storage_sent_this_wake = False
-                # Nếu dùng --no-wait-signal, backlight_is_on đã được set = True ở trên
-
-                # Chỉ gửi dữ liệu khi backlight bật
-                if backlight_is_on:
-                    # Đọc metrics
-                    metrics = aggregate_metrics()
-
-                    # Gửi qua serial
-                    send_success = False
-
-                    # Nếu là lần đầu wake up (chưa gửi storage), gửi cả storage và dynamic
-                    if not storage_sent_this_wake:
-                        # Gửi storage labels (1 lần duy nhất)
-                        if write_serial_with_retry(
-                            serial_file,
-                            metrics,
-                            WAKEUP_LABELS,
-                            retries=serial_retry_count,
-                            retry_delay=serial_retry_delay,
-                            dataset_name="storage data",
-                        ):
-                            print(f"[{iteration}] Đã gửi storage data (1 lần duy nhất)")
-                            storage_sent_this_wake = True
-                            send_success = True
-                        else:
-                            raise OSError("Không gửi được storage data")
-
-                        # Sau đó gửi dynamic labels ngay
-                        if write_serial_with_retry(
-                            serial_file,
-                            metrics,
-                            DYNAMIC_LABELS,
-                            retries=serial_retry_count,
-                            retry_delay=serial_retry_delay,
-                            dataset_name="dynamic data",
-                        ):
-                            print(f"[{iteration}] Đã gửi dynamic data")
-                            send_success = True
-                        else:
-                            raise OSError("Không gửi được dynamic data")
-                    else:
-                        # Đã gửi storage rồi, chỉ gửi dynamic labels
-                        if write_serial_with_retry(
-                            serial_file,
-                            metrics,
-                            DYNAMIC_LABELS,
-                            retries=serial_retry_count,
-                            retry_delay=serial_retry_delay,
-                            dataset_name="dynamic data",
-                        ):
-                            print(f"[{iteration}] Đã gửi dynamic data tới {serial_device}")
-                            send_success = True
-                        else:
-                            raise OSError("Không gửi được dữ liệu")
-
-                    # Reset connection lost counter nếu gửi thành công
-                    if send_success:
-                        connection_lost_count = 0
-
-                    # Ghi file nếu đã đến thời gian
-                    if current_time - last_file_write_time >= file_interval:
-                        write_output(metrics, output_path)
+                    windows = sparklines.setdefault(display.source, SparklineWindows())
+                    if display.source not in sparklines_pushed:
+                        windows.push(source_metrics)
+                        sparklines_pushed.add(display.source)
+                    try:
+                        display.send(source_metrics, iteration, windows)
+                    except (OSError, IOError, ValueError) as exc:
+                        drop_display(display, exc)
+
+                # Ghi file nếu đã đến thời gian (chỉ metrics của máy local)
+                metrics = snapshots.get(LOCAL_SOURCE)
+                if metrics is not None and state_file is not None:
+                    state_file.save(metrics)
+                if metrics is not None and current_time - last_file_write_time >= file_interval:
+                    if output_sink.write(metrics):
                         print(f"Đã ghi {len(LABEL_ORDER)} label vào {output_path}")
-                        last_file_write_time = current_time
-                else:
-                    # Backlight tắt, không gửi dữ liệu
-                    if iteration % 10 == 0:  # Chỉ log mỗi 10 lần để không spam
-                        print(f"[{iteration}] Đang chờ ESP32 bật màn hình...")
-
-                # Đợi đến lần kiểm tra tiếp theo
+                    last_file_write_time = current_time
+                if cadence is not None:
+                    cadence.update(snapshots)
+            else:
+                # Backlight tắt, không gửi dữ liệu
+                if iteration % 10 == 0:  # Chỉ log mỗi 10 lần để không spam
+                    print(f"[{iteration}] Đang chờ ESP32 bật màn hình...")
+
+            # Đợi đến lần kiểm tra tiếp theo (không tính vào profile)
+            TICK_PROFILER.tick_end()
+            if args.stats_log > 0 and current_time - last_stats_log_time >= args.stats_log:
+                print(SELF_METRICS.log_line())
+                last_stats_log_time = current_time
+            if cadence is None:
                 time.sleep(interval)
-
-            except (OSError, IOError, ValueError) as exc:
-                # Mất kết nối hoặc lỗi I/O - đóng kết nối và đợi reconnect
-                connection_lost_count += 1
-                print(f"⚠ Lỗi kết nối (lần {connection_lost_count}): {exc}")
-
-                # Đóng kết nối hiện tại
-                if serial_file:
-                    try:
-                        serial_file.close()
-                    except Exception:
-                        pass
-                    serial_file = None
-
-                # Đợi một chút trước khi thử lại
-                time.sleep(1.0)
-                continue
+            elif active_displays:
+                time.sleep(cadence.current)
+            else:
+                # Mọi màn hình tắt: block trên serial tới khi ESP32 gửi W, chỉ thức dậy
+                # định kỳ để quét màn hình mới, chờ màn hình USB OTA xong hoặc auto-start
+                idle_timeout = ADAPTIVE_IDLE_WAKE_SECONDS
+                for display in displays.values():
+                    if display.updating:
+                        idle_timeout = min(idle_timeout, interval)
+                    elif not display.auto_start_triggered and display.auto_start_timeout > 0:
+                        remaining = display.start_time + display.auto_start_timeout - time.time()
+                        idle_timeout = min(idle_timeout, max(0.0, remaining))
+                wait_for_display_input(list(displays.values()), idle_timeout)
 
     except KeyboardInterrupt:
         print("\nĐang dừng...")
+        TICK_PROFILER.cancel()
+        any_backlight_on = any(d.backlight_is_on for d in displays.values())
         # Đóng kết nối serial
-        if serial_file:
-            try:
-                serial_file.close()
-            except Exception:
-                pass
+        for display in displays.values():
+            display.close()
         # Ghi file lần cuối trước khi thoát (nếu backlight đang bật)
-        if backlight_is_on:
+        if any_backlight_on:
             try:
                 metrics = aggregate_metrics()
-                write_output(metrics, output_path)
-                print(f"Đã ghi dữ liệu cuối cùng vào {output_path}")
+                if output_sink.write(metrics):
+                    print(f"Đã ghi dữ liệu cuối cùng vào {output_path}")
             except Exception:
                 pass
         sys.exit(0)
     except Exception as exc:
+        TICK_PROFILER.cancel()
         # Đóng kết nối serial nếu có lỗi
-        if serial_file:
-            try:
-                serial_file.close()
-            except Exception:
-                pass
+        for display in displays.values():
+            display.close()
         raise
 
 
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Test agent/hub (SnapshotDeltaEncoder/Decoder, HubServer, RemoteHostTable) hoàn toàn trên localhost.
+
+Encoder/decoder được kiểm tra round-trip qua nhiều snapshot (đổi giá trị, thêm key, bớt key,
+frame delta lệch sequence). Hub chạy thật trên 127.0.0.1 với port ngẫu nhiên, agent giả
+là socket gửi frame như run_agent: kiểm tra agent reconnect trùng tên và dòng quá dài.
+
+CÁCH SỬ DỤNG:
+
+python3 test-agent-hub.py
+"""
+
+import json
+import socket
+import sys
+import time
+from pathlib import Path
+from threading import Thread
+
+sys.path.insert(0, str(Path(__file__).parent))
+import read_sensor  # noqa: E402
+
+
+def round_trip(snapshots, full_every=read_sensor.AGENT_FULL_SNAPSHOT_EVERY):
+    """Encode rồi decode từng snapshot; trả về danh sách (loại frame, snapshot decode được)."""
+    encoder = read_sensor.SnapshotDeltaEncoder(full_every)
+    decoder = read_sensor.SnapshotDeltaDecoder()
+    results = []
+    for metrics in snapshots:
+        frame = json.loads(encoder.encode(metrics))
+        results.append((frame["t"], decoder.apply(frame)))
+    return results
+
+
+def check(name, problems):
+    print(f"{'✓' if not problems else '✗'} {name}")
+    for problem in problems:
+        print(f"    {problem}")
+    return not problems
+
+
+def case_round_trip():
+    base = {"label_cpu_usage": "12%", "label_temp_drive1": "35°C", "label_temp_drive2": "36°C"}
+    snapshots = [
+        base,
+        dict(base, label_cpu_usage="14%"),
+        dict(base, label_cpu_usage="14%"),
+        dict(base, label_temp_drive3="33°C"),                            # Thêm ổ
+        {"label_cpu_usage": "15%", "label_temp_drive1": "35°C"},         # Rút ổ 2
+        {"label_cpu_usage": "16%", "label_temp_drive1": "35°C"},
+    ]
+    problems = []
+    results = round_trip(snapshots)
+    for step, (metrics, (kind, decoded)) in enumerate(zip(snapshots, results)):
+        if decoded != metrics:
+            problems.append(f"snapshot {step} ({kind}): {decoded} != {metrics}")
+    expected_kinds = ["full", "delta", "delta", "full", "full", "delta"]
+    kinds = [kind for kind, _ in results]
+    if kinds != expected_kinds:
+        problems.append(f"loại frame {kinds}, mong đợi {expected_kinds}")
+    return check("round-trip: đổi giá trị, thêm key, bớt key", problems)
+
+
+def case_full_every():
+    snapshots = [{"label_cpu_usage": f"{value}%"} for value in range(7)]
+    kinds = [kind for kind, _ in round_trip(snapshots, full_every=3)]
+    expected = ["full", "delta", "delta", "delta", "full", "delta", "delta"]
+    return check("full snapshot định kỳ", [] if kinds == expected else [f"{kinds} != {expected}"])
+
+
+def case_sequence_gap():
+    encoder = read_sensor.SnapshotDeltaEncoder()
+    decoder = read_sensor.SnapshotDeltaDecoder()
+    decoder.apply(json.loads(encoder.encode({"label_cpu_usage": "1%"})))
+    encoder.encode({"label_cpu_usage": "2%"})  # Frame bị mất
+    problems = []
+    try:
+        decoder.apply(json.loads(encoder.encode({"label_cpu_usage": "3%"})))
+        problems.append("không phát hiện frame delta lệch sequence")
+    except ValueError:
+        pass
+    encoder.reset()
+    decoded = decoder.apply(json.loads(encoder.encode({"label_cpu_usage": "4%"})))
+    if decoded != {"label_cpu_usage": "4%"}:
+        problems.append(f"sau resync: {decoded}")
+    return check("delta lệch sequence rồi resync", problems)
+
+
+class FakeAgent:
+    """Agent giả: gửi hello rồi frame của encoder qua TCP như run_agent."""
+
+    def __init__(self, port, name):
+        self.sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+        self.encoder = read_sensor.SnapshotDeltaEncoder()
+        self.send_line(json.dumps({"t": "hello", "host": name}).encode() + b"\n")
+
+    def send_line(self, line):
+        self.sock.sendall(line)
+
+    def send(self, metrics):
+        self.send_line(self.encoder.encode(metrics))
+
+    def closed_by_hub(self):
+        self.sock.settimeout(5)
+        try:
+            return self.sock.recv(64) == b""
+        except OSError:
+            return True
+
+    def close(self):
+        self.sock.close()
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def start_hub():
+    table = read_sensor.RemoteHostTable()
+    server = read_sensor.HubServer(("127.0.0.1", 0), table)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, table
+
+
+def case_hub_reconnect():
+    server, table = start_hub()
+    port = server.server_address[1]
+    problems = []
+    try:
+        old = FakeAgent(port, "nas2")
+        old.send({"label_cpu_usage": "1%"})
+        if not wait_for(lambda: table.get("nas2") == {"label_cpu_usage": "1%"}):
+            problems.append("hub không nhận snapshot đầu")
+        # Agent reconnect khi kết nối cũ chưa đóng, rồi kết nối cũ mới đóng
+        new = FakeAgent(port, "nas2")
+        new.send({"label_cpu_usage": "2%", "label_temp_drive1": "30°C"})
+        if not wait_for(lambda: table.get("nas2") == {"label_cpu_usage": "2%", "label_temp_drive1": "30°C"}):
+            problems.append("hub không nhận snapshot từ kết nối mới")
+        old.close()
+        time.sleep(0.3)
+        if table.host_names() != ["nas2"]:
+            problems.append(f"kết nối cũ đóng đã xóa agent đang sống: {table.host_names()}")
+        # Rút ổ: key mất trên agent cũng phải mất trên hub
+        new.send({"label_cpu_usage": "3%"})
+        if not wait_for(lambda: table.get("nas2") == {"label_cpu_usage": "3%"}):
+            problems.append(f"key đã bỏ vẫn còn trên hub: {table.get('nas2')}")
+        new.close()
+        if not wait_for(lambda: table.host_names() == []):
+            problems.append("agent ngắt kết nối nhưng vẫn còn trong bảng")
+    finally:
+        server.shutdown()
+        server.server_close()
+    return check("hub: agent reconnect trùng tên, bớt key", problems)
+
+
+def case_hub_long_line():
+    server, table = start_hub()
+    problems = []
+    try:
+        agent = FakeAgent(server.server_address[1], "flood")
+        try:
+            agent.send_line(b"x" * (read_sensor.HUB_MAX_LINE_BYTES + 1024))
+        except OSError:
+            pass  # Hub có thể đóng trước khi gửi hết
+        if not agent.closed_by_hub():
+            problems.append("hub không đóng kết nối gửi dòng quá dài")
+        agent.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+    return check("hub: dòng quá dài bị từ chối", problems)
+
+
+def main():
+    ok = all([
+        case_round_trip(),
+        case_full_every(),
+        case_sequence_gap(),
+        case_hub_reconnect(),
+        case_hub_long_line(),
+    ])
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Test nội dung /metrics (render_prometheus_metrics) theo Prometheus text format, không cần phần cứng.
+
+Snapshot lấy từ sensors.txt mẫu (có đủ đơn vị: %, °C, RPM, Gb, Mbps, MB/s, ms...), kèm
+histogram độ trễ, bộ đếm, budget và circuit breaker, để mọi metric family đều xuất hiện.
+Kiểm tra: mỗi tên trong "# TYPE" chỉ khai báo một lần (Prometheus bỏ cả lần scrape nếu
+trùng), mỗi sample thuộc một family đã khai báo và không có series trùng (tên + labels).
+
+CÁCH SỬ DỤNG:
+
+python3 test-prometheus.py
+"""
+
+import re
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+import read_sensor  # noqa: E402
+
+SAMPLE_RE = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? (\S+)$")
+# Hậu tố sample của histogram/summary thuộc về family gốc
+FAMILY_SUFFIXES = ("_bucket", "_sum", "_count")
+
+
+def load_snapshot():
+    """Metrics từ sensors.txt mẫu; label thiếu là "N/A" như aggregate_metrics."""
+    metrics = {}
+    for line in (Path(__file__).parent / "sensors.txt").read_text(encoding="utf-8").splitlines():
+        label, sep, value = line.partition(": ")
+        if sep:
+            metrics[label] = value
+    for label in read_sensor.LABEL_ORDER:
+        metrics.setdefault(label, "N/A")
+    return metrics
+
+
+def populate():
+    metrics = load_snapshot()
+    read_sensor.SNAPSHOT_STORE.publish(metrics, dict.fromkeys(metrics, "test"), {"network": 3.0})
+    read_sensor.SELF_METRICS.observe("collector", "cpu", 0.002)
+    read_sensor.SELF_METRICS.observe("subprocess", "ping", 0.02)
+    read_sensor.SELF_METRICS.inc("collector_errors", "gpu")
+    read_sensor.TICK_BUDGET.record("cpu", 0.002, 0.001, {"label_cpu_usage": "5%"})
+    read_sensor.TICK_BUDGET.end_tick(0.002)
+    read_sensor.COLLECTOR_STATS.record("cpu", 0.002, None, 0)
+    for _ in range(read_sensor.BREAKER_THRESHOLD):
+        read_sensor.BREAKERS.failure("nvidia-smi")
+    return metrics
+
+
+def check_exposition(body):
+    problems = []
+    declared = {}
+    series = set()
+    for number, line in enumerate(body.splitlines(), 1):
+        if line.startswith("# TYPE "):
+            name = line.split()[2]
+            if name in declared:
+                problems.append(f"dòng {number}: TYPE {name} khai báo lại (lần đầu ở dòng {declared[name]})")
+            declared[name] = number
+            continue
+        if not line or line.startswith("#"):
+            continue
+        match = SAMPLE_RE.match(line)
+        if match is None:
+            problems.append(f"dòng {number}: sample không hợp lệ: {line}")
+            continue
+        name, labels = match.group(1), match.group(2) or ""
+        family = next(
+            (name[:-len(suffix)] for suffix in FAMILY_SUFFIXES
+             if name.endswith(suffix) and name[:-len(suffix)] in declared),
+            name,
+        )
+        if family not in declared:
+            problems.append(f"dòng {number}: {name} chưa có TYPE")
+        if (name, labels) in series:
+            problems.append(f"dòng {number}: series trùng {name}{labels}")
+        series.add((name, labels))
+    return declared, problems
+
+
+def main():
+    populate()
+    body = read_sensor.render_prometheus_metrics().decode("utf-8")
+    declared, problems = check_exposition(body)
+    # Snapshot mẫu có ping (ms) nên family độ trễ theo label và histogram self-metrics cùng có mặt
+    for name in ("jonsbo_latency_seconds", "jonsbo_self_latency_seconds"):
+        if name not in declared:
+            problems.append(f"thiếu family {name}")
+    # Lần render thứ hai đi qua cache snapshot, phải cho cùng tập family
+    cached, cached_problems = check_exposition(read_sensor.render_prometheus_metrics().decode("utf-8"))
+    problems += cached_problems
+    if set(cached) != set(declared):
+        problems.append(f"render từ cache khác family: {sorted(set(cached) ^ set(declared))}")
+
+    print(f"{'✓' if not problems else '✗'} /metrics: {len(declared)} family, TYPE không trùng")
+    for problem in problems:
+        print(f"    {problem}")
+    sys.exit(0 if not problems else 1)
+
+
+if __name__ == "__main__":
+    main()
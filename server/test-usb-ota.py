@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Test đường truyền USB OTA (UsbOtaUploader trong read_sensor.py) với ESP32 giả qua pty.
+
+ESP32 giả chạy trong thread, làm đúng phần nhận frame như usb_comm.c/ota_update.c:
+parse "ota_begin:", kiểm tra CRC32/offset, ack tích lũy, NAK khi mất frame, resume
+khi nhận lại cùng image, kiểm tra SHA-256 rồi trả lời 'D'. Có thể giả lập lỗi:
+mất frame, sai CRC, chen byte W/S và mất kết nối giữa chừng.
+
+CÁCH SỬ DỤNG:
+
+python3 test-usb-ota.py
+python3 test-usb-ota.py --size-kb 2048
+"""
+
+import argparse
+import hashlib
+import os
+import pty
+import select
+import struct
+import sys
+import time
+import tty
+import zlib
+from pathlib import Path
+from threading import Event, Thread
+
+sys.path.insert(0, str(Path(__file__).parent))
+import read_sensor  # noqa: E402
+
+HEADER = read_sensor.USB_OTA_FRAME_HEADER
+CRC = read_sensor.USB_OTA_FRAME_CRC
+# Giống USB_OTA_IDLE_TIMEOUT_MS trong usb_comm.c
+IDLE_TIMEOUT = 1.0
+
+
+class FakeDevice:
+    """ESP32 giả ở đầu master của pty."""
+
+    def __init__(self, fd, running_digest=None, drop_frames=(), corrupt_frames=(), stall_at=None):
+        self.fd = fd
+        self.running_digest = running_digest
+        self.drop_frames = set(drop_frames)
+        self.corrupt_frames = set(corrupt_frames)
+        self.stall_at = stall_at  # Ngừng phản hồi khi nhận tới offset này (giả lập rút cáp)
+        self.stalled = Event()
+        self.stop = Event()
+        self.image = bytearray()
+        self.size = 0
+        self.sha256 = None
+        self.binary = False
+        self.frames_received = 0
+        self.naks = 0
+        self.done = False
+        self.buffer = b""
+
+    def reply(self, text):
+        os.write(self.fd, text.encode() + b"\n")
+
+    def handle_line(self, line):
+        if not line.startswith(b"ota_begin:"):
+            return
+        size, sha256, digest = line.split(b":", 1)[1].split()
+        if self.running_digest and digest.decode() == self.running_digest:
+            self.reply("U")
+            return
+        if self.sha256 == sha256.decode() and self.size == int(size):
+            # Cùng image với lần nhận dở: resume
+            self.binary = True
+            self.reply(f"B{len(self.image)}")
+            return
+        self.size, self.sha256, self.image = int(size), sha256.decode(), bytearray()
+        self.binary = True
+        self.reply("B0")
+
+    def handle_frames(self):
+        """Xử lý frame trong buffer; trả về khi cần thêm dữ liệu hoặc đã thoát chế độ frame."""
+        nak_sent = False
+        while self.binary:
+            start = self.buffer.find(read_sensor.USB_OTA_FRAME_MAGIC)
+            if start < 0:
+                self.buffer = self.buffer[-1:]
+                return
+            self.buffer = self.buffer[start:]
+            if len(self.buffer) < HEADER.size:
+                return
+            _, seq, offset, length = HEADER.unpack_from(self.buffer)
+            total = HEADER.size + length + CRC.size
+            if len(self.buffer) < total:
+                return
+            frame, self.buffer = self.buffer[:total], self.buffer[total:]
+            if length == 0:
+                # Frame rỗng: host yêu cầu thoát chế độ nhận frame
+                self.binary = False
+                return
+            self.frames_received += 1
+            if seq in self.drop_frames:
+                self.drop_frames.discard(seq)
+                continue
+            payload = bytearray(frame[HEADER.size:HEADER.size + length])
+            if seq in self.corrupt_frames:
+                self.corrupt_frames.discard(seq)
+                payload[0] ^= 0xFF
+            (crc,) = CRC.unpack_from(frame, HEADER.size + length)
+            expected_crc = zlib.crc32(bytes(payload), zlib.crc32(frame[2:HEADER.size])) & 0xFFFFFFFF
+            if crc != expected_crc or offset > len(self.image):
+                if not nak_sent:
+                    self.naks += 1
+                    self.reply(f"N{len(self.image)}")
+                    nak_sent = True
+                continue
+            if offset < len(self.image):
+                continue  # Frame gửi lại, đã có
+            nak_sent = False
+            self.image += payload
+            self.reply(f"K{len(self.image)}")
+            if seq % 64 == 0:
+                os.write(self.fd, b"W")  # Tín hiệu backlight chen giữa các ack
+            if self.stall_at is not None and len(self.image) >= self.stall_at:
+                self.stall_at = None
+                self.stalled.set()
+                return
+            if len(self.image) == self.size:
+                ok = hashlib.sha256(self.image).hexdigest() == self.sha256
+                self.done = ok
+                self.reply("D" if ok else "E-1")
+                self.binary = False
+                return
+
+    def run(self):
+        last_rx = time.monotonic()
+        while not self.stop.is_set():
+            ready, _, _ = select.select([self.fd], [], [], 0.05)
+            if not ready:
+                if self.binary and time.monotonic() - last_rx > IDLE_TIMEOUT:
+                    # Giống ESP32: không có dữ liệu thì bỏ frame dở và quay về chế độ dòng lệnh
+                    self.binary = False
+                    self.buffer = b""
+                continue
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError:
+                return
+            if self.stalled.is_set():
+                continue  # Đang "rút cáp": bỏ toàn bộ dữ liệu
+            last_rx = time.monotonic()
+            self.buffer += data
+            while True:
+                if self.binary:
+                    self.handle_frames()
+                    if self.binary:
+                        break  # Cần thêm dữ liệu
+                elif b"\n" in self.buffer:
+                    line, self.buffer = self.buffer.split(b"\n", 1)
+                    self.handle_line(line.strip())
+                else:
+                    break
+
+
+def open_pair():
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    return master, open(os.ttyname(slave), "r+b", buffering=0), slave
+
+
+def make_firmware(size):
+    """Image giả có header ESP-IDF và SHA-256 đính kèm ở cuối."""
+    body = bytearray(os.urandom(size - 32))
+    body[0] = read_sensor.ESP_IMAGE_MAGIC
+    body[23] = 1  # hash_appended
+    return bytes(body) + hashlib.sha256(body).digest()
+
+
+def run_case(name, firmware, device_kwargs, expect_update=True, ack_timeout=0.2):
+    master, serial_file, slave = open_pair()
+    device = FakeDevice(master, **device_kwargs)
+    thread = Thread(target=device.run, daemon=True)
+    thread.start()
+    problems = []
+    try:
+        start = time.perf_counter()
+        uploader = read_sensor.UsbOtaUploader(serial_file, firmware, name=name, ack_timeout=ack_timeout)
+        if device.stall_at is not None:
+            try:
+                uploader.run()
+                problems.append("không phát hiện mất kết nối")
+            except OSError:
+                pass
+            # "Cắm lại cáp": uploader mới phải resume từ offset đã ack
+            device.stalled.clear()
+            resumed_from = len(device.image)
+            frames_before = device.frames_received
+            uploader = read_sensor.UsbOtaUploader(serial_file, firmware, name=name, ack_timeout=ack_timeout)
+            updated = uploader.run()
+            resent = (device.frames_received - frames_before) * read_sensor.USB_OTA_CHUNK_SIZE
+            if resent > len(firmware) - resumed_from + read_sensor.USB_OTA_WINDOW * read_sensor.USB_OTA_CHUNK_SIZE:
+                problems.append(f"không resume: gửi lại {resent} bytes từ offset {resumed_from}")
+        else:
+            updated = uploader.run()
+        elapsed = time.perf_counter() - start
+        if updated != expect_update:
+            problems.append(f"run() trả về {updated}, mong đợi {expect_update}")
+        if expect_update and (not device.done or bytes(device.image) != firmware):
+            problems.append("image nhận được không khớp")
+    except OSError as exc:
+        problems.append(str(exc))
+        elapsed = 0.0
+    finally:
+        device.stop.set()
+        thread.join()
+        serial_file.close()
+        os.close(master)
+        os.close(slave)
+
+    status = "✓" if not problems else "✗"
+    speed = len(firmware) / elapsed / 1024 if expect_update and elapsed else 0
+    print(f"{status} {name}: {elapsed:.2f}s" + (f", {speed:.0f} KB/s, {device.naks} NAK" if speed else ""))
+    for problem in problems:
+        print(f"    {problem}")
+    return not problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test USB OTA với ESP32 giả qua pty")
+    parser.add_argument("--size-kb", type=int, default=512, help="Kích thước firmware giả (KB, default: 512)")
+    args = parser.parse_args()
+
+    firmware = make_firmware(args.size_kb * 1024)
+    digest = read_sensor.esp_image_digest(firmware)
+    ok = all([
+        run_case("truyền bình thường", firmware, {}),
+        run_case("mất frame + sai CRC", firmware, {"drop_frames": {3, 40}, "corrupt_frames": {7, 41}}),
+        run_case("mất kết nối rồi resume", firmware, {"stall_at": len(firmware) // 2}),
+        run_case("đã chạy bản mới nhất", firmware, {"running_digest": digest}, expect_update=False),
+    ])
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()